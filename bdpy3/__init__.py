@@ -1,3 +1,29 @@
 # -*- coding: utf-8 -*-
 
-from .borrowdirect import BorrowDirect
+""" Exports BorrowDirect, AsyncBorrowDirect, and TenantRegistry.
+    They are loaded on first access, so `import bdpy3` stays cheap for short-lived cli and cron processes;
+      `requests` (and `aiohttp`, for AsyncBorrowDirect) is only imported once a client is actually built. """
+
+import importlib
+
+
+_LAZY_EXPORTS = {
+    'BorrowDirect': '.borrowdirect',
+    'AsyncBorrowDirect': '.async_client',
+    'TenantRegistry': '.tenants',
+    }
+
+__all__ = list( _LAZY_EXPORTS )
+
+
+def __getattr__( name ):
+    """ Imports the submodule holding `name` on first access, then caches the attribute on the package. """
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError( 'module %r has no attribute %r' % (__name__, name) )
+    value = getattr( importlib.import_module(_LAZY_EXPORTS[name], __name__), name )
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted( list(globals()) + __all__ )
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+""" Enables `python -m bdpy3`; see cli.py """
+
+import sys
+from .cli import main
+
+
+sys.exit( main() )
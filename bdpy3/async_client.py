@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+""" asyncio equivalent of BorrowDirect; requires the optional `aiohttp` package (`pip install bdpy3[async]`). """
+
+import asyncio, json, logging, time
+from .logger_setup import LazyBody
+from .auth import is_invalid_aid_response, make_auth_params
+from .borrowdirect import BorrowDirectHelper
+from .cache import SqliteSearchCache, bib_search_key, exact_search_key
+from .deadline import Deadline, DeadlineExceeded, deadline_guard, timeout_for_phase
+from .metrics import loads_json
+from .ratelimit import FileTokenBucket
+from .results import format_result
+from .request import build_bib_search_params, build_exact_search_params
+from .search import DEFAULT_FORMATS, VALID_SEARCH_TYPES, build_bib_item_params, build_exact_item_params
+from .singleflight import AsyncSingleFlight
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncBorrowDirect( object ):
+    """ Manages high-level awaitable function calls, so one event-loop can keep many searches/requests in flight.
+        Settings are handled as for BorrowDirect; json is built by the same module-level param-builders Authenticator, Searcher, and Requester use,
+          so no `requests` session is created.
+        Each run_* method returns its result, and also stores it on the instance like BorrowDirect does --
+          with concurrent calls, use the returned value.
+        File-backed stores -- AUTH_CACHE_PATH, SEARCH_CACHE_PATH, RATE_LIMIT_PATH -- block on file-locks and disk i/o,
+          so their calls run on the loop's default executor rather than on the event-loop; in-memory stores are called directly. """
+
+    def __init__( self, settings=None, logger=None, session=None ):
+        """ `session` may be an existing aiohttp.ClientSession; otherwise one is created on first use, inside the running event-loop. """
+        ## general initialization
+        self.API_URL_ROOT = None
+        self.API_KEY = None
+        self.PARTNERSHIP_ID = None
+        self.UNIVERSITY_CODE = None
+        self.PICKUP_LOCATION = None
+        self.LOG_PATH = None
+        self.LOG_LEVEL = None
+        ## setup
+        bdh = BorrowDirectHelper()
+        normalized_settings = bdh.normalize_settings( settings )
+        bdh.update_properties( self, normalized_settings )
+        bdh.setup_log( self, logger )
+        self.auth_cache = bdh.make_auth_cache( self )
+        self.search_cache = bdh.make_search_cache( self )
+        self.search_flights = AsyncSingleFlight( 'search' ) if self.SEARCH_SINGLE_FLIGHT else None
+        self.rate_limiter = bdh.make_rate_limiter( self )
+        self.metrics = bdh.make_metrics( self )
+        self.auth_cache_blocks = bool( self.auth_cache and self.auth_cache.store )
+        self.search_cache_blocks = isinstance( self.search_cache, SqliteSearchCache )
+        self.rate_limiter_blocks = isinstance( self.rate_limiter, FileTokenBucket )
+        self.session = session
+        self.owns_session = session is None
+        ## updated by workflow
+        self.AId = None
+        self.authnz_valid = None
+        self.search_result = None
+        self.request_result = None
+
+    async def run_auth_nz( self, patron_barcode ):
+        """ Runs authN/Z and stores authentication-id; returns authorization validity.
+            Can be called manually, but likely no need to, since the search and request calls handle auth automatically. """
+        log.debug( 'starting async run_auth_nz()...' )
+        deadline = self.new_deadline()  # auth is the whole operation here, so it gets the whole budget
+        self.AId = await self._authenticate( patron_barcode, deadline )
+        if self.auth_cache:
+            await self._offload( self.auth_cache_blocks, self.auth_cache.set, self._auth_cache_key(patron_barcode), self.AId )
+        url = '%s/portal-service/user/authz/isAuthorized?aid=%s' % ( self.API_URL_ROOT, self.AId )
+        dct = await self._call( 'GET', url, 'authorization', deadline )
+        self.authnz_valid = dct['AuthorizationState']['State']
+        assert type( self.authnz_valid ) == bool
+        log.info( 'async run_auth_nz() complete' )
+        return self.authnz_valid
+
+    async def run_search_exact_item( self, patron_barcode, search_type, search_value ):
+        """ Searches for exact key-value; returns result_dct.
+            Called manually. """
+        assert search_type in VALID_SEARCH_TYPES
+        key = exact_search_key( self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, search_type, search_value )
+        params = build_exact_item_params( patron_barcode, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, search_type, search_value )
+        self.search_result = self.format_result( await self._search_with_cache(patron_barcode, key, params, self.new_deadline()), 'search' )
+        log.info( 'async run_search_exact_item() complete' )
+        return self.search_result
+
+    async def run_search_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Searches for bib item; returns result_dct.
+            Called manually. """
+        key = bib_search_key( self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, title, author, year, formats )
+        params = build_bib_item_params( self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, title, author, year, formats )
+        self.search_result = self.format_result( await self._search_with_cache(patron_barcode, key, params, self.new_deadline()), 'search' )
+        log.info( 'async run_search_bib_item() complete' )
+        return self.search_result
+
+    async def run_request_exact_item( self, patron_barcode, search_type, search_value ):
+        """ Runs an 'ExactSearch' request; returns result_dct.
+            Called manually. """
+        assert search_type in VALID_SEARCH_TYPES
+        params = build_exact_search_params( self.PARTNERSHIP_ID, self.PICKUP_LOCATION, search_type, search_value )
+        self.request_result = self.format_result( await self._post_with_auth(patron_barcode, 'dws/item/add', params, self.new_deadline()), 'request' )
+        log.info( 'async run_request_exact_item() complete' )
+        return self.request_result
+
+    async def run_request_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Runs a 'BibSearch' request; returns result_dct.
+            Called manually. """
+        params = build_bib_search_params( self.PARTNERSHIP_ID, self.PICKUP_LOCATION, title, author, year, formats )
+        self.request_result = self.format_result( await self._post_with_auth(patron_barcode, 'dws/item/add', params, self.new_deadline()), 'request' )
+        log.info( 'async run_request_bib_item() complete' )
+        return self.request_result
+
+    async def close( self ):
+        """ Closes the aiohttp session if this instance created it.
+            Called manually, or on leaving an `async with AsyncBorrowDirect(...) as bd:` block. """
+        if self.session and self.owns_session:
+            await self.session.close()
+            self.session = None
+        return
+
+    async def __aenter__( self ):
+        return self
+
+    async def __aexit__( self, exc_type, exc_value, traceback ):
+        await self.close()
+        return False
+
+    async def _search_with_cache( self, patron_barcode, key, params, deadline=None ):
+        """ Returns cached search result if available; otherwise joins an identical in-flight search, or searches and caches the result.
+            Called by run_search_exact_item() and run_search_bib_item() """
+        if self.search_cache:
+            result_dct = await self._offload( self.search_cache_blocks, self.search_cache.get, key )
+            if result_dct is not None:
+                return result_dct
+        if self.search_flights:
+            authorization_id = await self._get_authorization_id( patron_barcode, deadline )  # each caller's own, so only the search is shared
+            return await self.search_flights.do(
+                (self.API_URL_ROOT,) + key, lambda: self._search_and_cache(patron_barcode, key, params, deadline, authorization_id), deadline )
+        return await self._search_and_cache( patron_barcode, key, params, deadline )
+
+    async def _search_and_cache( self, patron_barcode, key, params, deadline=None, authorization_id=None ):
+        """ Searches, and caches the result if there is a search-cache.
+            Called by _search_with_cache() """
+        result_dct = await self._post_with_auth( patron_barcode, 'dws/item/available', params, deadline, authorization_id )
+        if self.search_cache:
+            await self._offload( self.search_cache_blocks, self.search_cache.set, key, result_dct )
+        return result_dct
+
+    async def _post_with_auth( self, patron_barcode, path, params, deadline=None, authorization_id=None ):
+        """ Posts params with a (possibly cached) authorization-id, unless one is passed in; retries once with a fresh id if a cached one is rejected.
+            Called by the run_search_* and run_request_* methods. """
+        if not authorization_id:
+            authorization_id = await self._get_authorization_id( patron_barcode, deadline )
+        result_dct = await self._post( path, authorization_id, params, deadline )
+        if self.auth_cache and is_invalid_aid_response( result_dct ):
+            log.info( 'authorization_id rejected; re-authenticating' )
+            await self._offload( self.auth_cache_blocks, self.auth_cache.invalidate, self._auth_cache_key(patron_barcode) )
+            authorization_id = await self._get_authorization_id( patron_barcode, deadline )
+            result_dct = await self._post( path, authorization_id, params, deadline )
+        return result_dct
+
+    async def _get_authorization_id( self, patron_barcode, deadline=None ):
+        """ Returns cached authorization-id, or authenticates within the deadline's auth share.
+            Called by _post_with_auth() """
+        if self.auth_cache:
+            authorization_id = await self._offload( self.auth_cache_blocks, self.auth_cache.get, self._auth_cache_key(patron_barcode) )
+            if authorization_id:
+                return authorization_id
+        authorization_id = await self._authenticate( patron_barcode, deadline.for_auth() if deadline else None )
+        if self.auth_cache:
+            await self._offload( self.auth_cache_blocks, self.auth_cache.set, self._auth_cache_key(patron_barcode), authorization_id )
+        return authorization_id
+
+    async def _authenticate( self, patron_barcode, deadline=None ):
+        """ Calls the authentication webservice; returns authentication-id.
+            Called by run_auth_nz() and _get_authorization_id() """
+        url = '%s/portal-service/user/authentication' % self.API_URL_ROOT
+        headers = { 'Content-type': 'application/json', 'Accept': 'text/plain'}
+        params = make_auth_params( patron_barcode, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE )
+        dct = await self._call( 'POST', url, 'authentication', deadline, data=json.dumps(params), headers=headers )
+        return dct['AuthorizationId']
+
+    async def _post( self, path, authorization_id, params, deadline=None ):
+        """ Posts json to a dws webservice; returns result_dct.
+            Called by _post_with_auth() """
+        url = '%s/%s?aid=%s' % ( self.API_URL_ROOT, path, authorization_id )
+        headers = { 'Content-type': 'application/json' }
+        return await self._call( 'POST', url, 'search' if path == 'dws/item/available' else 'request', deadline, data=json.dumps(params), headers=headers )
+
+    async def _call( self, method, url, endpoint, deadline=None, **kwargs ):
+        """ Makes the call after any rate-limit wait, recording metrics if enabled; returns decoded json.
+            With a deadline, the whole call -- including the rate-limit wait -- must finish within the remaining budget.
+            Called by _authenticate(), _post(), and run_auth_nz() """
+        session = await self._get_session()
+        await self._wait_for_rate_limiter( deadline, endpoint )
+        if deadline:
+            import aiohttp
+            ( connect, sock_read ) = timeout_for_phase( self._timeout_tuple(), deadline, endpoint )  # raises DeadlineExceeded if the budget is gone
+            kwargs['timeout'] = aiohttp.ClientTimeout( total=deadline.remaining(), connect=connect, sock_read=sock_read )
+        start_time = self.metrics.start_call( endpoint ) if self.metrics else None
+        ( status, timed_out, connection_error ) = ( None, False, False )
+        try:
+            with deadline_guard( deadline, endpoint ):
+                async with session.request( method, url, **kwargs ) as r:
+                    status = r.status
+                    content = await r.read()
+        except asyncio.TimeoutError:
+            timed_out = True
+            raise
+        except OSError:  # includes aiohttp's connection errors
+            connection_error = True
+            raise
+        finally:
+            if self.metrics:
+                self.metrics.finish_call( endpoint, start_time, status=status, timed_out=timed_out, connection_error=connection_error )
+        log.debug( '%s response, `%s`', endpoint, LazyBody(content) )
+        decode_start = time.perf_counter()
+        dct = loads_json( content )
+        if self.metrics:
+            self.metrics.observe_decode( endpoint, time.perf_counter() - decode_start, dct )
+        return dct
+
+    async def _get_session( self ):
+        """ Returns the aiohttp session, creating it on first use.
+            Called by _call() """
+        if self.session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError( 'AsyncBorrowDirect requires the `aiohttp` package; install with `pip install bdpy3[async]`' )
+            connector = aiohttp.TCPConnector( limit=self.ASYNC_CONNECTION_LIMIT, force_close=(not self.HTTP_KEEP_ALIVE) )
+            ( connect, sock_read ) = self._timeout_tuple()
+            self.session = aiohttp.ClientSession( connector=connector, timeout=aiohttp.ClientTimeout(connect=connect, sock_read=sock_read) )
+        return self.session
+
+    async def _wait_for_rate_limiter( self, deadline=None, phase=None ):
+        """ Awaits, without blocking the event-loop, until the rate-limiter allows a call.
+            With a deadline, raises DeadlineExceeded for `phase` at once, taking no token, if the wait would outlast the remaining budget.
+            Called by _call() """
+        if self.rate_limiter:
+            wait = await self._offload( self.rate_limiter_blocks, self.rate_limiter.reserve, deadline.remaining() if deadline else None )
+            if wait is None:
+                log.warning( 'rate-limit wait would outlast the deadline in phase, `%s`', phase )
+                raise DeadlineExceeded( phase, deadline.seconds, deadline.seconds - deadline.remaining() )
+            if wait > 0:
+                await asyncio.sleep( wait )
+        return
+
+    async def _offload( self, blocking, func, *args ):
+        """ Returns func( *args ), run on the default executor if `blocking`, so file-locks and disk i/o do not stall the event-loop.
+            Called by the auth-cache, search-cache, and rate-limiter call-sites. """
+        if blocking:
+            return await asyncio.get_running_loop().run_in_executor( None, func, *args )
+        return func( *args )
+
+    def format_result( self, result_dct, kind ):
+        """ Returns result_dct per the RESULT_* settings; see results.format_result().
+            Called by the run_search_* and run_request_* methods. """
+        return format_result( result_dct, kind, self.RESULT_FORMAT, self.RESULT_DROP_FIELDS, self.RESULT_KEEP_RAW )
+
+    def new_deadline( self ):
+        """ Returns a fresh Deadline of DEADLINE_SECONDS for one operation, or None if no deadline is set.
+            Called by the run_* methods. """
+        if not self.DEADLINE_SECONDS:
+            return None
+        return Deadline( self.DEADLINE_SECONDS, self.DEADLINE_AUTH_SHARE )
+
+    def _timeout_tuple( self ):
+        return ( self.HTTP_CONNECT_TIMEOUT, self.HTTP_READ_TIMEOUT )
+
+    def _auth_cache_key( self, patron_barcode ):
+        return self.auth_cache.make_key( self.API_URL_ROOT, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, patron_barcode )
+
+    ## end class AsyncBorrowDirect
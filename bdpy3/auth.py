@@ -1,54 +1,81 @@
 # -*- coding: utf-8 -*-
 
-import json, logging, os, pprint
-import requests
-from . import logger_setup
+import json, logging
+from .logger_setup import LazyBody, LazyPformat
+from .deadline import deadline_guard, timeout_for_phase
+from .metrics import decode_json
 
 
 log = logging.getLogger(__name__)
-logger_setup.check_logger()
+
+INVALID_AID_ERROR_CODES = ( 'PUBAN003', )  # returned by search/request webservices when an authorization-id has expired or is unknown
 
 
 class Authenticator( object ):
     """ Enables easy calls to the BorrowDirect authN/Z webservices.
         BorrowDirect 'Authentication Web Service' docs: <http://borrowdirect.pbworks.com/w/page/90132761/Authentication%20Web%20Service> (login required)
         BorrowDirect 'Authorization Web Service' docs: <http://borrowdirect.pbworks.com/w/page/90132884/Authorization%20Web%20Service> (login required)
+        `timeout` is seconds, or a ( connect, read ) tuple, per call; a `deadline` passed to a call caps it further.
         Called by BorrowDirect.run_auth_nz() """
 
-    def __init__( self ):
-        pass
+    def __init__( self, session=None, timeout=90 ):
+        if session is None:
+            from .cassette import default_session  # imports requests on first use, so `import bdpy3` stays cheap
+            session = default_session()  # the `requests` module, unless BDPY3_CASSETTE_PATH is set
+        self.session = session  # a session.BorrowDirectSession reuses pooled connections
+        self.metrics = getattr( session, 'metrics', None )
+        self.timeout = timeout
 
-    def authenticate( self, patron_barcode, api_url, api_key, partnership_id, university_code ):
+    def authenticate( self, patron_barcode, api_url, api_key, partnership_id, university_code, deadline=None ):
         """ Accesses and returns authentication-id for storage.
             Called by BorrowDirect.run_auth_nz(), Searcher.get_authorization_id(), and Requester.get_authorization_id() """
         url = '%s/portal-service/user/authentication' % api_url
         headers = { 'Content-type': 'application/json', 'Accept': 'text/plain'}
         params = self._make_auth_params( patron_barcode, api_url, api_key, partnership_id, university_code )
-        log.debug( 'params, `%s`' % pprint.pformat(params) )
-        r = requests.post( url, data=json.dumps(params), headers=headers, timeout=90 )
-        log.debug( 'auth response, `%s`' % r.content.decode('utf-8') )
-        authentication_id = r.json()['AuthorizationId']
+        log.debug( 'params, `%s`', LazyPformat(params) )
+        with deadline_guard( deadline, 'authentication' ):
+            r = self.session.post( url, data=json.dumps(params), headers=headers, timeout=timeout_for_phase(self.timeout, deadline, 'authentication') )
+        log.debug( 'auth response, `%s`', LazyBody(r.content) )
+        authentication_id = decode_json( r, self.metrics, 'authentication' )['AuthorizationId']
         return authentication_id
 
     def _make_auth_params( self, patron_barcode, api_url, api_key, partnership_id, university_code ):
-        """ Preps param dict.
+        """ Preps param dict; see make_auth_params().
             Called by authenticate() """
-        params = {
-            'ApiKey': api_key,
-            'UserGroup': 'patron',
-            'LibrarySymbol': university_code,
-            'PartnershipId': partnership_id,
-            'PatronId': patron_barcode }
-        return params
-
-    def authorize( self, api_url, authentication_id ):
+        return make_auth_params( patron_barcode, api_key, partnership_id, university_code )
+
+    def authorize( self, api_url, authentication_id, deadline=None ):
         """ Checks authorization and extends authentication session time.
-            Called by BorrowDirect.run_auth_nz() """
+            Called by BorrowDirect.auth_nz() and keepalive.AuthKeepAlive.refresh() """
         url = '%s/portal-service/user/authz/isAuthorized?aid=%s' % ( api_url, authentication_id )
-        r = requests.get( url, timeout=90 )
-        dct = r.json()
+        with deadline_guard( deadline, 'authorization' ):
+            r = self.session.get( url, timeout=timeout_for_phase(self.timeout, deadline, 'authorization') )
+        dct = decode_json( r, self.metrics, 'authorization' )
         state = dct['AuthorizationState']['State']  # boolean
         assert type( state ) == bool
         return state
 
     # end class Authenticator
+
+
+def is_invalid_aid_response( result_dct ):
+    """ Returns True if a search/request response -- a dct, or a results.SearchResult/RequestResult -- shows the authorization-id was rejected.
+        Called by Searcher and Requester when an AuthIdCache is in use. """
+    if hasattr( result_dct, 'problem_code' ):
+        return result_dct.problem_code in INVALID_AID_ERROR_CODES
+    try:
+        return result_dct['Problem']['ErrorCode'] in INVALID_AID_ERROR_CODES
+    except ( KeyError, TypeError ):
+        return False
+
+
+def make_auth_params( patron_barcode, api_key, partnership_id, university_code ):
+    """ Preps authentication param dict.
+        Called by Authenticator._make_auth_params() and AsyncBorrowDirect._authenticate() """
+    params = {
+        'ApiKey': api_key,
+        'UserGroup': 'patron',
+        'LibrarySymbol': university_code,
+        'PartnershipId': partnership_id,
+        'PatronId': patron_barcode }
+    return params
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+""" Runs many calls on a bounded thread-pool. """
+
+import concurrent.futures, itertools, logging
+
+
+log = logging.getLogger(__name__)
+
+
+def run_unordered( func, items, max_workers=4, max_pending=None ):
+    """ Yields ( item, result ) tuples as each func(item) completes; order follows completion, not input.
+        If func(item) raises, the exception instance is yielded as the result, so one failure does not end the batch.
+        At most `max_pending` items (default twice max_workers) are in flight, so `items` may be a long lazy iterable.
+        Called by BorrowDirect.run_search_batch() """
+    max_pending = max_pending if max_pending else max_workers * 2
+    items = iter( items )
+    executor = concurrent.futures.ThreadPoolExecutor( max_workers=max_workers )
+    try:
+        pending = {}
+        for item in itertools.islice( items, max_pending ):
+            pending[ executor.submit(func, item) ] = item
+        while pending:
+            done, _ = concurrent.futures.wait( pending, return_when=concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                item = pending.pop( future )
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.warning( 'batch item, ```%s```; exception, ```%s```' % (item, repr(e)) )
+                    result = e
+                for next_item in itertools.islice( items, 1 ):
+                    pending[ executor.submit(func, next_item) ] = next_item
+                yield ( item, result )
+    finally:
+        executor.shutdown( wait=True, cancel_futures=True )
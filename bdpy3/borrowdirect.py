@@ -1,25 +1,27 @@
 # -*- coding: utf-8 -*-
 
-import imp, json, logging, os, pprint, time, types
-import requests
+import importlib.machinery, importlib.util, logging, types
 from . import logger_setup
+from .logger_setup import LazyPformat
 from .auth import Authenticator
+from .deadline import Deadline
 from .request import Requester
-from .search import Searcher
+from .search import DEFAULT_FORMATS, ERROR, HELD_LOCALLY, NOT_FOUND, Searcher, classify_search_result
 
 
 log = logging.getLogger(__name__)
-logger_setup.check_logger()
 
 
 class BorrowDirect( object ):
     """ Manages high-level function calls. """
 
-    def __init__( self, settings=None, logger=None ):
+    def __init__( self, settings=None, logger=None, search_cache=None, metrics=None ):
         """
         - Allows a settings module to be passed in,
             or a settings path to be passed in,
-            or a dictionary to be passed in. """
+            or a dictionary to be passed in.
+        - `search_cache` (a cache.SearchResultCache or SqliteSearchCache) and `metrics` (a metrics.Metrics) may be passed in to share them between instances,
+            eg by tenants.TenantRegistry; otherwise they are built from the settings. """
         ## general initialization
         self.API_URL_ROOT = None
         self.API_KEY = None
@@ -28,71 +30,254 @@ class BorrowDirect( object ):
         self.PICKUP_LOCATION = None
         self.LOG_PATH = None
         self.LOG_LEVEL = None
+        ## (other settings and their defaults: BorrowDirectHelper.SETTINGS_DEFAULTS)
         ## setup
         bdh = BorrowDirectHelper()
         normalized_settings = bdh.normalize_settings( settings )
         bdh.update_properties( self, normalized_settings )
         bdh.setup_log( self, logger )
+        self.auth_cache = bdh.make_auth_cache( self )
+        self.rate_limiter = bdh.make_rate_limiter( self )
+        self.metrics = metrics if metrics is not None else bdh.make_metrics( self )
+        self.session = bdh.make_session( self )
+        self.search_cache = search_cache if search_cache is not None else bdh.make_search_cache( self )
+        self.search_flights = bdh.make_search_flights( self )
+        self.auth_keepalive = bdh.make_auth_keepalive( self )
         ## updated by workflow
         self.AId = None
         self.authnz_valid = None
         self.search_result = None
         self.request_result = None
 
+    ## stateless calls; each returns its result and leaves the instance untouched, so one instance can be shared by many threads
+
+    def auth_nz( self, patron_barcode ):
+        """ Runs authN/Z; returns ( authorization_id, authnz_valid ).
+            Called by run_auth_nz(), or manually. """
+        deadline = self.new_deadline()  # auth is the whole operation here, so it gets the whole budget
+        authr = Authenticator( session=self.session, timeout=self.http_timeout() )
+        authorization_id = authr.authenticate(
+            patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, deadline )
+        if self.auth_cache:
+            self.auth_cache.set( self.auth_cache.make_key(self.API_URL_ROOT, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, patron_barcode), authorization_id )
+        authnz_valid = authr.authorize(
+            self.API_URL_ROOT, authorization_id, deadline )
+        return ( authorization_id, authnz_valid )
+
+    def search_exact_item( self, patron_barcode, search_type, search_value ):
+        """ Searches for exact key-value; returns the search result.
+            search_value may also be a list of identifiers for the same work, eg `[ '9780688002305', ('OCLC', '673595') ]`; all are sent in one call.
+            Called by run_search_exact_item(), or manually. """
+        srchr = self.make_searcher()
+        return self.format_result( srchr.search_exact_item(patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, search_type, search_value, deadline=self.new_deadline()), 'search' )
+
+    def search_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Searches for bib item; returns the search result.
+            `year` may be a single year, several (a list, set, or range), or None; `formats` a single format, several, or None -- all sent in one query.
+            Called by run_search_bib_item(), or manually. """
+        srchr = self.make_searcher()
+        return self.format_result( srchr.search_bib_item(patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, title, author, year, deadline=self.new_deadline(), formats=formats), 'search' )
+
+    def request_exact_item( self, patron_barcode, search_type, search_value ):
+        """ Runs an 'ExactSearch' request; returns the request result.
+            <https://relais.atlassian.net/wiki/spaces/ILL/pages/106608984/RequestItem#RequestItem-RequestItemrequestjson>
+            search_value may also be a list of identifiers for the same work, eg `[ '9780688002305', ('OCLC', '673595') ]`; all are sent in one call.
+            Called by run_request_exact_item(), or manually. """
+        req = self.make_requester()
+        return self.format_result( req.request_exact_item(patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, self.PICKUP_LOCATION, search_type, search_value, deadline=self.new_deadline()), 'request' )
+
+    def request_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Runs a 'BibSearch' request; returns the request result.
+            <https://relais.atlassian.net/wiki/spaces/ILL/pages/106608984/RequestItem#RequestItem-RequestItemrequestjson>
+            Called by run_request_bib_item(), or manually. """
+        log.debug( 'title, ```%s```', title )
+        req = self.make_requester()
+        return self.format_result( req.request_bib_item(patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, self.PICKUP_LOCATION, title, author, year, deadline=self.new_deadline(), formats=formats), 'request' )
+
+    def search_and_request_exact_item( self, patron_barcode, search_type, search_value ):
+        """ Searches for exact key-value, then requests it unless the search shows it held locally, not found, or errored.
+            Authenticates once; the authorization-id is reused for both calls.
+            Returns outcome dct -- see _search_then_request().
+            Called by run_search_and_request_exact_item(), or manually. """
+        return self._search_then_request(
+            patron_barcode,
+            lambda srchr, aid, deadline: srchr.search_exact_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, search_type, search_value, authorization_id=aid, deadline=deadline ),
+            lambda req, aid, deadline: req.request_exact_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, self.PICKUP_LOCATION, search_type, search_value, authorization_id=aid, deadline=deadline ) )
+
+    def search_and_request_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Searches for bib item, then requests it unless the search shows it held locally, not found, or errored.
+            Authenticates once; the authorization-id is reused for both calls.
+            Returns outcome dct -- see _search_then_request().
+            Called by run_search_and_request_bib_item(), or manually. """
+        return self._search_then_request(
+            patron_barcode,
+            lambda srchr, aid, deadline: srchr.search_bib_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, title, author, year, authorization_id=aid, deadline=deadline, formats=formats ),
+            lambda req, aid, deadline: req.request_bib_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, self.PICKUP_LOCATION, title, author, year, authorization_id=aid, deadline=deadline, formats=formats ) )
+
+    def run_search_batch( self, patron_barcode, items, max_workers=4 ):
+        """ Runs many searches concurrently; yields ( item, result_dct ) tuples as each search completes.
+            Each item is either a ( search_type, search_value ) exact-item tuple, or a ( title, author, year ) bib-item tuple, optionally followed by formats.
+            A search that raises yields the exception instance in place of the result_dct.
+            Does not set self.search_result; results are only yielded.
+            Called manually. """
+        log.debug( '\n\nstarting run_search_batch()...' )
+        if max_workers > self.HTTP_POOL_MAXSIZE:
+            log.warning( 'max_workers, `%s`, exceeds HTTP_POOL_MAXSIZE, `%s`; extra connections will not be pooled' % (max_workers, self.HTTP_POOL_MAXSIZE) )
+        def search( item ):
+            if len( item ) == 2:
+                ( search_type, search_value ) = item
+                return self.search_exact_item( patron_barcode, search_type, search_value )
+            ( title, author, year ) = item[:3]
+            return self.search_bib_item( patron_barcode, title, author, year, item[3] if len(item) > 3 else DEFAULT_FORMATS )
+        from . import batch
+        for ( item, result ) in batch.run_unordered( search, items, max_workers=max_workers ):
+            yield ( item, result )
+        log.info( 'run_search_batch() complete' )
+
+    ## legacy calls; each stores its result on the instance, so an instance used this way must not be shared between threads
+
     def run_auth_nz( self, patron_barcode ):
         """ Runs authN/Z and stores authentication-id.
             Can be called manually, but likely no need to, since run_search() and run_request_exact_item() handle auth automatically. """
         log.debug( 'starting run_auth_nz()...' )
-        authr = Authenticator()
-        self.AId = authr.authenticate(
-            patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE )
-        time.sleep( 1 )
-        self.authnz_valid = authr.authorize(
-            self.API_URL_ROOT, self.AId )
+        ( self.AId, self.authnz_valid ) = self.auth_nz( patron_barcode )
         log.info( 'run_auth_nz() complete' )
         return
 
     def run_search_exact_item( self, patron_barcode, search_type, search_value ):
-        """ Searches for exact key-value.
+        """ Searches for exact key-value; stores self.search_result.
             Called manually. """
         log.debug( '\n\nstarting run_search_exact_item()...' )
-        srchr = Searcher()
-        self.search_result = srchr.search_exact_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, search_type, search_value )
-        log.debug( 'search_result, ```%s```' % pprint.pformat(self.search_result) )
+        self.search_result = self.search_exact_item( patron_barcode, search_type, search_value )
+        log.debug( 'search_result, ```%s```', LazyPformat(self.search_result) )
         log.info( 'run_search_exact_item() complete' )
         return
 
-    def run_search_bib_item( self, patron_barcode, title, author, year ):
-        """ Searches for bib item.
+    def run_search_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Searches for bib item; stores self.search_result.
             Called manually. """
         log.debug( '\n\nstarting run_search_bib_item()...' )
-        srchr = Searcher()
-        self.search_result = srchr.search_bib_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, title, author, year )
-        log.debug( 'search_result, ```%s```' % pprint.pformat(self.search_result) )
+        self.search_result = self.search_bib_item( patron_barcode, title, author, year, formats )
+        log.debug( 'search_result, ```%s```', LazyPformat(self.search_result) )
         log.info( 'run_search_bib_item() complete' )
         return
 
     def run_request_exact_item( self, patron_barcode, search_type, search_value ):
-        """ Runs an 'ExactSearch' query.
-            <https://relais.atlassian.net/wiki/spaces/ILL/pages/106608984/RequestItem#RequestItem-RequestItemrequestjson>
+        """ Runs an 'ExactSearch' request; stores self.request_result.
             Called manually. """
         log.debug( '\n\nstarting run_exact_item_request()...' )
-        req = Requester()
-        self.request_result = req.request_exact_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, self.PICKUP_LOCATION, search_type, search_value )
+        self.request_result = self.request_exact_item( patron_barcode, search_type, search_value )
         log.info( 'run_request_exact_item() complete' )
         return
 
-    def run_request_bib_item( self, patron_barcode, title, author, year ):
-        """ Runs a 'BibSearch' query.
-            <https://relais.atlassian.net/wiki/spaces/ILL/pages/106608984/RequestItem#RequestItem-RequestItemrequestjson>
+    def run_request_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Runs a 'BibSearch' request; stores self.request_result.
             Called manually. """
         log.debug( '\n\nstarting run_bib_search_request()...' )
-        log.debug( 'title, ```%s```' % title )
-        req = Requester()
-        self.request_result = req.request_bib_item( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, self.PICKUP_LOCATION, title, author, year )
+        self.request_result = self.request_bib_item( patron_barcode, title, author, year, formats )
         log.info( 'run_request_bib_item() complete' )
         return
 
+    def run_search_and_request_exact_item( self, patron_barcode, search_type, search_value ):
+        """ Runs search_and_request_exact_item(); stores self.search_result and self.request_result (None if no request was made), and returns the outcome dct.
+            Called manually. """
+        log.debug( '\n\nstarting run_search_and_request_exact_item()...' )
+        outcome = self.search_and_request_exact_item( patron_barcode, search_type, search_value )
+        ( self.search_result, self.request_result ) = ( outcome['search_result'], outcome['request_result'] )
+        log.info( 'run_search_and_request_exact_item() complete' )
+        return outcome
+
+    def run_search_and_request_bib_item( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Runs search_and_request_bib_item(); stores self.search_result and self.request_result (None if no request was made), and returns the outcome dct.
+            Called manually. """
+        log.debug( '\n\nstarting run_search_and_request_bib_item()...' )
+        outcome = self.search_and_request_bib_item( patron_barcode, title, author, year, formats )
+        ( self.search_result, self.request_result ) = ( outcome['search_result'], outcome['request_result'] )
+        log.info( 'run_search_and_request_bib_item() complete' )
+        return outcome
+
+    def _search_then_request( self, patron_barcode, search_func, request_func ):
+        """ Runs search_func, then request_func if warranted, sharing one authorization-id.
+            Returns dct like:
+                { 'search_outcome': 'available',  # see search.classify_search_result()
+                  'requested': True,
+                  'request_number': 'BRO-12345678',  # None if no request was made, or the request produced no number
+                  'search_result': {...},
+                  'request_result': {...} }  # None if no request was made
+            Called by search_and_request_exact_item() and search_and_request_bib_item() """
+        ( srchr, req, deadline ) = ( self.make_searcher(), self.make_requester(), self.new_deadline() )  # one budget covers auth, search, and request
+        authorization_id = srchr.get_authorization_id( patron_barcode, self.API_URL_ROOT, self.API_KEY, self.PARTNERSHIP_ID, self.UNIVERSITY_CODE, deadline )
+        search_dct = search_func( srchr, authorization_id, deadline )
+        search_outcome = classify_search_result( search_dct )
+        search_result = self.format_result( search_dct, 'search' )
+        request_dct = None
+        if search_outcome in ( HELD_LOCALLY, NOT_FOUND, ERROR ):
+            log.info( 'search outcome, `%s`; not requesting', search_outcome )
+        else:
+            request_dct = request_func( req, authorization_id, deadline )
+        return {
+            'search_outcome': search_outcome,
+            'requested': request_dct is not None,
+            'request_number': request_dct.get( 'RequestNumber' ) if isinstance( request_dct, dict ) else getattr( request_dct, 'request_number', None ),
+            'search_result': search_result,
+            'request_result': self.format_result( request_dct, 'request' ) }
+
+    def format_result( self, result_dct, kind ):
+        """ Returns result_dct trimmed of RESULT_DROP_FIELDS, as a dct or -- with RESULT_FORMAT 'object' -- a results.SearchResult/RequestResult.
+            Called by the search_* and request_* methods. """
+        from .results import format_result
+        return format_result( result_dct, kind, self.RESULT_FORMAT, self.RESULT_DROP_FIELDS, self.RESULT_KEEP_RAW )
+
+    def make_searcher( self ):
+        """ Returns a Searcher sharing this instance's session, caches, and in-flight searches.
+            With RESULT_FORMAT 'object' and no search-cache, which holds dcts, results are built straight from the response bytes.
+            Called by the search_* methods. """
+        return Searcher(
+            auth_cache=self.auth_cache, session=self.session, result_cache=self.search_cache, timeout=self.http_timeout(), flights=self.search_flights,
+            result_parser=None if self.search_cache else self.make_result_parser('search') )
+
+    def make_requester( self ):
+        """ Returns a Requester sharing this instance's session and auth-cache.
+            With RESULT_FORMAT 'object', results are built straight from the response bytes.
+            Called by the request_* methods. """
+        return Requester( auth_cache=self.auth_cache, session=self.session, timeout=self.http_timeout(), result_parser=self.make_result_parser('request') )
+
+    def make_result_parser( self, kind ):
+        """ Returns a callable building a results.SearchResult/RequestResult from response bytes if RESULT_FORMAT is 'object', otherwise None.
+            Called by make_searcher() and make_requester() """
+        if self.RESULT_FORMAT != 'object':
+            return None
+        from .results import RequestResult, SearchResult
+        result_class = SearchResult if kind == 'search' else RequestResult
+        return lambda content: result_class.from_bytes( content, keep_raw=self.RESULT_KEEP_RAW, drop=self.RESULT_DROP_FIELDS )
+
+    def http_timeout( self ):
+        """ Returns the per-call ( connect, read ) timeout tuple.
+            Called by auth_nz(), make_searcher(), and make_requester() """
+        return ( self.HTTP_CONNECT_TIMEOUT, self.HTTP_READ_TIMEOUT )
+
+    def new_deadline( self ):
+        """ Returns a fresh Deadline of DEADLINE_SECONDS for one operation, or None if no deadline is set.
+            Called by auth_nz() and the search_* and request_* methods. """
+        if not self.DEADLINE_SECONDS:
+            return None
+        return Deadline( self.DEADLINE_SECONDS, self.DEADLINE_AUTH_SHARE )
+
+    def close( self ):
+        """ Stops any keep-alive thread, and closes pooled connections.
+            Called manually, or on leaving a `with BorrowDirect(...) as bd:` block. """
+        if self.auth_keepalive:
+            self.auth_keepalive.stop()
+        self.session.close()
+        return
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
     ## end class BorrowDirect
 
 
@@ -100,45 +285,188 @@ class BorrowDirectHelper( object ):
     """ Assists BorrowDirect setup.
         Called by BorrowDirect.__init__() """
 
+    SETTINGS_DEFAULTS = (  # ( name, default ); every setting becomes an instance-attribute
+        ( 'API_URL_ROOT', None ),
+        ( 'API_KEY', None ),
+        ( 'PARTNERSHIP_ID', None ),
+        ( 'UNIVERSITY_CODE', None ),
+        ( 'PICKUP_LOCATION', None ),
+        ( 'LOG_PATH', None ),
+        ( 'LOG_LEVEL', None ),  # None keeps the default log config's level; see logger_setup.check_logger()
+        ( 'AUTH_CACHE_TTL', None ),
+        ( 'AUTH_CACHE_MAX_ENTRIES', 1000 ),
+        ( 'AUTH_CACHE_PATH', None ),
+        ( 'AUTH_KEEPALIVE', False ),
+        ( 'AUTH_KEEPALIVE_MARGIN', 60 ),
+        ( 'AUTH_KEEPALIVE_IDLE', 1800 ),
+        ( 'HTTP_POOL_CONNECTIONS', 10 ),
+        ( 'HTTP_POOL_MAXSIZE', 10 ),
+        ( 'HTTP_POOL_BLOCK', False ),
+        ( 'HTTP_MAX_RETRIES', 0 ),
+        ( 'HTTP_KEEP_ALIVE', True ),
+        ( 'HTTP_TCP_KEEPALIVE', False ),
+        ( 'HTTP_CASSETTE_PATH', None ),
+        ( 'HTTP_CASSETTE_MODE', 'replay' ),
+        ( 'HTTP_CASSETTE_LATENCY', 0.0 ),
+        ( 'HTTP_CONNECT_TIMEOUT', 10 ),
+        ( 'HTTP_READ_TIMEOUT', 90 ),
+        ( 'DEADLINE_SECONDS', None ),
+        ( 'DEADLINE_AUTH_SHARE', 0.5 ),
+        ( 'ASYNC_CONNECTION_LIMIT', 100 ),
+        ( 'SEARCH_CACHE_MAX_ENTRIES', None ),
+        ( 'SEARCH_CACHE_TTL_AVAILABLE', 300 ),
+        ( 'SEARCH_CACHE_TTL_UNAVAILABLE', 900 ),
+        ( 'SEARCH_CACHE_TTL_NOT_FOUND', 3600 ),
+        ( 'SEARCH_CACHE_PATH', None ),
+        ( 'SEARCH_CACHE_MEMORY_ENTRIES', 1000 ),
+        ( 'SEARCH_CACHE_WARM_START', 0 ),
+        ( 'SEARCH_SINGLE_FLIGHT', False ),
+        ( 'RATE_LIMIT_PER_SECOND', None ),
+        ( 'RATE_LIMIT_BURST', 1 ),
+        ( 'RATE_LIMIT_PATH', None ),
+        ( 'METRICS_ENABLED', False ),
+        ( 'METRICS_SINK', None ),
+        ( 'LOG_QUEUE', False ),
+        ( 'RESULT_FORMAT', 'dict' ),
+        ( 'RESULT_DROP_FIELDS', () ),
+        ( 'RESULT_KEEP_RAW', False ),
+        )
+
     def normalize_settings( self, settings ):
-        """ Returns a settings module regardless whether settings are passed in as a module or dict or settings-path.
+        """ Returns a dct of the upper-case settings, regardless whether settings are passed in as a module or dict or settings-path.
             Called by BorrowDirect.__init__() """
-        log.debug( 'type(settings), ```%s```' % type(settings) )
+        log.debug( 'type(settings), ```%s```', type(settings) )
         assert ( isinstance(settings, dict) or isinstance(settings, str) or isinstance(settings, types.ModuleType) or settings == None  ), Exception( 'Passing in settings is optional, but if used, must be either a dict, a path to a settings module, or a module named settings; current type is: %s' % type(settings) )
+        if settings is None:
+            return {}
         if isinstance( settings, dict ):
-            s = imp.new_module( 'settings' )
-            for k, v in settings.items():
-                setattr( s, k, v )
-            settings = s
-        elif isinstance( settings, str ):  # path
-              settings = imp.load_source( '*', settings )
-        return settings
+            return dict( settings )
+        if isinstance( settings, str ):  # path
+            settings = self.load_settings_path( settings )
+        return { k: v for k, v in vars( settings ).items() if k.isupper() }
+
+    def load_settings_path( self, path ):
+        """ Executes the settings file at `path`, whatever its extension, and returns it as a module.
+            Called by normalize_settings() """
+        loader = importlib.machinery.SourceFileLoader( 'bdpy3_settings', path )
+        module = importlib.util.module_from_spec( importlib.util.spec_from_loader(loader.name, loader) )
+        loader.exec_module( module )
+        return module
 
     def update_properties( self, bd_instance, settings ):
-        """ Sets main properties.
+        """ Sets main properties from the normalized settings dct, falling back to SETTINGS_DEFAULTS.
             Called by BorrowDirect.__init__() """
-        bd_instance.API_URL_ROOT = None if ( 'API_URL_ROOT' not in dir(settings) ) else settings.API_URL_ROOT
-        bd_instance.API_KEY = None if ( 'API_KEY' not in dir(settings) ) else settings.API_KEY
-        bd_instance.PARTNERSHIP_ID = None if ( 'PARTNERSHIP_ID' not in dir(settings) ) else settings.PARTNERSHIP_ID
-        bd_instance.UNIVERSITY_CODE = None if ( 'UNIVERSITY_CODE' not in dir(settings) ) else settings.UNIVERSITY_CODE
-        bd_instance.PICKUP_LOCATION = None if ( 'PICKUP_LOCATION' not in dir(settings) ) else settings.PICKUP_LOCATION
-        bd_instance.LOG_PATH = None if ( 'LOG_PATH' not in dir(settings) ) else settings.LOG_PATH
-        bd_instance.LOG_LEVEL = 'DEBUG' if ( 'LOG_LEVEL' not in dir(settings) ) else settings.LOG_LEVEL
+        for ( name, default ) in self.SETTINGS_DEFAULTS:
+            setattr( bd_instance, name, settings.get(name, default) )
         return
 
+    def make_auth_cache( self, bd_instance ):
+        """ Returns an AuthIdCache if AUTH_CACHE_TTL (seconds) is set, otherwise None, so every call re-authenticates.
+            Called by BorrowDirect.__init__() """
+        if not bd_instance.AUTH_CACHE_TTL:
+            return None
+        from .cache import AuthIdCache
+        return AuthIdCache(
+            ttl=bd_instance.AUTH_CACHE_TTL, max_entries=bd_instance.AUTH_CACHE_MAX_ENTRIES, path=bd_instance.AUTH_CACHE_PATH )
+
+    def make_auth_keepalive( self, bd_instance ):
+        """ Returns a started AuthKeepAlive if AUTH_KEEPALIVE is set, otherwise None; it needs the auth-cache, so AUTH_CACHE_TTL must be set too.
+            Called by BorrowDirect.__init__() """
+        if not bd_instance.AUTH_KEEPALIVE:
+            return None
+        if not bd_instance.auth_cache:
+            log.warning( 'AUTH_KEEPALIVE needs AUTH_CACHE_TTL set; not keeping authorization-ids alive' )
+            return None
+        from .keepalive import AuthKeepAlive
+        return AuthKeepAlive(
+            bd_instance.auth_cache, session=bd_instance.session, timeout=bd_instance.http_timeout(),
+            refresh_margin=bd_instance.AUTH_KEEPALIVE_MARGIN, idle_timeout=bd_instance.AUTH_KEEPALIVE_IDLE ).start()
+
+    def make_search_cache( self, bd_instance ):
+        """ Returns a SearchResultCache if SEARCH_CACHE_MAX_ENTRIES is set, otherwise None, so every search calls the webservice.
+            With SEARCH_CACHE_PATH, returns a SqliteSearchCache in that file instead, shared by every process using the same path.
+            Called by BorrowDirect.__init__() """
+        if bd_instance.SEARCH_CACHE_PATH:
+            from .cache import SqliteSearchCache
+            return SqliteSearchCache(
+                bd_instance.SEARCH_CACHE_PATH,
+                max_entries=bd_instance.SEARCH_CACHE_MAX_ENTRIES or 10000,
+                ttl_available=bd_instance.SEARCH_CACHE_TTL_AVAILABLE,
+                ttl_unavailable=bd_instance.SEARCH_CACHE_TTL_UNAVAILABLE,
+                ttl_not_found=bd_instance.SEARCH_CACHE_TTL_NOT_FOUND,
+                memory_entries=bd_instance.SEARCH_CACHE_MEMORY_ENTRIES,
+                warm_start=bd_instance.SEARCH_CACHE_WARM_START )
+        if not bd_instance.SEARCH_CACHE_MAX_ENTRIES:
+            return None
+        from .cache import SearchResultCache
+        return SearchResultCache(
+            max_entries=bd_instance.SEARCH_CACHE_MAX_ENTRIES,
+            ttl_available=bd_instance.SEARCH_CACHE_TTL_AVAILABLE,
+            ttl_unavailable=bd_instance.SEARCH_CACHE_TTL_UNAVAILABLE,
+            ttl_not_found=bd_instance.SEARCH_CACHE_TTL_NOT_FOUND )
+
+    def make_search_flights( self, bd_instance ):
+        """ Returns a SingleFlight if SEARCH_SINGLE_FLIGHT is set, otherwise None (the default), so identical concurrent searches each call the webservice.
+            Called by BorrowDirect.__init__() """
+        if not bd_instance.SEARCH_SINGLE_FLIGHT:
+            return None
+        from .singleflight import SingleFlight
+        return SingleFlight( 'search' )
+
+    def make_rate_limiter( self, bd_instance ):
+        """ Returns a TokenBucket if RATE_LIMIT_PER_SECOND is set, otherwise None, so calls are not throttled.
+            With RATE_LIMIT_PATH, the bucket's state is kept in that file and shared by every process using the same path.
+            Called by BorrowDirect.__init__() """
+        if not bd_instance.RATE_LIMIT_PER_SECOND:
+            return None
+        from .ratelimit import FileTokenBucket, TokenBucket
+        if bd_instance.RATE_LIMIT_PATH:
+            return FileTokenBucket( bd_instance.RATE_LIMIT_PER_SECOND, bd_instance.RATE_LIMIT_BURST, path=bd_instance.RATE_LIMIT_PATH )
+        return TokenBucket( bd_instance.RATE_LIMIT_PER_SECOND, bd_instance.RATE_LIMIT_BURST )
+
+    def make_metrics( self, bd_instance ):
+        """ Returns a Metrics collector if METRICS_ENABLED (or a METRICS_SINK callable) is set, otherwise None.
+            Called by BorrowDirect.__init__() """
+        if not ( bd_instance.METRICS_ENABLED or bd_instance.METRICS_SINK ):
+            return None
+        from .metrics import Metrics
+        metrics = Metrics()
+        if bd_instance.METRICS_SINK:
+            metrics.add_sink( bd_instance.METRICS_SINK )
+        return metrics
+
+    def make_session( self, bd_instance ):
+        """ Returns the pooled, keep-alive session shared by this instance's Authenticator, Searcher, and Requester calls.
+            `requests` is first imported here, rather than on `import bdpy3`.
+            With HTTP_CASSETTE_PATH, or else the BDPY3_CASSETTE_PATH environment-variable, calls are recorded to, or replayed from, that cassette file.
+            Called by BorrowDirect.__init__() """
+        from .cassette import environment_cassette, open_cassette
+        from .session import BorrowDirectSession
+        if bd_instance.HTTP_CASSETTE_PATH:
+            cassette = open_cassette( bd_instance.HTTP_CASSETTE_PATH, mode=bd_instance.HTTP_CASSETTE_MODE, latency_scale=bd_instance.HTTP_CASSETTE_LATENCY )
+        else:
+            cassette = environment_cassette()
+        return BorrowDirectSession(
+            pool_connections=bd_instance.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=bd_instance.HTTP_POOL_MAXSIZE,
+            pool_block=bd_instance.HTTP_POOL_BLOCK,
+            max_retries=bd_instance.HTTP_MAX_RETRIES,
+            keep_alive=bd_instance.HTTP_KEEP_ALIVE,
+            tcp_keepalive=bd_instance.HTTP_TCP_KEEPALIVE,
+            rate_limiter=bd_instance.rate_limiter,
+            metrics=bd_instance.metrics,
+            cassette=cassette )
+
     def setup_log( self, bd_instance, logger ):
         """ Configures log path and level.
             Called by BorrowDirect.__init__() """
         if logger:
             bd_instance.logger = logger
         else:
-            log_level = {
-                'DEBUG': logging.DEBUG, 'INFO': logging.INFO, }
-            logging.basicConfig(
-                filename=bd_instance.LOG_PATH, level=log_level[bd_instance.LOG_LEVEL],
-                format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
-                datefmt='%d/%b/%Y %H:%M:%S' )
+            logger_setup.configure_default_logging( bd_instance.LOG_PATH, bd_instance.LOG_LEVEL )
             bd_instance.logger = logging.getLogger(__name__)
+        if bd_instance.LOG_QUEUE:
+            logger_setup.enable_queue_logging()
         return
 
     ## end class BorrowDirectHelper
@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+
+""" Caches used to cut round-trips to the BorrowDirect webservices. """
+
+import collections, copy, json, logging, os, re, sqlite3, threading, time
+from .search import AVAILABLE, DEFAULT_FORMATS, HELD_LOCALLY, NOT_FOUND, UNAVAILABLE, bib_formats, bib_years, classify_search_result, exact_search_pairs
+
+try:
+    import fcntl
+except ImportError:  # non-posix; file-store locking then falls back to the in-process lock only
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+
+class AuthIdCache( object ):
+    """ Holds authorization-ids per (api_url_root, partnership_id, university_code, patron_barcode) for `ttl` seconds.
+        Least-recently-used entries are evicted beyond `max_entries`.
+        If `path` is given, entries are also written to an AuthIdFileStore so several worker-processes can share them.
+        If a `keepalive` (keepalive.AuthKeepAlive) is attached, each get-hit and set is reported to it as a use of that authorization-id.
+        Called by BorrowDirect.__init__(); used by Searcher.get_authorization_id() and Requester.get_authorization_id() """
+
+    def __init__( self, ttl=600, max_entries=1000, path=None ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = AuthIdFileStore( path ) if path else None
+        self.entries = collections.OrderedDict()  # key -> ( authorization_id, expires_at )
+        self.lock = threading.Lock()
+        self.keepalive = None  # optional keepalive.AuthKeepAlive
+
+    def make_key( self, api_url_root, partnership_id, university_code, patron_barcode ):
+        """ Returns cache key.
+            Called by Searcher.get_authorization_id() and Requester.get_authorization_id() """
+        return ( api_url_root, partnership_id, university_code, patron_barcode )
+
+    def get( self, key ):
+        """ Returns unexpired authorization-id, or None.
+            Called by Searcher.get_authorization_id() and Requester.get_authorization_id() """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry and entry[1] > now:
+                self.entries.move_to_end( key )
+            elif entry:
+                del self.entries[key]
+                entry = None
+        if not entry and self.store:
+            entry = self.store.get( key, now )
+            if entry:
+                with self.lock:
+                    self._put( key, entry[0], entry[1] )
+        if not entry:
+            return None
+        if self.keepalive:
+            self.keepalive.touch( key )
+        return entry[0]
+
+    def set( self, key, authorization_id ):
+        """ Stores authorization-id.
+            Called by Searcher.get_authorization_id(), Requester.get_authorization_id(), and BorrowDirect.auth_nz() """
+        self.extend( key, authorization_id )
+        if self.keepalive:
+            self.keepalive.touch( key )
+        return
+
+    def extend( self, key, authorization_id ):
+        """ Stores authorization-id for another `ttl` seconds, without counting as a use.
+            Called by set(), and by AuthKeepAlive.refresh() after the server extends the authorization-id's session. """
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._put( key, authorization_id, expires_at )
+        if self.store:
+            self.store.set( key, authorization_id, expires_at, self.max_entries )
+        return
+
+    def peek( self, key ):
+        """ Returns unexpired ( authorization_id, expires_at ) from memory, or None; does not count as a use, nor as recently-used.
+            Called by AuthKeepAlive.refresh() """
+        with self.lock:
+            entry = self.entries.get( key )
+        if entry and entry[1] > time.time():
+            return entry
+        return None
+
+    def invalidate( self, key ):
+        """ Drops entry, eg after the server rejects an expired authorization-id.
+            Called by Searcher.invalidate_authorization_id() and Requester.invalidate_authorization_id() """
+        with self.lock:
+            self.entries.pop( key, None )
+        if self.store:
+            self.store.delete( key )
+        log.debug( 'invalidated authorization-id for key, ```%s```', key )
+        return
+
+    def _put( self, key, authorization_id, expires_at ):
+        """ Stores entry and evicts least-recently-used entries; caller holds lock.
+            Called by get() and set() """
+        self.entries[key] = ( authorization_id, expires_at )
+        self.entries.move_to_end( key )
+        while len( self.entries ) > self.max_entries:
+            self.entries.popitem( last=False )
+        return
+
+    ## end class AuthIdCache
+
+
+class AuthIdFileStore( object ):
+    """ Json-file store of authorization-ids, shared across processes via an exclusive file-lock.
+        Called by AuthIdCache() """
+
+    def __init__( self, path ):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def get( self, key, now ):
+        """ Returns unexpired ( authorization_id, expires_at ), or None.
+            Called by AuthIdCache.get() """
+        entry = self._transact( lambda data: data.get(self._key(key)), write=False )
+        if entry and entry[1] > now:
+            return ( entry[0], entry[1] )
+        return None
+
+    def set( self, key, authorization_id, expires_at, max_entries ):
+        """ Stores entry, purging expired and oldest entries.
+            Called by AuthIdCache.set() """
+        def update( data ):
+            now = time.time()
+            for k in [ k for k, v in data.items() if v[1] <= now ]:
+                del data[k]
+            data[ self._key(key) ] = [ authorization_id, expires_at ]
+            for k in sorted( data, key=lambda k: data[k][1] )[ :max(0, len(data) - max_entries) ]:
+                del data[k]
+        self._transact( update, write=True )
+        return
+
+    def delete( self, key ):
+        """ Removes entry.
+            Called by AuthIdCache.invalidate() """
+        self._transact( lambda data: data.pop(self._key(key), None), write=True )
+        return
+
+    def _key( self, key ):
+        """ Returns json-friendly key.
+            Called by get(), set(), and delete() """
+        return '|'.join( [ str(part) for part in key ] )
+
+    def _transact( self, func, write ):
+        """ Runs func on the loaded data under the file-lock, saving the data if `write`.
+            Called by get(), set(), and delete() """
+        with self.lock:
+            with open( self.path, 'a+' ) as f:
+                if fcntl:
+                    fcntl.flock( f, fcntl.LOCK_EX if write else fcntl.LOCK_SH )
+                try:
+                    f.seek( 0 )
+                    content = f.read()
+                    try:
+                        data = json.loads( content ) if content else {}
+                    except ValueError:
+                        log.warning( 'unreadable auth-cache file, ```%s```; starting fresh' % self.path )
+                        data = {}
+                    result = func( data )
+                    if write:
+                        f.seek( 0 )
+                        f.truncate()
+                        f.write( json.dumps(data) )
+                        f.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock( f, fcntl.LOCK_UN )
+        return result
+
+    ## end class AuthIdFileStore
+
+
+class SearchResultCache( object ):
+    """ Holds search results per (partnership_id, university_code, search_type, normalized search_value).
+        Each outcome gets its own ttl, so eg 'No result' (PUBFI002) answers can be kept longer than availability answers.
+        Error responses are never stored; neither are request responses -- only Searcher uses this cache.
+        Least-recently-used entries are evicted beyond `max_entries`; `hits` and `misses` count lookups.
+        Called by BorrowDirect.__init__(); used by Searcher.search_exact_item() and Searcher.search_bib_item() """
+
+    def __init__( self, max_entries=1000, ttl_available=300, ttl_unavailable=900, ttl_not_found=3600 ):
+        self.max_entries = max_entries
+        self.ttls = {
+            AVAILABLE: ttl_available, UNAVAILABLE: ttl_unavailable, HELD_LOCALLY: ttl_unavailable, NOT_FOUND: ttl_not_found }
+        self.entries = collections.OrderedDict()  # key -> ( result_dct, expires_at )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_exact_key( self, partnership_id, university_code, search_type, search_value ):
+        """ Returns cache key for an exact-item search; see exact_search_key().
+            Called by Searcher.search_exact_item() """
+        return exact_search_key( partnership_id, university_code, search_type, search_value )
+
+    def make_bib_key( self, partnership_id, university_code, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Returns cache key for a bib-item search; see bib_search_key().
+            Called manually. """
+        return bib_search_key( partnership_id, university_code, title, author, year, formats )
+
+    def get( self, key ):
+        """ Returns a copy of the unexpired result_dct, or None.
+            Called by Searcher.search_exact_item() and Searcher.search_bib_item() """
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry and entry[1] > time.time():
+                self.entries.move_to_end( key )
+                self.hits += 1
+                return copy.deepcopy( entry[0] )
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+        return None
+
+    def set( self, key, result_dct ):
+        """ Stores a copy of result_dct if its outcome has a positive ttl.
+            Called by Searcher.search_exact_item() and Searcher.search_bib_item() """
+        ttl = self.ttls.get( classify_search_result(result_dct) )
+        if not ttl or ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = ( copy.deepcopy(result_dct), time.time() + ttl )
+            self.entries.move_to_end( key )
+            while len( self.entries ) > self.max_entries:
+                self.entries.popitem( last=False )
+        return
+
+    def clear( self ):
+        """ Drops all entries.
+            Called manually. """
+        with self.lock:
+            self.entries.clear()
+        return
+
+    def stats( self ):
+        """ Returns counters dct.
+            Called manually. """
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries) }
+
+    ## end class SearchResultCache
+
+
+class SqliteSearchCache( object ):
+    """ As SearchResultCache, but kept in a SQLite file shared by every process on the host using the same `path` -- eg gunicorn and cron workers --
+          so a search one process made answers the others'.
+        Each outcome gets its own ttl; least-recently-used rows are evicted beyond `max_entries`, and expired rows on each write.
+        Up to `memory_entries` recently-used results are also held in memory, for at most their remaining ttl, so hot keys skip the file;
+          `warm_start` preloads that many of the most-hit unexpired keys, so a freshly started worker gets hits at once.
+        Hit counts and last-use times are buffered in memory and written every `flush_interval` seconds, and on close().
+        A database error is logged and treated as a miss, or as a skipped store -- the cache never fails a search.
+        `hits`, `memory_hits`, and `misses` count this process's lookups.
+        Called by BorrowDirectHelper.make_search_cache() when SEARCH_CACHE_PATH is set, or manually; used by Searcher.search_exact_item() and Searcher.search_bib_item() """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS search_results ( key TEXT PRIMARY KEY, result TEXT NOT NULL, outcome TEXT NOT NULL, '
+        'expires_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, last_used REAL NOT NULL )',
+        'CREATE INDEX IF NOT EXISTS search_results_last_used ON search_results ( last_used )',
+        'CREATE INDEX IF NOT EXISTS search_results_hits ON search_results ( hits )',
+        )
+
+    def __init__( self, path, max_entries=10000, ttl_available=300, ttl_unavailable=900, ttl_not_found=3600, memory_entries=1000, warm_start=0, timeout=5.0, flush_interval=5.0 ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = {
+            AVAILABLE: ttl_available, UNAVAILABLE: ttl_unavailable, HELD_LOCALLY: ttl_unavailable, NOT_FOUND: ttl_not_found }
+        self.memory_entries = memory_entries
+        self.timeout = timeout  # seconds to wait on another process's write-lock
+        self.flush_interval = flush_interval
+        self.memory = collections.OrderedDict()  # db-key -> ( result_dct, expires_at )
+        self.pending_hits = {}  # db-key -> [ hits, last_used ], not yet written
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None  # a connection is not carried across a fork; each process opens its own
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.warmed = self.warm( warm_start ) if warm_start else 0
+
+    def make_exact_key( self, partnership_id, university_code, search_type, search_value ):
+        """ Returns cache key for an exact-item search; see exact_search_key().
+            Called by Searcher.search_exact_item() """
+        return exact_search_key( partnership_id, university_code, search_type, search_value )
+
+    def make_bib_key( self, partnership_id, university_code, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Returns cache key for a bib-item search; see bib_search_key().
+            Called manually. """
+        return bib_search_key( partnership_id, university_code, title, author, year, formats )
+
+    def get( self, key ):
+        """ Returns a copy of the unexpired result_dct, from memory or the file, or None.
+            Called by Searcher.search_exact_item() and Searcher.search_bib_item() """
+        db_key = self._db_key( key )
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get( db_key )
+            if entry and entry[1] > now:
+                self.memory.move_to_end( db_key )
+                self.memory_hits += 1
+            else:
+                if entry:
+                    del self.memory[db_key]
+                entry = self._read( db_key, now )
+                if entry:
+                    self._remember( db_key, entry[0], entry[1] )
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._note_use( db_key, now )
+            result_dct = copy.deepcopy( entry[0] )
+        return result_dct
+
+    def set( self, key, result_dct ):
+        """ Stores result_dct if its outcome has a positive ttl; purges expired rows and evicts beyond `max_entries`.
+            Called by Searcher.search_exact_item() and Searcher.search_bib_item() """
+        outcome = classify_search_result( result_dct )
+        ttl = self.ttls.get( outcome )
+        if not ttl or ttl <= 0:
+            return
+        db_key = self._db_key( key )
+        now = time.time()
+        with self.lock:
+            self._remember( db_key, copy.deepcopy(result_dct), now + ttl )
+            self._write( lambda connection: self._upsert(connection, db_key, json.dumps(result_dct), outcome, now + ttl, now) )
+        return
+
+    def warm( self, count ):
+        """ Loads up to `count` of the most-hit unexpired results into memory; returns the number loaded.
+            Called by __init__() when `warm_start` is set, or manually. """
+        count = min( count, self.memory_entries )
+        with self.lock:
+            try:
+                rows = self._connect().execute(
+                    'SELECT key, result, expires_at FROM search_results WHERE expires_at > ? ORDER BY hits DESC, last_used DESC LIMIT ?', (time.time(), count) ).fetchall()
+            except sqlite3.Error as e:
+                log.warning( 'search-cache warm-start failed, `%r`', e )
+                return 0
+            for ( db_key, result, expires_at ) in reversed( rows ):  # hottest last, so most-recently-used
+                self._remember( db_key, json.loads(result), expires_at )
+        log.debug( 'warmed search-cache with `%s` results', len(rows) )
+        return len( rows )
+
+    def clear( self ):
+        """ Drops all entries, from the file and from this process's memory; other processes' memory keeps theirs until their ttls end.
+            Called manually. """
+        with self.lock:
+            self.memory.clear()
+            self.pending_hits.clear()
+            self._write( lambda connection: connection.execute('DELETE FROM search_results') )
+        return
+
+    def stats( self ):
+        """ Returns counters dct; `entries` counts unexpired rows in the file, across processes.
+            Called manually. """
+        with self.lock:
+            try:
+                entries = self._connect().execute( 'SELECT COUNT(*) FROM search_results WHERE expires_at > ?', (time.time(),) ).fetchone()[0]
+            except sqlite3.Error as e:
+                log.warning( 'search-cache stats failed, `%r`', e )
+                entries = None
+            return { 'hits': self.hits, 'memory_hits': self.memory_hits, 'misses': self.misses, 'entries': entries, 'memory_entries': len(self.memory), 'warmed': self.warmed }
+
+    def close( self ):
+        """ Writes buffered hit counts, and closes the file; a later call reopens it.
+            Called manually. """
+        with self.lock:
+            if self.pending_hits:
+                self._write( lambda connection: None )
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
+        return
+
+    def _connect( self ):
+        """ Returns this process's connection, opening it and creating the table if need be; caller holds lock.
+            Called by get(), set(), warm(), stats(), and _write() """
+        if self.connection is None or self.pid != os.getpid():
+            connection = sqlite3.connect( self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False )
+            connection.execute( 'PRAGMA journal_mode=WAL' )  # readers do not wait on a writer
+            connection.execute( 'PRAGMA synchronous=NORMAL' )
+            for statement in self.SCHEMA:
+                connection.execute( statement )
+            ( self.connection, self.pid ) = ( connection, os.getpid() )
+        return self.connection
+
+    def _read( self, db_key, now ):
+        """ Returns unexpired ( result_dct, expires_at ) from the file, or None; caller holds lock.
+            Called by get() """
+        try:
+            row = self._connect().execute( 'SELECT result, expires_at FROM search_results WHERE key = ? AND expires_at > ?', (db_key, now) ).fetchone()
+        except sqlite3.Error as e:
+            log.warning( 'search-cache read failed, `%r`', e )
+            return None
+        if row is None:
+            return None
+        return ( json.loads(row[0]), row[1] )
+
+    def _write( self, func ):
+        """ Runs func in a write-transaction, together with any buffered hit counts; caller holds lock.
+            Called by set(), clear(), close(), and _note_use() """
+        try:
+            connection = self._connect()
+            connection.execute( 'BEGIN IMMEDIATE' )
+            try:
+                func( connection )
+                if self.pending_hits:
+                    connection.executemany(
+                        'UPDATE search_results SET hits = hits + ?, last_used = MAX(last_used, ?) WHERE key = ?',
+                        [ (hits, last_used, db_key) for ( db_key, (hits, last_used) ) in self.pending_hits.items() ] )
+                connection.execute( 'COMMIT' )
+            except BaseException:
+                connection.execute( 'ROLLBACK' )
+                raise
+        except sqlite3.Error as e:
+            log.warning( 'search-cache write failed, `%r`', e )
+            return False
+        self.pending_hits.clear()
+        self.last_flush = time.time()
+        return True
+
+    def _upsert( self, connection, db_key, result, outcome, expires_at, now ):
+        """ Stores row, keeping its hit count, then purges expired rows and evicts least-recently-used beyond `max_entries`.
+            Called by set() """
+        connection.execute(
+            'INSERT INTO search_results ( key, result, outcome, expires_at, hits, last_used ) VALUES ( ?, ?, ?, ?, 0, ? ) '
+            'ON CONFLICT ( key ) DO UPDATE SET result = excluded.result, outcome = excluded.outcome, expires_at = excluded.expires_at, last_used = excluded.last_used',
+            (db_key, result, outcome, expires_at, now) )
+        connection.execute( 'DELETE FROM search_results WHERE expires_at <= ?', (now,) )
+        excess = connection.execute( 'SELECT COUNT(*) FROM search_results' ).fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute( 'DELETE FROM search_results WHERE key IN ( SELECT key FROM search_results ORDER BY last_used LIMIT ? )', (excess,) )
+        return
+
+    def _remember( self, db_key, result_dct, expires_at ):
+        """ Holds result in memory, evicting least-recently-used beyond `memory_entries`; caller holds lock.
+            Called by get(), set(), and warm() """
+        if not self.memory_entries:
+            return
+        self.memory[db_key] = ( result_dct, expires_at )
+        self.memory.move_to_end( db_key )
+        while len( self.memory ) > self.memory_entries:
+            self.memory.popitem( last=False )
+        return
+
+    def _note_use( self, db_key, now ):
+        """ Buffers a hit, writing the buffer once `flush_interval` has passed; caller holds lock.
+            Called by get() """
+        pending = self.pending_hits.setdefault( db_key, [0, now] )
+        pending[0] += 1
+        pending[1] = now
+        if now - self.last_flush >= self.flush_interval:
+            self._write( lambda connection: None )
+        return
+
+    def _db_key( self, key ):
+        """ Returns text form of a cache key; json keeps the nested tuples, and None, distinct.
+            Called by get() and set() """
+        return json.dumps( key, separators=(',', ':') )
+
+    ## end class SqliteSearchCache
+
+
+def exact_search_key( partnership_id, university_code, search_type, search_value ):
+    """ Returns key identifying an exact-item search; several identifiers share a key regardless of their order.
+        Called by SearchResultCache.make_exact_key(), Searcher.search_exact_item(), and AsyncBorrowDirect.run_search_exact_item() """
+    if not isinstance( search_value, (list, tuple) ):
+        return ( partnership_id, university_code, search_type, normalize_search_value(search_type, search_value) )
+    pairs = sorted( set( (item_type, normalize_search_value(item_type, item_value)) for (item_type, item_value) in exact_search_pairs(search_type, search_value) ) )
+    return ( partnership_id, university_code, 'MULTI', tuple(pairs) )
+
+
+def bib_search_key( partnership_id, university_code, title, author, year, formats=DEFAULT_FORMATS ):
+    """ Returns key identifying a bib-item search; years and formats are keyed regardless of their order.
+        Called by SearchResultCache.make_bib_key(), Searcher.search_bib_item(), and AsyncBorrowDirect.run_search_bib_item() """
+    authors = tuple( normalize_search_value('PHRASE', a) for a in author ) if isinstance( author, (list, tuple) ) else normalize_search_value( 'PHRASE', author )
+    ( years, formats ) = ( bib_years(year), bib_formats(formats) )
+    years = tuple( sorted(set( str(y).strip() for y in years )) ) if years else None
+    formats = tuple( sorted(set(formats)) ) if formats else None
+    return ( partnership_id, university_code, 'BIB', (normalize_search_value('PHRASE', title), authors, years, formats) )
+
+
+def normalize_search_value( search_type, search_value ):
+    """ Returns search_value normalized for cache-keys, so eg '978-0-688-00230-5' and '9780688002305' share an entry.
+        Called by SearchResultCache """
+    value = str( search_value ).strip()
+    if search_type in ( 'ISBN', 'ISSN' ):
+        return re.sub( r'[\s-]', '', value ).upper()
+    if search_type == 'OCLC':
+        value = re.sub( r'^(\(ocolc\)|ocm|ocn|on)', '', value.lower() ).strip()
+        return value.lstrip( '0' ) or '0'
+    if search_type == 'LCCN':
+        return re.sub( r'\s', '', value ).lower()
+    return ' '.join( value.lower().split() )
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+""" Record/replay of BorrowDirect webservice calls, for offline, deterministic tests and benchmarks.
+
+    In 'record' mode, calls go to the network as usual, and each request/response pair is saved to a json cassette file;
+      in 'replay' mode, no call leaves the process -- each is answered from the cassette, optionally after its recorded latency.
+
+    Usage:
+        >>> bd = BorrowDirect( dict(settings, HTTP_CASSETTE_PATH='./cassettes/searches.json', HTTP_CASSETTE_MODE='record') )
+        >>> bd.search_exact_item( patron_barcode, 'ISBN', '9780688002305' )  # saved
+        >>> bd = BorrowDirect( dict(settings, HTTP_CASSETTE_PATH='./cassettes/searches.json', HTTP_CASSETTE_MODE='replay') )
+        >>> bd.search_exact_item( patron_barcode, 'ISBN', '9780688002305' )  # replayed, no network
+
+    Or, for Authenticator, Searcher, and Requester instances built without a session -- eg the tests in tests.py -- via environment-variables:
+        $ BDPY3_CASSETTE_PATH=./cassettes/tests.json BDPY3_CASSETTE_MODE=record python ./tests.py """
+
+import datetime, json, logging, os, threading, time, urllib.parse
+import requests
+from requests.structures import CaseInsensitiveDict
+from .session import BorrowDirectSession, PoolAdapter
+
+
+log = logging.getLogger(__name__)
+
+MODES = ( 'record', 'replay' )
+REDACTED_FIELDS = ( 'ApiKey', 'PatronId' )  # request-body fields not saved, nor matched on, so cassettes can be shared
+VOLATILE_QUERY_FIELDS = ( 'aid', )  # query-params not matched on; authorization-ids differ between runs
+DROPPED_RESPONSE_HEADERS = ( 'connection', 'content-encoding', 'content-length', 'date', 'keep-alive', 'server', 'set-cookie', 'transfer-encoding' )
+
+_cassettes = {}  # ( path, mode, latency_scale ) -> Cassette, shared by every session in the process
+_default_session = None
+_lock = threading.Lock()
+
+
+class CassetteMiss( requests.exceptions.ConnectionError ):
+    """ Raised in replay mode for a call the cassette holds no response for -- as a network failure would be, since the call cannot be made. """
+    pass
+
+
+class Cassette( object ):
+    """ Holds the recorded interactions of one cassette file; shared safely across threads.
+        A call matches an interaction on method, url-path, query (less VOLATILE_QUERY_FIELDS), and json-body (less REDACTED_FIELDS) --
+          not on host, so a cassette recorded against one API_URL_ROOT replays against any other.
+        Several interactions with the same match are replayed in recorded order, then from the first again.
+        Record from one process at a time; each recording process rewrites the whole file.
+        `latency_scale` multiplies each replayed response's recorded latency (default 0.0, answering at once); 1.0 replays real timings.
+        `recorded`, `replayed`, and `misses` count calls.
+        Called by open_cassette() """
+
+    def __init__( self, path, mode='replay', latency_scale=0.0 ):
+        assert mode in MODES, Exception( 'cassette mode must be one of %s; current value is: %s' % (MODES, mode) )
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.interactions = []  # in recorded order
+        self.matches = {}  # match-key -> list of interactions
+        self.positions = {}  # match-key -> index of the next interaction to replay
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        if mode == 'replay':
+            self.load()
+
+    def load( self ):
+        """ Loads the cassette file's interactions.
+            Called by __init__() in replay mode. """
+        with open( self.path ) as f:
+            data = json.load( f )
+        with self.lock:
+            self.interactions = []
+            self.matches = {}
+            self.positions = {}
+            for interaction in data['interactions']:
+                self._add( interaction )
+        log.debug( 'loaded `%s` interactions from cassette, ```%s```', len(self.interactions), self.path )
+        return
+
+    def play( self, request ):
+        """ Returns the recorded interaction for a requests.PreparedRequest; raises CassetteMiss if there is none.
+            Called by CassetteAdapter.send() """
+        key = match_key( request.method, request.url, request.body )
+        with self.lock:
+            candidates = self.matches.get( key )
+            if not candidates:
+                self.misses += 1
+                raise CassetteMiss( 'no recorded response in cassette ```%s``` for `%s %s`' % (self.path, request.method, key[1]), request=request )
+            position = self.positions.get( key, 0 )
+            self.positions[key] = ( position + 1 ) % len( candidates )
+            self.replayed += 1
+        return candidates[position]
+
+    def record( self, request, response, elapsed ):
+        """ Adds the request/response pair, and saves the cassette file.
+            Called by CassetteAdapter.send() """
+        ( method, path, query, body ) = match_key( request.method, request.url, request.body )
+        try:
+            response_body = { 'body': response.content.decode('utf-8') }
+        except UnicodeDecodeError:
+            response_body = { 'body_latin1': response.content.decode('latin-1') }
+        interaction = {
+            'request': { 'method': method, 'path': path, 'query': query, 'body': body },
+            'response': dict( {
+                'status': response.status_code, 'reason': response.reason,
+                'headers': { name: value for (name, value) in response.headers.items() if name.lower() not in DROPPED_RESPONSE_HEADERS } }, **response_body ),
+            'elapsed': round( elapsed, 6 ),
+            }
+        with self.lock:
+            self._add( interaction )
+            self.recorded += 1
+            self._save()
+        return
+
+    def stats( self ):
+        """ Returns counters dct.
+            Called manually. """
+        with self.lock:
+            return { 'mode': self.mode, 'interactions': len(self.interactions), 'recorded': self.recorded, 'replayed': self.replayed, 'misses': self.misses }
+
+    def _add( self, interaction ):
+        """ Indexes interaction by its match-key; caller holds lock.
+            Called by load() and record() """
+        recorded = interaction['request']
+        self.interactions.append( interaction )
+        self.matches.setdefault( (recorded['method'], recorded['path'], recorded['query'], recorded['body']), [] ).append( interaction )
+        return
+
+    def _save( self ):
+        """ Writes all interactions, via a temporary file, so a reader never sees a partial cassette; caller holds lock.
+            Called by record() """
+        directory = os.path.dirname( os.path.abspath(self.path) )
+        os.makedirs( directory, exist_ok=True )
+        temp_path = '%s.%s.tmp' % ( self.path, os.getpid() )
+        with open( temp_path, 'w' ) as f:
+            json.dump( {'version': 1, 'interactions': self.interactions}, f, indent=1, sort_keys=True )
+        os.replace( temp_path, self.path )
+        return
+
+    ## end class Cassette
+
+
+class CassetteAdapter( PoolAdapter ):
+    """ HTTPAdapter that records calls to, or replays them from, a Cassette.
+        Called by BorrowDirectSession() when given a cassette. """
+
+    __attrs__ = PoolAdapter.__attrs__ + [ 'cassette' ]
+
+    def __init__( self, cassette, **kwargs ):
+        self.cassette = cassette
+        super( CassetteAdapter, self ).__init__( **kwargs )
+
+    def send( self, request, **kwargs ):
+        """ Returns the replayed response, or the network response after recording it.
+            Called by requests.Session.send() """
+        if self.cassette.mode == 'replay':
+            interaction = self.cassette.play( request )
+            if self.cassette.latency_scale:
+                time.sleep( interaction['elapsed'] * self.cassette.latency_scale )
+            return self.build_replayed_response( request, interaction )
+        start_time = time.perf_counter()
+        response = super( CassetteAdapter, self ).send( request, **kwargs )
+        response.content  # reads the body, so its transfer counts toward the recorded latency
+        self.cassette.record( request, response, time.perf_counter() - start_time )
+        return response
+
+    def build_replayed_response( self, request, interaction ):
+        """ Returns a requests.Response built from the recorded interaction.
+            Called by send() """
+        recorded = interaction['response']
+        response = requests.Response()
+        response.status_code = recorded['status']
+        response.reason = recorded['reason']
+        response.headers = CaseInsensitiveDict( recorded['headers'] )
+        if 'body_latin1' in recorded:
+            ( response._content, response.encoding ) = ( recorded['body_latin1'].encode('latin-1'), 'latin-1' )
+        else:
+            ( response._content, response.encoding ) = ( recorded['body'].encode('utf-8'), 'utf-8' )
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = datetime.timedelta( seconds=interaction['elapsed'] )
+        return response
+
+    ## end class CassetteAdapter
+
+
+def match_key( method, url, body ):
+    """ Returns ( method, path, query, body ) identifying a call for replay, with volatile query-params and redacted body-fields removed.
+        Called by Cassette.play() and Cassette.record() """
+    parts = urllib.parse.urlsplit( url )
+    query = urllib.parse.urlencode( sorted( (name, value) for (name, value) in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if name not in VOLATILE_QUERY_FIELDS ) )
+    if isinstance( body, bytes ):
+        body = body.decode( 'utf-8' )
+    if body:
+        try:
+            data = json.loads( body )
+        except ValueError:
+            pass
+        else:
+            if isinstance( data, dict ):
+                data = { name: value for (name, value) in data.items() if name not in REDACTED_FIELDS }
+            body = json.dumps( data, sort_keys=True )
+    return ( method.upper(), parts.path, query, body or '' )
+
+
+def open_cassette( path, mode='replay', latency_scale=0.0 ):
+    """ Returns the process's Cassette for the path, mode, and latency_scale, building it on first use -- so several sessions recording
+          to one file add to, rather than overwrite, each other's interactions.
+        Called by BorrowDirectHelper.make_session() and environment_cassette() """
+    key = ( os.path.abspath(path), mode, float(latency_scale) )
+    with _lock:
+        if key not in _cassettes:
+            _cassettes[key] = Cassette( path, mode=mode, latency_scale=latency_scale )
+        return _cassettes[key]
+
+
+def environment_cassette():
+    """ Returns the Cassette named by the BDPY3_CASSETTE_PATH, BDPY3_CASSETTE_MODE (default 'replay'), and BDPY3_CASSETTE_LATENCY environment-variables,
+          or None if BDPY3_CASSETTE_PATH is not set.
+        Called by default_session() and BorrowDirectHelper.make_session() """
+    path = os.environ.get( 'BDPY3_CASSETTE_PATH' )
+    if not path:
+        return None
+    return open_cassette( path, mode=os.environ.get('BDPY3_CASSETTE_MODE', 'replay'), latency_scale=float(os.environ.get('BDPY3_CASSETTE_LATENCY', '0')) )
+
+
+def default_session():
+    """ Returns the `requests` module, or -- if BDPY3_CASSETTE_PATH is set -- a BorrowDirectSession recording to, or replaying from, that cassette,
+          built once per process and shared.
+        Called by Authenticator(), Searcher(), and Requester() when no session is passed in. """
+    global _default_session
+    if _default_session is None:
+        cassette = environment_cassette()
+        with _lock:
+            if _default_session is None:
+                _default_session = BorrowDirectSession( cassette=cassette ) if cassette else requests
+                if cassette:
+                    log.info( 'using cassette, ```%s```; mode, `%s`', cassette.path, cassette.mode )
+    return _default_session
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+""" Streams csv or jsonl rows through BorrowDirect searches and/or requests, writing one jsonl result per row as each completes.
+
+    Usage:
+        $ python -m bdpy3 --settings ./bd_settings.py --action search --workers 8 < items.csv > results.jsonl
+        $ python -m bdpy3 --setting API_URL_ROOT='"https://..."' --patron 1234 items.jsonl
+
+    Input rows (csv with a header-row, or one json object per line) hold either
+      `search_type` and `search_value` (an exact-item), or `title`, `author`, and `year` (a bib-item),
+      plus `patron` (or `patron_barcode`) unless --patron is given; any other fields are passed through in `input`.
+    Bib-item rows may also hold `formats` (default `Book`; json null drops the format filter), and several years.
+    In csv, several identifiers (`search_value`), authors (`author`), years (`year`), or formats (`formats`) are separated by `|`.
+    Memory use stays flat however long the input: rows are read lazily and at most twice --workers rows are in flight.
+    With --journal, a re-run after a crash skips journaled searches and never re-sends a journaled request (see journal.Journal). """
+
+import argparse, collections, csv, itertools, json, logging, sys, time
+from .search import DEFAULT_FORMATS, ERROR, HELD_LOCALLY, NOT_FOUND, classify_search_result
+
+
+log = logging.getLogger(__name__)
+
+ACTIONS = ( 'search', 'request', 'search_and_request' )
+MULTI_VALUE_SEPARATOR = '|'
+
+
+def main( argv=None, stdin=None, stdout=None, stderr=None ):
+    """ Runs the cli; returns the process exit-status: 0 if every row succeeded, 1 if any row errored.
+        Called by bdpy3/__main__.py, or manually. """
+    ( stdin, stdout, stderr ) = ( stdin or sys.stdin, stdout or sys.stdout, stderr or sys.stderr )
+    args = parse_args( argv )
+    logging.basicConfig( stream=stderr, level=args.log_level, format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s' )
+    bd = make_borrowdirect( args )
+    summary = Summary()
+    journal = None
+    if args.journal:
+        from .journal import Journal
+        journal = Journal( args.journal )
+    input_file = open( args.input, newline='' ) if args.input != '-' else stdin
+    try:
+        rows = read_rows( input_file, args.format )
+        for record in run_rows( bd, rows, args.action, args.patron, args.workers, journal ):
+            summary.add( record )
+            stdout.write( json.dumps(record) + '\n' )
+            stdout.flush()
+    finally:
+        if input_file is not stdin:
+            input_file.close()
+        if journal:
+            journal.close()
+        bd.close()
+    stderr.write( summary.line() + '\n' )
+    return 1 if summary.errors else 0
+
+
+def parse_args( argv ):
+    """ Returns parsed args.
+        Called by main() """
+    parser = argparse.ArgumentParser( prog='python -m bdpy3', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( 'input', nargs='?', default='-', help='csv or jsonl file; default `-`, stdin' )
+    parser.add_argument( '--action', choices=ACTIONS, default='search' )
+    parser.add_argument( '--format', choices=('auto', 'csv', 'jsonl'), default='auto', help='default `auto`: jsonl if the first line starts with `{`' )
+    parser.add_argument( '--workers', type=int, default=4, help='concurrent calls; default 4' )
+    parser.add_argument( '--patron', default=None, help='patron-barcode for rows without one' )
+    parser.add_argument( '--settings', default=None, metavar='PATH', help='settings-module path, as accepted by BorrowDirect()' )
+    parser.add_argument( '--setting', action='append', default=[], metavar='NAME=JSON', help='setting overriding --settings, eg AUTH_CACHE_TTL=600; repeatable' )
+    parser.add_argument( '--journal', default=None, metavar='PATH', help='sqlite journal; a re-run skips journaled work and never re-sends a journaled request' )
+    parser.add_argument( '--log-level', default='WARNING' )
+    return parser.parse_args( argv )
+
+
+def make_borrowdirect( args ):
+    """ Returns a BorrowDirect built from --settings and --setting; its pool is widened to --workers.
+        Called by main() """
+    from . import BorrowDirect
+    from .borrowdirect import BorrowDirectHelper
+    settings = BorrowDirectHelper().normalize_settings( args.settings )
+    for setting in args.setting:
+        ( name, value ) = setting.split( '=', 1 )
+        settings[name] = json.loads( value )
+    settings.setdefault( 'AUTH_CACHE_TTL', 600 )  # many rows per patron; authenticate once each
+    settings['RESULT_FORMAT'] = 'dict'  # output is json; RESULT_DROP_FIELDS still trims it
+    settings['HTTP_POOL_MAXSIZE'] = max( settings.get('HTTP_POOL_MAXSIZE', 10), args.workers )
+    return BorrowDirect( settings, logger=log )
+
+
+def read_rows( input_file, input_format='auto' ):
+    """ Lazily yields ( line_number, row_dct ) for each non-blank input row.
+        Called by main() """
+    first_line = input_file.readline()
+    lines = itertools.chain( [first_line], input_file )
+    if input_format == 'auto':
+        input_format = 'jsonl' if first_line.lstrip().startswith( '{' ) else 'csv'
+    if input_format == 'jsonl':
+        for ( line_number, line ) in enumerate( lines, 1 ):
+            if line.strip():
+                yield ( line_number, line )  # decoded by the worker, so a bad line becomes that row's error
+    else:
+        reader = csv.DictReader( lines )
+        for row in reader:
+            if any( row.values() ):
+                yield ( reader.line_num, row )
+
+
+def run_rows( bd, rows, action='search', patron=None, workers=4, journal=None ):
+    """ Yields one output-record dct per row, in completion order; each record carries its input `line` number.
+        All worker-threads share bd, its session, and its caches; its stateless methods return results rather than storing them.
+        Called by main() """
+    from . import batch
+    def run( numbered_row ):
+        row = parse_row( numbered_row[1], patron )
+        if journal:
+            return run_journaled_row( bd, row, action, journal )
+        return run_row( bd, row, action )
+    for ( ( line_number, row ), result ) in batch.run_unordered( run, rows, max_workers=workers ):
+        record = { 'line': line_number }
+        if isinstance( result, Exception ):
+            record.update( {'input': row.strip() if isinstance(row, str) else row, 'error': repr(result)} )
+        else:
+            record.update( result )
+        yield record
+
+
+def parse_row( row, default_patron=None ):
+    """ Returns normalized row dct with `patron` and either `search_type` and `search_value`, or `title`, `author`, and `year`.
+        Raises ValueError for an unusable row.
+        Called by run_rows() """
+    if isinstance( row, str ):
+        row = json.loads( row )
+        if not isinstance( row, dict ):
+            raise ValueError( 'json row is not an object' )
+    else:
+        row = { k: v for k, v in row.items() if k is not None and not _is_blank(v) }  # csv.DictReader files extra cells under None; empty cells are left out
+        for key in ( 'search_value', 'author', 'year', 'formats' ):
+            if isinstance( row.get(key), str ) and MULTI_VALUE_SEPARATOR in row[key]:
+                row[key] = [ part.strip() for part in row[key].split(MULTI_VALUE_SEPARATOR) if part.strip() ]
+    row['patron'] = row.pop( 'patron_barcode', None ) or row.get( 'patron' ) or default_patron
+    if not row['patron']:
+        raise ValueError( 'no patron (or patron_barcode) in row, and no --patron given' )
+    if row.get( 'search_type' ) and row.get( 'search_value' ):
+        return row
+    if row.get( 'title' ):
+        row.setdefault( 'author', '' )
+        row['year'] = None if _is_blank( row.get('year') ) else row.get( 'year' )  # no year means no date filter, not a filter on a blank date
+        return row
+    raise ValueError( 'row needs search_type and search_value, or title' )
+
+
+def _is_blank( value ):
+    """ Returns True for None and empty or whitespace-only strings.
+        Called by parse_row() """
+    return value is None or ( isinstance(value, str) and not value.strip() )
+
+
+def run_row( bd, row, action ):
+    """ Runs the action for a parsed row; returns output-record fields.
+        Called by run_rows() """
+    ( patron, record ) = ( row['patron'], {'input': row} )
+    if action == 'search_and_request':
+        if is_exact( row ):
+            record.update( bd.search_and_request_exact_item(patron, row['search_type'], row['search_value']) )
+        else:
+            record.update( bd.search_and_request_bib_item(patron, row['title'], row['author'], row['year'], row.get('formats', DEFAULT_FORMATS)) )
+    elif action == 'search':
+        search_result = run_search( bd, row )
+        record.update( {'search_outcome': classify_search_result(search_result), 'search_result': search_result} )
+    else:
+        request_result = run_request( bd, row )
+        record.update( {'requested': True, 'request_number': request_result.get('RequestNumber'), 'request_result': request_result} )
+    return record
+
+
+def run_journaled_row( bd, row, action, journal ):
+    """ Runs the action for a parsed row, skipping whatever the journal shows already done; returns output-record fields.
+        A journaled request -- DONE, or PENDING from a run that died mid-call -- is never re-sent; its record gets `journaled` True.
+        Called by run_rows() when --journal is given. """
+    from .journal import FAILED, PENDING, REQUEST, SEARCH
+    record = { 'input': row }
+    if is_exact( row ):
+        key = journal.make_exact_key( row['patron'], row['search_type'], row['search_value'] )
+    else:
+        key = journal.make_bib_key( row['patron'], row['title'], row['author'], row['year'], row.get('formats', DEFAULT_FORMATS) )
+    if action in ( 'request', 'search_and_request' ):
+        entry = journal.get( key, REQUEST )
+        if entry and ( entry['request_number'] or entry['status'] != FAILED ):
+            record.update( {
+                'journaled': True, 'requested': True, 'request_status': entry['status'],
+                'request_number': entry['request_number'], 'request_result': entry['result']} )
+            if entry['status'] == PENDING:
+                log.warning( 'request for `%s` was pending when an earlier run stopped; not re-sending -- check BorrowDirect', key )
+            return record
+    if action in ( 'search', 'search_and_request' ):
+        entry = journal.get( key, SEARCH )
+        if entry:
+            ( search_result, record['journaled'] ) = ( entry['result'], True )
+        else:
+            search_result = run_search( bd, row )
+        search_outcome = classify_search_result( search_result )
+        if not entry and search_outcome != ERROR:
+            journal.record_search( key, search_result )
+        record.update( {'search_outcome': search_outcome, 'search_result': search_result} )
+        if action == 'search':
+            return record
+        if search_outcome in ( HELD_LOCALLY, NOT_FOUND, ERROR ):
+            record.update( {'requested': False, 'request_number': None, 'request_result': None} )
+            return record
+    if not journal.begin_request( key ):  # another row for the same item got there first
+        entry = journal.get( key, REQUEST )
+        record.update( {'journaled': True, 'requested': True, 'request_status': entry['status'], 'request_number': entry['request_number'], 'request_result': entry['result']} )
+        return record
+    try:
+        request_result = run_request( bd, row )
+    except Exception as e:
+        journal.fail_request( key, repr(e) )
+        raise
+    journal.finish_request( key, request_result )
+    record.update( {'requested': True, 'request_number': request_result.get('RequestNumber'), 'request_result': request_result} )
+    return record
+
+
+def is_exact( row ):
+    """ Returns True for an exact-item row, False for a bib-item row.
+        Called by run_row() and run_journaled_row() """
+    return bool( row.get('search_type') and row.get('search_value') )
+
+
+def run_search( bd, row ):
+    """ Returns the search result for a parsed row.
+        Called by run_row() and run_journaled_row() """
+    if is_exact( row ):
+        return bd.search_exact_item( row['patron'], row['search_type'], row['search_value'] )
+    return bd.search_bib_item( row['patron'], row['title'], row['author'], row['year'], row.get('formats', DEFAULT_FORMATS) )
+
+
+def run_request( bd, row ):
+    """ Returns the request result for a parsed row.
+        Called by run_row() and run_journaled_row() """
+    if is_exact( row ):
+        return bd.request_exact_item( row['patron'], row['search_type'], row['search_value'] )
+    return bd.request_bib_item( row['patron'], row['title'], row['author'], row['year'], row.get('formats', DEFAULT_FORMATS) )
+
+
+class Summary( object ):
+    """ Tallies output-records in constant memory.
+        Called by main() """
+
+    def __init__( self ):
+        self.start_time = time.perf_counter()
+        self.rows = 0
+        self.errors = 0
+        self.request_numbers = 0
+        self.journaled = 0
+        self.outcomes = collections.Counter()
+
+    def add( self, record ):
+        self.rows += 1
+        if 'error' in record:
+            self.errors += 1
+        if record.get( 'search_outcome' ):
+            self.outcomes[ record['search_outcome'] ] += 1
+        if record.get( 'request_number' ):
+            self.request_numbers += 1
+        if record.get( 'journaled' ):
+            self.journaled += 1
+        return
+
+    def line( self ):
+        """ Returns the summary line written to stderr. """
+        seconds = time.perf_counter() - self.start_time
+        outcomes = ' '.join( '%s=%s' % (k, v) for k, v in sorted(self.outcomes.items()) ) or '-'
+        return 'bdpy3: %s rows in %.1f seconds (%.1f rows/second); errors %s; request-numbers %s; from journal %s; search outcomes %s' % (
+            self.rows, seconds, self.rows / seconds if seconds else 0.0, self.errors, self.request_numbers, self.journaled, outcomes )
+
+    ## end class Summary
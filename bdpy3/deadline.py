@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+""" End-to-end time budgets for BorrowDirect operations, split between the auth phase and the search/request phase. """
+
+import contextlib, contextvars, logging, sys, time
+
+
+log = logging.getLogger(__name__)
+
+TIMEOUT_SLACK = 0.05  # seconds; a call timing out this close to the deadline is blamed on the deadline
+
+_current = contextvars.ContextVar( 'bdpy3_deadline', default=(None, None) )  # ( deadline, phase ) of the call inside deadline_guard()
+
+
+class DeadlineExceeded( TimeoutError ):
+    """ Raised when an operation's budget runs out; `phase` names the call that was cut off or never started --
+          'authentication', 'authorization', 'search', or 'request' -- and `budget` is that phase's budget in seconds. """
+
+    def __init__( self, phase, budget, elapsed ):
+        self.phase = phase
+        self.budget = budget
+        self.elapsed = elapsed
+        super( DeadlineExceeded, self ).__init__(
+            'deadline exceeded in the `%s` phase; budget `%.3f` seconds, elapsed `%.3f` seconds' % (phase, budget, elapsed) )
+
+    ## end class DeadlineExceeded
+
+
+class Deadline( object ):
+    """ A budget of `seconds`, starting now.
+        for_auth() hands the auth phase at most `auth_share` of what remains, so a slow authentication still leaves the search or request time to run;
+          the search/request phase then gets everything left.
+        Called by BorrowDirect and AsyncBorrowDirect when the DEADLINE_SECONDS setting is set; used by Authenticator, Searcher, and Requester. """
+
+    def __init__( self, seconds, auth_share=0.5 ):
+        self.seconds = seconds
+        self.auth_share = auth_share
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining( self ):
+        """ Returns seconds left; negative once expired. """
+        return self.expires_at - time.monotonic()
+
+    def for_auth( self ):
+        """ Returns the auth phase's deadline: `auth_share` of the remaining budget.
+            Called by Searcher.get_authorization_id(), Requester.get_authorization_id(), and BorrowDirect.run_auth_nz() """
+        return Deadline( max(0.0, self.remaining()) * self.auth_share, self.auth_share )
+
+    def timeout_for( self, phase, timeout ):
+        """ Returns `timeout` -- seconds, or a ( connect, read ) tuple -- capped at the remaining budget.
+            Raises DeadlineExceeded, without making the call, if nothing remains.
+            Called by timeout_for_phase() """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded( phase, self.seconds, self.seconds - remaining )
+        if isinstance( timeout, (list, tuple) ):
+            return tuple( remaining if t is None else min(t, remaining) for t in timeout )
+        return remaining if timeout is None else min( timeout, remaining )
+
+    ## end class Deadline
+
+
+def timeout_for_phase( timeout, deadline, phase ):
+    """ Returns the http timeout to use for a call: `timeout`, capped by the deadline if there is one.
+        Called by Authenticator, Searcher, Requester, and AsyncBorrowDirect before each call. """
+    if deadline is None:
+        return timeout
+    return deadline.timeout_for( phase, timeout )
+
+
+@contextlib.contextmanager
+def deadline_guard( deadline, phase ):
+    """ Re-raises a timeout that happened as the deadline ran out as DeadlineExceeded, naming the phase; other errors pass through.
+        While inside, current_deadline() returns ( deadline, phase ), so the session can cap its rate-limit wait.
+        Called by Authenticator, Searcher, Requester, and AsyncBorrowDirect around each call. """
+    token = _current.set( (deadline, phase) )
+    try:
+        yield
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if deadline is None or not _is_timeout( e ) or deadline.remaining() > TIMEOUT_SLACK:
+            raise
+        log.warning( 'deadline exceeded in phase, `%s`', phase )
+        raise DeadlineExceeded( phase, deadline.seconds, deadline.seconds - deadline.remaining() ) from e
+    finally:
+        _current.reset( token )
+
+
+def current_deadline():
+    """ Returns ( deadline, phase ) of the call being made inside deadline_guard(), or ( None, None ).
+        Called by BorrowDirectSession.request() """
+    return _current.get()
+
+
+def _is_timeout( exception ):
+    """ Returns True for socket, asyncio, and `requests` timeouts; `requests` is only consulted if already imported. """
+    if isinstance( exception, TimeoutError ):
+        return True
+    requests = sys.modules.get( 'requests' )
+    return bool( requests ) and isinstance( exception, requests.exceptions.Timeout )
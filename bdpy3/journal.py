@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+""" Durable sqlite journal of bulk searches and requests, so a restarted run skips completed work and never re-submits a request. """
+
+import json, logging, sqlite3, threading, time
+from .cache import normalize_search_value
+from .search import DEFAULT_FORMATS, bib_formats, exact_search_pairs
+
+
+log = logging.getLogger(__name__)
+
+SEARCH = 'search'
+REQUEST = 'request'
+PENDING = 'pending'  # request sent, or about to be; outcome unknown if the run died here
+DONE = 'done'
+FAILED = 'failed'  # the call raised; safe to retry, since no request-number came back
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS journal (
+        key TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        request_number TEXT,
+        result TEXT,
+        updated REAL NOT NULL,
+        PRIMARY KEY ( key, kind ) )
+    """
+
+
+class Journal( object ):
+    """ Records, per input-key, each search and request with its status and result.
+        Search results are buffered and written in batches of `batch_size` (or every `flush_interval` seconds),
+          since losing a few on a crash only costs a repeated search.
+        Request states are committed synchronously -- PENDING before the call, DONE or FAILED after --
+          so a crash can never lose a request-number; a PENDING entry found on restart is reported, not re-sent.
+        Thread-safe; one connection is shared under a lock.
+        Called by cli.main(), or manually. """
+
+    def __init__( self, path, batch_size=100, flush_interval=1.0 ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = {}  # key -> ( status, result_json, updated ), for unflushed search entries
+        self.last_flush = time.monotonic()
+        self.connection = sqlite3.connect( path, check_same_thread=False, isolation_level=None )
+        self.connection.execute( 'PRAGMA journal_mode=WAL' )
+        self.connection.execute( SCHEMA )
+
+    def make_exact_key( self, patron_barcode, search_type, search_value ):
+        """ Returns input-key for an exact-item; several identifiers share a key regardless of their order.
+            Called by cli.run_journaled_row(), or manually. """
+        pairs = sorted( set( (item_type, normalize_search_value(item_type, item_value)) for (item_type, item_value) in exact_search_pairs(search_type, search_value) ) )
+        return json.dumps( ['exact', str(patron_barcode), pairs] )
+
+    def make_bib_key( self, patron_barcode, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Returns input-key for a bib-item; formats are only part of the key if not the default, so earlier journals' keys still match.
+            Called by cli.run_journaled_row(), or manually. """
+        authors = [ normalize_search_value('PHRASE', a) for a in author ] if isinstance( author, (list, tuple) ) else normalize_search_value( 'PHRASE', author )
+        years = sorted( set(str(y).strip() for y in year) ) if isinstance( year, (list, tuple, set, frozenset, range) ) else str( year ).strip()
+        key = [ 'bib', str(patron_barcode), normalize_search_value('PHRASE', title), authors, years ]
+        formats = sorted( set(bib_formats(formats) or []) )
+        if formats != sorted( DEFAULT_FORMATS ):
+            key.append( formats )
+        return json.dumps( key )
+
+    def get( self, key, kind ):
+        """ Returns entry dct -- {'status', 'request_number', 'result'} -- or None.
+            Called by cli.run_journaled_row(), or manually. """
+        with self.lock:
+            if kind == SEARCH and key in self.buffer:
+                ( status, result_json, updated ) = self.buffer[key]
+                return { 'status': status, 'request_number': None, 'result': json.loads(result_json) }
+            row = self.connection.execute(
+                'SELECT status, request_number, result FROM journal WHERE key = ? AND kind = ?', (key, kind) ).fetchone()
+        if row is None:
+            return None
+        return { 'status': row[0], 'request_number': row[1], 'result': json.loads(row[2]) if row[2] else None }
+
+    def record_search( self, key, result_dct ):
+        """ Buffers a completed search; flushes when the batch is full or due.
+            Called by cli.run_journaled_row(), or manually. """
+        with self.lock:
+            self.buffer[key] = ( DONE, json.dumps(result_dct), time.time() )
+            if len( self.buffer ) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+        return
+
+    def begin_request( self, key ):
+        """ Commits a PENDING request entry, claiming the key; call just before sending the request.
+            Returns False, claiming nothing, if the key already has a PENDING or DONE request -- eg a duplicate input row -- so it must not be sent.
+            Called by cli.run_journaled_row(), or manually. """
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO journal ( key, kind, status, request_number, result, updated ) VALUES ( ?, ?, ?, NULL, NULL, ? ) '
+                'ON CONFLICT ( key, kind ) DO UPDATE SET status = excluded.status, result = NULL, updated = excluded.updated '
+                'WHERE journal.status = ? AND journal.request_number IS NULL',
+                ( key, REQUEST, PENDING, time.time(), FAILED ) )
+            claimed = cursor.rowcount == 1
+        log.debug( 'journaled request, `%s`; claimed, `%s`', key, claimed )
+        return claimed
+
+    def finish_request( self, key, result_dct ):
+        """ Commits the request's result and any request-number.
+            Called by cli.run_journaled_row(), or manually. """
+        self._write_request( key, DONE, ( result_dct or {} ).get('RequestNumber'), json.dumps(result_dct) )
+        return
+
+    def fail_request( self, key, error ):
+        """ Commits a FAILED request entry, eg after a connection error, so a later run retries it.
+            Called by cli.run_journaled_row(), or manually. """
+        self._write_request( key, FAILED, None, json.dumps({'error': error}) )
+        return
+
+    def flush( self ):
+        """ Writes buffered search entries.
+            Called by close(), or manually. """
+        with self.lock:
+            self._flush()
+        return
+
+    def stats( self ):
+        """ Returns counts dct like { 'search:done': 120, 'request:pending': 1 }.
+            Called manually. """
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute( 'SELECT kind, status, COUNT(*) FROM journal GROUP BY kind, status' ).fetchall()
+        return { '%s:%s' % (kind, status): count for ( kind, status, count ) in rows }
+
+    def close( self ):
+        """ Flushes and closes the connection.
+            Called by cli.main(), manually, or on leaving a `with Journal(path) as journal:` block. """
+        self.flush()
+        with self.lock:
+            self.connection.close()
+        return
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+    def _write_request( self, key, status, request_number, result_json ):
+        """ Commits one request entry, never replacing a recorded request-number; called by finish_request() and fail_request() """
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO journal ( key, kind, status, request_number, result, updated ) VALUES ( ?, ?, ?, ?, ?, ? ) '
+                'ON CONFLICT ( key, kind ) DO UPDATE SET status = excluded.status, request_number = excluded.request_number, result = excluded.result, updated = excluded.updated '
+                'WHERE journal.request_number IS NULL',
+                ( key, REQUEST, status, request_number, result_json, time.time() ) )
+        log.debug( 'journaled request, `%s`; status, `%s`', key, status )
+        return
+
+    def _flush( self ):
+        """ Writes buffered search entries in one transaction; caller holds lock. """
+        if self.buffer:
+            with self.connection:
+                self.connection.execute( 'BEGIN' )
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO journal ( key, kind, status, request_number, result, updated ) VALUES ( ?, ?, ?, NULL, ?, ? )',
+                    [ (key, SEARCH, status, result_json, updated) for key, ( status, result_json, updated ) in self.buffer.items() ] )
+            log.debug( 'journaled `%s` searches', len(self.buffer) )
+            self.buffer = {}
+        self.last_flush = time.monotonic()
+        return
+
+    ## end class Journal
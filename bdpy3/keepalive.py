@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+""" Keeps patrons' authorization-ids alive in the background, so searches and requests for active patrons never wait on authentication. """
+
+import logging, threading, time
+from .auth import Authenticator
+
+
+log = logging.getLogger(__name__)
+
+
+class AuthKeepAlive( object ):
+    """ Tracks the authorization-ids in an AuthIdCache as they are used; a background thread calls Authenticator.authorize() on each
+          once it is within `refresh_margin` seconds of its cache-expiry -- extending its server session -- then extends its cache entry.
+        An authorization-id unused for `idle_timeout` seconds is dropped from tracking and left to expire, bounding memory and server load;
+          one the server reports invalid is invalidated, so the next use re-authenticates.
+        `refreshes`, `failures`, and `evictions` count outcomes.
+        Called by BorrowDirect.__init__() when the AUTH_KEEPALIVE setting is set, or manually. """
+
+    def __init__( self, auth_cache, session=None, timeout=90, refresh_margin=60, idle_timeout=1800, interval=None ):
+        self.auth_cache = auth_cache
+        self.authenticator = Authenticator( session=session, timeout=timeout )
+        self.refresh_margin = refresh_margin
+        self.idle_timeout = idle_timeout
+        self.interval = interval or max( 0.05, refresh_margin / 4.0 )  # seconds between passes
+        self.last_used = {}  # auth-cache key -> time.time() of last use
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.refreshes = 0
+        self.failures = 0
+        self.evictions = 0
+        auth_cache.keepalive = self
+
+    def touch( self, key ):
+        """ Records a use of the key's authorization-id.
+            Called by AuthIdCache.get() and AuthIdCache.set() """
+        with self.lock:
+            self.last_used[key] = time.time()
+        return
+
+    def start( self ):
+        """ Starts the background thread; returns self.
+            Called by BorrowDirect.__init__(), or manually. """
+        if not self.thread:
+            self.stop_event.clear()
+            self.thread = threading.Thread( target=self._run, name='bdpy3-auth-keepalive', daemon=True )
+            self.thread.start()
+        return self
+
+    def stop( self ):
+        """ Stops the background thread.
+            Called by BorrowDirect.close(), or manually. """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        return
+
+    def refresh( self, now=None ):
+        """ Makes one pass over the tracked authorization-ids: evicts idle ones, authorizes those near expiry.
+            Called by the background thread, or manually. """
+        now = now or time.time()
+        with self.lock:
+            tracked = list( self.last_used.items() )
+        for ( key, last_used ) in tracked:
+            if self.stop_event.is_set():
+                break
+            entry = self.auth_cache.peek( key )
+            if entry is None or now - last_used > self.idle_timeout:  # expired, invalidated, or idle
+                self._forget( key, last_used )
+                self.evictions += entry is not None
+                continue
+            ( authorization_id, expires_at ) = entry
+            if expires_at - now > self.refresh_margin:
+                continue
+            try:
+                valid = self.authenticator.authorize( key[0], authorization_id )  # key is ( api_url_root, partnership_id, university_code, patron_barcode )
+            except Exception as e:
+                self.failures += 1
+                log.warning( 'keep-alive authorization failed, `%r`; will retry until the authorization-id expires', e )
+                continue
+            if valid:
+                self.auth_cache.extend( key, authorization_id )
+                self.refreshes += 1
+            else:
+                self.auth_cache.invalidate( key )
+                self._forget( key, last_used )
+        return
+
+    def stats( self ):
+        """ Returns counters dct.
+            Called manually. """
+        with self.lock:
+            tracked = len( self.last_used )
+        return { 'tracked': tracked, 'refreshes': self.refreshes, 'failures': self.failures, 'evictions': self.evictions }
+
+    def _forget( self, key, last_used ):
+        """ Stops tracking key, unless it was used again meanwhile.
+            Called by refresh() """
+        with self.lock:
+            if self.last_used.get( key ) == last_used:
+                del self.last_used[key]
+        return
+
+    def _run( self ):
+        while not self.stop_event.wait( self.interval ):
+            try:
+                self.refresh()
+            except Exception:
+                log.exception( 'keep-alive pass failed' )
+        return
+
+    ## end class AuthKeepAlive
@@ -2,7 +2,7 @@
 
 """ Configures logger if needed. """
 
-import json, logging, logging.config, os, pprint
+import json, logging, os, random, threading
 
 
 DEFAULT_CONFIG_DCT = {
@@ -16,7 +16,7 @@ DEFAULT_CONFIG_DCT = {
     },
     'handlers': {
         'default': {
-            'level':'DEBUG',
+            'level':'INFO',
             'class':'logging.StreamHandler',
             'formatter': 'standard',
         },
@@ -24,18 +24,147 @@ DEFAULT_CONFIG_DCT = {
     'loggers': {
         '': {
             'handlers': ['default'],
-            'level': 'DEBUG',
+            'level': 'INFO',  # so hot-path debug messages, and their Lazy* args, are skipped unless LOG_LEVEL or BDPY3_LOG_LEVEL asks for them
             'propagate': False
         }
     }
 }
 
 
-def check_logger():
+BODY_MAX_CHARS = int( os.environ.get('BDPY3_LOG_BODY_MAX_CHARS', '2000') )  # 0 means no truncation
+BODY_SAMPLE_RATE = float( os.environ.get('BDPY3_LOG_BODY_SAMPLE_RATE', '1.0') )  # fraction of response-bodies logged
+
+queue_listener = None
+default_logging_configured = False
+default_logging_lock = threading.Lock()
+
+
+def check_logger( log_path=None, log_level=None ):
     """ Allows a log config dct to be passed in.
         Useful for logging to a file, or adjusting levels via settings.
-        Called by most bdpy3 modules. """
+        `BDPY3_LOG_LEVEL` adjusts the default config's level; `BDPY3_LOG_QUEUE=1` routes records through enable_queue_logging().
+        `log_level` (the LOG_LEVEL setting) overrides `BDPY3_LOG_LEVEL`, and `log_path` (the LOG_PATH setting) sends the default config's records to that file
+          instead of stderr; neither applies to a `BDPY3_LOG_CONFIG_JSON` config, nor once logging has handlers.
+        Not run on import, so `import bdpy3` leaves logging alone until a BorrowDirect is built without a logger.
+        Called by configure_default_logging(), or manually. """
     if not logging._handlers:
+        import logging.config as logging_config  # imported on first use; it pulls in several modules
         config_dct = json.loads( os.environ.get('BDPY3_LOG_CONFIG_JSON', json.dumps(DEFAULT_CONFIG_DCT)) )
-        logging.config.dictConfig( config_dct )
+        if 'BDPY3_LOG_CONFIG_JSON' not in os.environ:
+            level = log_level or os.environ.get( 'BDPY3_LOG_LEVEL' )
+            if level:
+                config_dct['handlers']['default']['level'] = config_dct['loggers']['']['level'] = level.upper() if isinstance( level, str ) else level
+            if log_path:
+                config_dct['handlers']['default'] = {
+                    'level': config_dct['handlers']['default']['level'], 'class': 'logging.FileHandler', 'filename': log_path, 'formatter': 'standard' }
+        logging_config.dictConfig( config_dct )
+        if os.environ.get( 'BDPY3_LOG_QUEUE' ) == '1':
+            enable_queue_logging()
+    return
+
+
+def configure_default_logging( log_path=None, log_level=None ):
+    """ Runs check_logger() with the LOG_PATH and LOG_LEVEL settings -- once per process;
+          later calls return immediately, so building many BorrowDirect instances, from any number of threads, does not re-configure logging.
+        Called by BorrowDirectHelper.setup_log(), or manually. """
+    global default_logging_configured
+    if default_logging_configured:
+        return
+    with default_logging_lock:
+        if not default_logging_configured:
+            check_logger( log_path, log_level )
+            default_logging_configured = True
+    return
+
+
+def enable_queue_logging():
+    """ Moves the root logger's handlers behind a queue serviced by a background thread,
+          so callers only pay for enqueuing a record, not for formatting it or for stream/file i/o.
+        Records are queued unformatted -- LazyPformat, LazyBody, and LazyJson args are rendered by the handlers, on the background thread --
+          so an object logged, then changed before the record is handled, is logged as changed; bdpy3's own log calls do not change their args.
+        Safe to call more than once; stop_queue_logging() runs at exit, flushing queued records.
+        Called by check_logger() and BorrowDirectHelper.setup_log(), or manually. """
+    global queue_listener
+    if queue_listener:
+        return queue_listener
+    import atexit, queue
+    import logging.handlers as logging_handlers
+
+    class DeferredQueueHandler( logging_handlers.QueueHandler ):
+        """ QueueHandler that leaves formatting to the listener's handlers; the stock prepare() formats the record in the calling thread. """
+
+        def prepare( self, record ):
+            return record
+
+    root = logging.getLogger()
+    handlers = [ h for h in root.handlers if not isinstance(h, logging_handlers.QueueHandler) ]
+    record_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler( handler )
+    root.addHandler( DeferredQueueHandler(record_queue) )
+    queue_listener = logging_handlers.QueueListener( record_queue, *handlers, respect_handler_level=True )
+    queue_listener.start()
+    atexit.register( stop_queue_logging )
+    return queue_listener
+
+
+def stop_queue_logging():
+    """ Flushes queued records and stops the background thread; records logged afterwards queue up until enable_queue_logging() is called again.
+        Called at exit, or manually. """
+    global queue_listener
+    if queue_listener:
+        queue_listener.stop()
+        queue_listener = None
     return
+
+
+class LazyPformat( object ):
+    """ Defers pprint.pformat() until a log record is actually emitted.
+        Usage: `log.debug( 'params, `%s`', LazyPformat(params) )` """
+
+    __slots__ = ( 'obj', )
+
+    def __init__( self, obj ):
+        self.obj = obj
+
+    def __str__( self ):
+        import pprint
+        return pprint.pformat( self.obj )
+
+    ## end class LazyPformat
+
+
+class LazyJson( object ):
+    """ Defers json.dumps() until a log record is actually emitted.
+        Usage: `log.debug( 'json would be, ```%s```', LazyJson(params) )` """
+
+    __slots__ = ( 'obj', )
+
+    def __init__( self, obj ):
+        self.obj = obj
+
+    def __str__( self ):
+        return json.dumps( self.obj )
+
+    ## end class LazyJson
+
+
+class LazyBody( object ):
+    """ Defers decoding a response-body until a log record is actually emitted;
+          then samples (BODY_SAMPLE_RATE) and truncates (BODY_MAX_CHARS) it.
+        Usage: `log.debug( 'search r.content, `%s`', LazyBody(r.content) )` """
+
+    __slots__ = ( 'content', )
+
+    def __init__( self, content ):
+        self.content = content
+
+    def __str__( self ):
+        if BODY_SAMPLE_RATE < 1.0 and random.random() >= BODY_SAMPLE_RATE:
+            return '(body not sampled; %s bytes)' % len( self.content )
+        text = self.content.decode( 'utf-8', 'replace' ) if isinstance( self.content, bytes ) else str( self.content )
+        if BODY_MAX_CHARS and len( text ) > BODY_MAX_CHARS:
+            return '%s...(truncated; %s chars total)' % ( text[:BODY_MAX_CHARS], len(text) )
+        return text
+
+    ## end class LazyBody
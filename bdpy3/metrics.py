@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+""" Per-endpoint latency, in-flight, status, error-code, and timeout metrics for calls to the BorrowDirect webservices. """
+
+import json, logging, os, threading, time, urllib.parse
+
+
+log = logging.getLogger(__name__)
+
+json_backend = None  # set by set_json_backend(); see loads_json()
+
+DEFAULT_BUCKETS = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 90.0 )
+ENDPOINT_PATHS = {
+    '/portal-service/user/authentication': 'authentication',
+    '/portal-service/user/authz/isAuthorized': 'authorization',
+    '/dws/item/available': 'search',
+    '/dws/item/add': 'request',
+    }
+
+
+class Metrics( object ):
+    """ Collects per-endpoint metrics; thread-safe.
+        Endpoints are 'authentication', 'authorization', 'search', and 'request' (see endpoint_name()).
+        Each observation is also passed, as a dct, to every sink added via add_sink() -- eg to forward to statsd.
+        snapshot(), to_json(), and to_prometheus_text() export the totals, so a long-running worker can be scraped.
+        Called by BorrowDirectHelper.make_metrics(); used by BorrowDirectSession.request() and decode_json() """
+
+    def __init__( self, buckets=DEFAULT_BUCKETS ):
+        self.buckets = tuple( sorted(buckets) )
+        self.lock = threading.Lock()
+        self.sinks = []
+        self.endpoints = {}
+
+    def add_sink( self, callback ):
+        """ Registers callback( event_dct ); called on every observation, outside the metrics lock.
+            Called manually. """
+        self.sinks.append( callback )
+        return
+
+    def start_call( self, endpoint ):
+        """ Increments the endpoint's in-flight count; returns start-time for finish_call().
+            Called by BorrowDirectSession.request() """
+        with self.lock:
+            self._endpoint( endpoint )['in_flight'] += 1
+        return time.perf_counter()
+
+    def finish_call( self, endpoint, start_time, status=None, timed_out=False, connection_error=False ):
+        """ Decrements in-flight count and records latency and outcome.
+            Called by BorrowDirectSession.request() """
+        seconds = time.perf_counter() - start_time
+        with self.lock:
+            stats = self._endpoint( endpoint )
+            stats['in_flight'] -= 1
+            self._observe( stats['latency'], seconds )
+            if status is not None:
+                stats['statuses'][str(status)] = stats['statuses'].get( str(status), 0 ) + 1
+            if timed_out:
+                stats['timeouts'] += 1
+            if connection_error:
+                stats['connection_errors'] += 1
+        self._emit( {'type': 'call', 'endpoint': endpoint, 'seconds': seconds, 'status': status, 'timed_out': timed_out, 'connection_error': connection_error} )
+        return
+
+    def observe_decode( self, endpoint, seconds, result_dct ):
+        """ Records json-decoding time, and any BorrowDirect 'Problem' ErrorCode in the result -- a dct, or a results.SearchResult/RequestResult.
+            Called by decode_json() """
+        error_code = getattr( result_dct, 'problem_code', None )
+        if isinstance( result_dct, dict ) and isinstance( result_dct.get('Problem'), dict ):
+            error_code = result_dct['Problem'].get( 'ErrorCode' )
+        with self.lock:
+            stats = self._endpoint( endpoint )
+            self._observe( stats['decode'], seconds )
+            if error_code:
+                stats['error_codes'][error_code] = stats['error_codes'].get( error_code, 0 ) + 1
+        self._emit( {'type': 'decode', 'endpoint': endpoint, 'seconds': seconds, 'error_code': error_code} )
+        return
+
+    def snapshot( self ):
+        """ Returns a deep copy of the per-endpoint totals.
+            Called by to_json(), to_prometheus_text(), or manually. """
+        with self.lock:
+            return json.loads( json.dumps({'buckets': self.buckets, 'endpoints': self.endpoints}) )
+
+    def to_json( self ):
+        """ Returns snapshot as json.
+            Called manually. """
+        return json.dumps( self.snapshot(), sort_keys=True )
+
+    def to_prometheus_text( self ):
+        """ Returns snapshot in the prometheus text exposition format.
+            Called manually, eg by a worker's /metrics handler. """
+        snapshot = self.snapshot()
+        lines = []
+        metric_specs = [
+            ( 'bdpy3_call_duration_seconds', 'histogram', 'BorrowDirect webservice call latency.' ),
+            ( 'bdpy3_json_decode_duration_seconds', 'histogram', 'BorrowDirect response json-decoding time.' ),
+            ( 'bdpy3_calls_in_flight', 'gauge', 'BorrowDirect webservice calls in progress.' ),
+            ( 'bdpy3_responses_total', 'counter', 'BorrowDirect webservice responses by http status.' ),
+            ( 'bdpy3_error_codes_total', 'counter', 'BorrowDirect Problem ErrorCodes returned.' ),
+            ( 'bdpy3_timeouts_total', 'counter', 'BorrowDirect webservice calls that timed out.' ),
+            ( 'bdpy3_connection_errors_total', 'counter', 'BorrowDirect webservice calls that failed to connect.' ),
+            ]
+        for ( name, kind, help_text ) in metric_specs:
+            lines.append( '# HELP %s %s' % (name, help_text) )
+            lines.append( '# TYPE %s %s' % (name, kind) )
+            for endpoint, stats in sorted( snapshot['endpoints'].items() ):
+                label = 'endpoint="%s"' % endpoint
+                if kind == 'histogram':
+                    histogram = stats['latency'] if name == 'bdpy3_call_duration_seconds' else stats['decode']
+                    for ( bound, count ) in zip( list(snapshot['buckets']) + ['+Inf'], histogram['counts'] ):
+                        lines.append( '%s_bucket{%s,le="%s"} %s' % (name, label, bound, count) )
+                    lines.append( '%s_sum{%s} %s' % (name, label, histogram['sum']) )
+                    lines.append( '%s_count{%s} %s' % (name, label, histogram['count']) )
+                elif name == 'bdpy3_calls_in_flight':
+                    lines.append( '%s{%s} %s' % (name, label, stats['in_flight']) )
+                elif name == 'bdpy3_responses_total':
+                    for status, count in sorted( stats['statuses'].items() ):
+                        lines.append( '%s{%s,status="%s"} %s' % (name, label, status, count) )
+                elif name == 'bdpy3_error_codes_total':
+                    for error_code, count in sorted( stats['error_codes'].items() ):
+                        lines.append( '%s{%s,error_code="%s"} %s' % (name, label, error_code, count) )
+                else:
+                    lines.append( '%s{%s} %s' % (name, label, stats['timeouts' if name == 'bdpy3_timeouts_total' else 'connection_errors']) )
+        return '\n'.join( lines ) + '\n'
+
+    def _endpoint( self, endpoint ):
+        """ Returns endpoint's stats dct, creating it if needed; caller holds lock. """
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                'in_flight': 0, 'statuses': {}, 'error_codes': {}, 'timeouts': 0, 'connection_errors': 0,
+                'latency': self._new_histogram(), 'decode': self._new_histogram() }
+        return self.endpoints[endpoint]
+
+    def _new_histogram( self ):
+        return { 'counts': [0] * ( len(self.buckets) + 1 ), 'sum': 0.0, 'count': 0 }  # counts are cumulative, as prometheus expects
+
+    def _observe( self, histogram, seconds ):
+        """ Adds an observation to a histogram; caller holds lock. """
+        for i, bound in enumerate( self.buckets ):
+            if seconds <= bound:
+                histogram['counts'][i] += 1
+        histogram['counts'][-1] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+        return
+
+    def _emit( self, event ):
+        for sink in self.sinks:
+            try:
+                sink( event )
+            except Exception as e:
+                log.warning( 'metrics sink failed, ```%s```' % repr(e) )
+        return
+
+    ## end class Metrics
+
+
+def endpoint_name( url ):
+    """ Returns 'authentication', 'authorization', 'search', 'request', or the url-path for anything else.
+        Called by BorrowDirectSession.request() """
+    path = urllib.parse.urlparse( url ).path
+    for known_path, name in ENDPOINT_PATHS.items():
+        if path.endswith( known_path ):
+            return name
+    return path
+
+
+def decode_json( r, metrics=None, endpoint=None, parse=None ):
+    """ Returns the response's decoded json -- parsed once, straight from the bytes, by loads_json(), or by `parse`, eg results.SearchResult.from_bytes() --
+          recording decoding time and any ErrorCode if metrics are enabled.
+        Called by Authenticator, Searcher, and Requester. """
+    parse = parse or loads_json
+    if not metrics:
+        return parse( r.content )
+    start_time = time.perf_counter()
+    result_dct = parse( r.content )
+    metrics.observe_decode( endpoint, time.perf_counter() - start_time, result_dct )
+    return result_dct
+
+
+def loads_json( content ):
+    """ Returns decoded json from response bytes, using the backend chosen by set_json_backend().
+        Called by decode_json(), AsyncBorrowDirect, and results.SearchResult/RequestResult.from_bytes() """
+    if json_backend is None:
+        set_json_backend( os.environ.get('BDPY3_JSON_BACKEND', 'auto') )
+    return json_backend( content )
+
+
+def set_json_backend( name='auto' ):
+    """ Selects the json decoder: 'orjson' (faster; `pip install bdpy3[fast]`), 'json' (standard-library), or 'auto' -- orjson if installed.
+        Called by loads_json() on first use (honoring the `BDPY3_JSON_BACKEND` environment-variable), or manually. """
+    global json_backend
+    assert name in ( 'auto', 'orjson', 'json' ), Exception( 'json backend must be `auto`, `orjson`, or `json`; current value is: %s' % name )
+    if name in ( 'auto', 'orjson' ):
+        try:
+            import orjson
+            json_backend = orjson.loads
+            return 'orjson'
+        except ImportError:
+            if name == 'orjson':
+                raise
+    json_backend = json.loads
+    return 'json'
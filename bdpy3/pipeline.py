@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+""" Staged search -> decide -> request pipeline, for ILL automation over many items.
+
+    Usage:
+        >>> bd = BorrowDirect( dict(settings, AUTH_CACHE_TTL=600) )  # the request stage then reuses the search stage's authorization-ids
+        >>> pipeline = Pipeline( bd, search_workers=8, request_workers=2 )
+        >>> for outcome in pipeline.run( items, patron_barcode ):
+        ...     print( outcome['item'], outcome['search_outcome'], outcome['request_number'] )
+        >>> pipeline.stats() """
+
+import logging, queue, threading, time
+from .search import DEFAULT_FORMATS, ERROR, HELD_LOCALLY, NOT_FOUND, classify_search_result
+
+
+log = logging.getLogger(__name__)
+
+_DONE = object()  # end-of-stage sentinel
+
+
+def request_unless_unavailable( item, search_result ):
+    """ Default decision: request unless the search shows the item held locally, not found, or errored -- as BorrowDirect.search_and_request_exact_item() does.
+        Called by Pipeline """
+    return classify_search_result( search_result ) not in ( HELD_LOCALLY, NOT_FOUND, ERROR )
+
+
+class Pipeline( object ):
+    """ Searches each item, passes the result to `decide( item, search_result )`, and requests the item if that returns True.
+        Each stage has its own worker-pool, fed by a bounded queue of `queue_size` (default twice the larger pool);
+          a slow stage, or a slow consumer of run(), fills the queue before it, which blocks the stage before that, back to reading `items` --
+          so memory stays flat however long the input.
+        Uses the BorrowDirect's stateless methods, so one instance serves every worker; without an auth-cache (AUTH_CACHE_TTL), every call authenticates.
+        Called manually. """
+
+    def __init__( self, bd, decide=request_unless_unavailable, search_workers=4, request_workers=2, queue_size=None ):
+        self.bd = bd
+        self.decide = decide
+        self.search_workers = search_workers
+        self.request_workers = request_workers
+        self.queue_size = queue_size or 2 * max( search_workers, request_workers )
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.queues = {}
+        self.live_workers = {}
+        self.counts = {}
+        self.start_time = None
+        if not bd.auth_cache:
+            log.warning( 'no auth-cache (AUTH_CACHE_TTL); every search and request will authenticate' )
+
+    def run( self, items, patron_barcode=None ):
+        """ Yields one outcome dct per item, in completion order; like BorrowDirect.search_and_request_exact_item()'s, plus `item`, and `error` if a call raised:
+                { 'item': ('ISBN', '9780688002305'), 'search_outcome': 'available', 'requested': True, 'request_number': 'BRO-12345678',
+                  'search_result': {...}, 'request_result': {...} }
+            Each item is either a ( search_type, search_value ) exact-item tuple or a ( title, author, year ) bib-item tuple, optionally followed by formats,
+              as for BorrowDirect.run_search_batch(), using `patron_barcode`; or a dct with the keys of a cli input-row -- `patron`, and `search_type` and `search_value`, or `title`, `author`, `year`, and optionally `formats`.
+            Stopping iteration early stops the workers. """
+        self.stop_event.clear()
+        self.queues = { name: queue.Queue(self.queue_size) for name in ('search', 'request', 'output') }
+        self.live_workers = { 'search': self.search_workers, 'request': self.request_workers }
+        self.counts = dict.fromkeys( ('fed', 'searched', 'search_errors', 'to_request', 'skipped', 'requested', 'request_errors', 'emitted'), 0 )
+        self.start_time = time.perf_counter()
+        threads = [ threading.Thread(target=self._feed, args=(items,), name='bdpy3-pipeline-feed') ]
+        threads += [ threading.Thread(target=self._search_stage, args=(patron_barcode,), name='bdpy3-pipeline-search-%s' % i) for i in range(self.search_workers) ]
+        threads += [ threading.Thread(target=self._request_stage, args=(patron_barcode,), name='bdpy3-pipeline-request-%s' % i) for i in range(self.request_workers) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                outcome = self._get( 'output' )
+                if outcome is _DONE:
+                    break
+                self._count( 'emitted' )
+                yield outcome
+        finally:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+        log.info( 'pipeline complete; stats, `%s`', self.stats() )
+
+    def stats( self ):
+        """ Returns per-stage counts, throughput, and queue-depths; may be called from another thread during run().
+            Called manually. """
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        with self.lock:
+            counts = dict( self.counts )
+        def per_second( count ):
+            return round( count / elapsed, 2 ) if elapsed else 0.0
+        def depth( name ):
+            return self.queues[name].qsize() if name in self.queues else 0
+        return {
+            'elapsed_seconds': round( elapsed, 3 ),
+            'fed': counts.get( 'fed', 0 ),
+            'search': {
+                'completed': counts.get('searched', 0), 'errors': counts.get('search_errors', 0), 'workers': self.search_workers,
+                'per_second': per_second( counts.get('searched', 0) + counts.get('search_errors', 0) ), 'queue_depth': depth('search') },
+            'decide': { 'request': counts.get('to_request', 0), 'skip': counts.get('skipped', 0) },
+            'request': {
+                'completed': counts.get('requested', 0), 'errors': counts.get('request_errors', 0), 'workers': self.request_workers,
+                'per_second': per_second( counts.get('requested', 0) + counts.get('request_errors', 0) ), 'queue_depth': depth('request') },
+            'output': { 'emitted': counts.get('emitted', 0), 'queue_depth': depth('output') },
+            }
+
+    def _feed( self, items ):
+        """ Reads items into the search queue, blocking while it is full; then ends the search stage.
+            Runs on the feeder thread. """
+        try:
+            for item in items:
+                if not self._put( 'search', item ):
+                    return
+                self._count( 'fed' )
+        except Exception as e:
+            log.warning( 'pipeline input failed, `%r`', e )
+            self._put( 'output', self._new_outcome(None, error=repr(e)) )
+        finally:
+            for i in range( self.search_workers ):
+                self._put( 'search', _DONE )
+        return
+
+    def _search_stage( self, patron_barcode ):
+        """ Searches items and decides; hands them on to the request stage, or straight to the output.
+            Runs on each search-worker thread. """
+        while True:
+            item = self._get( 'search' )
+            if item is _DONE:
+                break
+            outcome = self._new_outcome( item )
+            try:
+                ( patron, args ) = parse_item( item, patron_barcode )
+                search_result = self.bd.search_exact_item( patron, *args ) if len( args ) == 2 else self.bd.search_bib_item( patron, *args )
+                outcome.update( {'search_outcome': classify_search_result(search_result), 'search_result': search_result} )
+                wanted = self.decide( item, search_result )
+            except Exception as e:
+                log.warning( 'pipeline search, `%s`; exception, `%r`', item, e )
+                outcome['error'] = repr( e )
+                self._count( 'search_errors' )
+                self._put( 'output', outcome )
+                continue
+            self._count( 'searched' )
+            self._count( 'to_request' if wanted else 'skipped' )
+            self._put( 'request' if wanted else 'output', outcome )
+        self._end_stage( 'search', 'request', self.request_workers )
+        return
+
+    def _request_stage( self, patron_barcode ):
+        """ Requests items the decide function chose.
+            Runs on each request-worker thread. """
+        while True:
+            outcome = self._get( 'request' )
+            if outcome is _DONE:
+                break
+            item = outcome['item']
+            try:
+                ( patron, args ) = parse_item( item, patron_barcode )
+                request_result = self.bd.request_exact_item( patron, *args ) if len( args ) == 2 else self.bd.request_bib_item( patron, *args )
+            except Exception as e:
+                log.warning( 'pipeline request, `%s`; exception, `%r`', item, e )
+                outcome['error'] = repr( e )
+                self._count( 'request_errors' )
+            else:
+                outcome.update( {'requested': True, 'request_number': request_number(request_result), 'request_result': request_result} )
+                self._count( 'requested' )
+            self._put( 'output', outcome )
+        self._end_stage( 'request', 'output', 1 )
+        return
+
+    def _new_outcome( self, item, error=None ):
+        outcome = { 'item': item, 'search_outcome': None, 'requested': False, 'request_number': None, 'search_result': None, 'request_result': None }
+        if error:
+            outcome['error'] = error
+        return outcome
+
+    def _end_stage( self, stage, next_queue, sentinels ):
+        """ Counts a worker out; the stage's last worker ends the next stage.
+            Called by _search_stage() and _request_stage() """
+        with self.lock:
+            self.live_workers[stage] -= 1
+            last = self.live_workers[stage] == 0
+        if last:
+            for i in range( sentinels ):
+                self._put( next_queue, _DONE )
+        return
+
+    def _count( self, name ):
+        with self.lock:
+            self.counts[name] += 1
+        return
+
+    def _put( self, name, value ):
+        """ Puts value on the named queue, waiting while it is full; returns False, without putting, once the pipeline is stopped. """
+        while not self.stop_event.is_set():
+            try:
+                self.queues[name].put( value, timeout=0.1 )
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get( self, name ):
+        """ Returns the next value from the named queue, waiting while it is empty; returns _DONE once the pipeline is stopped. """
+        while not self.stop_event.is_set():
+            try:
+                return self.queues[name].get( timeout=0.1 )
+            except queue.Empty:
+                continue
+        return _DONE
+
+    ## end class Pipeline
+
+
+def parse_item( item, patron_barcode=None ):
+    """ Returns ( patron_barcode, args ): args is ( search_type, search_value ) for an exact-item, or ( title, author, year, formats ) for a bib-item.
+        Called by Pipeline """
+    if isinstance( item, dict ):
+        patron = item.get( 'patron' ) or item.get( 'patron_barcode' ) or patron_barcode
+        if item.get( 'search_type' ):
+            args = ( item['search_type'], item['search_value'] )
+        else:
+            args = ( item['title'], item.get('author', ''), item.get('year'), item.get('formats', DEFAULT_FORMATS) )
+    elif len( item ) == 2:
+        ( patron, args ) = ( patron_barcode, tuple(item) )
+    else:
+        ( patron, args ) = ( patron_barcode, (item[0], item[1], item[2], item[3] if len(item) > 3 else DEFAULT_FORMATS) )
+    if not patron:
+        raise ValueError( 'no patron for item, and no patron_barcode given' )
+    return ( patron, args )
+
+
+def request_number( request_result ):
+    """ Returns the request-number from a request result -- a dct, or a results.RequestResult with RESULT_FORMAT 'object' -- or None.
+        Called by Pipeline """
+    if isinstance( request_result, dict ):
+        return request_result.get( 'RequestNumber' )
+    return getattr( request_result, 'request_number', None )
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+""" Token-bucket rate-limiting of calls to the BorrowDirect webservices. """
+
+import json, logging, threading, time
+from .deadline import DeadlineExceeded
+
+try:
+    import fcntl
+except ImportError:  # non-posix; FileTokenBucket then only limits within this process
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket( object ):
+    """ Allows `rate` calls per second on average, with bursts of up to `burst` calls; shared safely across threads.
+        Called by BorrowDirectHelper.make_rate_limiter(); used by BorrowDirectSession.request() """
+
+    def __init__( self, rate, burst=1 ):
+        assert rate > 0, Exception( 'rate must be positive; current value is: %s' % rate )
+        self.rate = float( rate )
+        self.burst = max( 1, burst )
+        self.tokens = float( self.burst )
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve( self, max_wait=None ):
+        """ Takes a token, returning the seconds the caller must wait before using it.
+            Tokens may go negative; later callers then queue behind earlier ones.
+            If the wait would exceed `max_wait`, takes no token and returns None.
+            Called by acquire(), and by AsyncBorrowDirect, which awaits the wait rather than blocking. """
+        with self.lock:
+            now = time.monotonic()
+            ( tokens, wait ) = _take_token( self.tokens, now - self.updated, self.rate, self.burst )
+            if max_wait is not None and wait > max_wait:
+                return None
+            ( self.tokens, self.updated ) = ( tokens, now )
+        return wait
+
+    def acquire( self, deadline=None, phase=None ):
+        """ Blocks until a call is allowed; returns seconds waited.
+            With a deadline, raises DeadlineExceeded for `phase` at once, taking no token, if the wait would outlast the remaining budget.
+            Called by BorrowDirectSession.request() """
+        wait = self.reserve( max_wait=deadline.remaining() if deadline else None )
+        if wait is None:
+            log.warning( 'rate-limit wait would outlast the deadline in phase, `%s`', phase )
+            raise DeadlineExceeded( phase, deadline.seconds, deadline.seconds - deadline.remaining() )
+        if wait > 0:
+            log.debug( 'rate-limited; waiting `%.3f` seconds', wait )
+            time.sleep( wait )
+        return wait
+
+    ## end class TokenBucket
+
+
+class FileTokenBucket( TokenBucket ):
+    """ TokenBucket whose state lives in a file guarded by an exclusive file-lock, so several processes on one host share the budget.
+        Called by BorrowDirectHelper.make_rate_limiter() """
+
+    def __init__( self, rate, burst=1, path=None, clock=time.time ):
+        super( FileTokenBucket, self ).__init__( rate, burst )
+        self.path = path
+        self.clock = clock  # wall-clock, since monotonic clocks are not comparable across processes
+
+    def reserve( self, max_wait=None ):
+        """ Takes a token from the shared file-state, returning the seconds the caller must wait before using it;
+              or, if the wait would exceed `max_wait`, leaves the file-state as it was and returns None.
+            Called by TokenBucket.acquire() """
+        with self.lock:
+            with open( self.path, 'a+' ) as f:
+                if fcntl:
+                    fcntl.flock( f, fcntl.LOCK_EX )
+                try:
+                    f.seek( 0 )
+                    content = f.read()
+                    now = self.clock()
+                    try:
+                        state = json.loads( content )
+                        ( tokens, updated ) = ( state['tokens'], state['updated'] )
+                    except ( ValueError, KeyError, TypeError ):
+                        ( tokens, updated ) = ( float(self.burst), now )
+                    ( tokens, wait ) = _take_token( tokens, max(0, now - updated), self.rate, self.burst )
+                    if max_wait is not None and wait > max_wait:
+                        return None
+                    f.seek( 0 )
+                    f.truncate()
+                    f.write( json.dumps({'tokens': tokens, 'updated': now}) )
+                    f.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock( f, fcntl.LOCK_UN )
+        return wait
+
+    ## end class FileTokenBucket
+
+
+def _take_token( tokens, elapsed, rate, burst ):
+    """ Returns ( remaining_tokens, wait_seconds ) after refilling for `elapsed` seconds and taking one token.
+        Called by TokenBucket.reserve() and FileTokenBucket.reserve() """
+    tokens = min( float(burst), tokens + elapsed * rate ) - 1
+    wait = -tokens / rate if tokens < 0 else 0.0
+    return ( tokens, wait )
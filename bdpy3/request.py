@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import json, logging, pprint
-import requests
-from . import logger_setup
-from .auth import Authenticator
+import json, logging
+from .logger_setup import LazyBody, LazyJson, LazyPformat
+from .deadline import deadline_guard, timeout_for_phase
+from .metrics import decode_json
+from .auth import Authenticator, is_invalid_aid_response
+from .search import DEFAULT_FORMATS, VALID_SEARCH_TYPES, bib_result_filter, exact_search_pairs
 
 
 log = logging.getLogger(__name__)
-logger_setup.check_logger()
 
 
 class Requester( object ):
@@ -15,75 +16,125 @@ class Requester( object ):
         BorrowDirect 'RequestItem Web Service' docs: <http://borrowdirect.pbworks.com/w/page/90133541/RequestItem%20Web%20Service> (login required)
         Called by BorrowDirect.run_request_exact_item() """
 
-    def __init__( self ):
-        self.valid_search_types = [ 'ISBN', 'ISSN', 'LCCN', 'OCLC', 'PHRASE' ]
+    def __init__( self, auth_cache=None, session=None, timeout=90, result_parser=None ):
+        self.valid_search_types = list( VALID_SEARCH_TYPES )
+        self.auth_cache = auth_cache  # optional cache.AuthIdCache
+        if session is None:
+            from .cassette import default_session  # imports requests on first use, so `import bdpy3` stays cheap
+            session = default_session()  # the `requests` module, unless BDPY3_CASSETTE_PATH is set
+        self.session = session  # a session.BorrowDirectSession reuses pooled connections
+        self.metrics = getattr( session, 'metrics', None )
+        self.timeout = timeout  # seconds, or a ( connect, read ) tuple, per call; a `deadline` passed to a call caps it further
+        self.result_parser = result_parser  # optional callable building the result from response-bytes, eg results.RequestResult.from_bytes; default, the decoded dct
 
-    def request_exact_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, pickup_location, search_type, search_value ):
+    def request_exact_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, pickup_location, search_type, search_value, authorization_id=None, deadline=None ):
         """ Runs an 'ExactSearch' query.
             <https://relais.atlassian.net/wiki/spaces/ILL/pages/106608984/RequestItem#RequestItem-RequestItemrequestjson>
+            search_value may also be a list of several identifiers for the same work, sent in one call; see search.exact_search_pairs().
             Called by BorrowDirect.run_request_exact_item() """
         log.info( '\n\nstarting exact item request' )
         assert search_type in self.valid_search_types
-        authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code )
+        if not authorization_id:  # a caller may pass in an authorization_id it already holds
+            authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline )
         params = self.build_exact_search_params( partnership_id, pickup_location, search_type, search_value )
-        url = '%s/dws/item/add?aid=%s' % ( api_url_root, authorization_id )
-        headers = { 'Content-type': 'application/json' }
-        r = requests.post( url, data=json.dumps(params), headers=headers, timeout=90 )
-        log.debug( 'request r.url, `%s`' % r.url )
-        log.debug( 'request r.content, `%s`' % r.content.decode('utf-8') )
-        result_dct = r.json()
+        result_dct = self.post_request( api_url_root, authorization_id, params, deadline )
+        if self.auth_cache and is_invalid_aid_response( result_dct ):
+            self.invalidate_authorization_id( patron_barcode, api_url_root, partnership_id, university_code )
+            authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline )
+            result_dct = self.post_request( api_url_root, authorization_id, params, deadline )
         return result_dct
 
-    def request_bib_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, pickup_location, title, author, year ):
+    def request_bib_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, pickup_location, title, author, year, authorization_id=None, deadline=None, formats=DEFAULT_FORMATS ):
         """ Runs a 'BibSearch' query.
             <https://relais.atlassian.net/wiki/spaces/ILL/pages/106608984/RequestItem#RequestItem-RequestItemrequestjson>
-            Called by BorrowDirect.run_request_bib_item() """
+            `year` and `formats` may each be several values, or None to drop that filter; see search.bib_result_filter().
+            Called by BorrowDirect.request_bib_item() """
         log.info( '\n\nstarting bib item request' )
-        authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code )
-        params = self.build_bib_search_params( partnership_id, pickup_location, title, author, year )
-        url = '%s/dws/item/add?aid=%s' % ( api_url_root, authorization_id )
-        headers = { 'Content-type': 'application/json' }
-        r = requests.post( url, data=json.dumps(params), headers=headers, timeout=90 )
-        log.debug( 'request r.url, `%s`' % r.url )
-        log.debug( 'request r.content, `%s`' % r.content.decode('utf-8') )
-        result_dct = r.json()
+        if not authorization_id:  # a caller may pass in an authorization_id it already holds
+            authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline )
+        params = self.build_bib_search_params( partnership_id, pickup_location, title, author, year, formats )
+        result_dct = self.post_request( api_url_root, authorization_id, params, deadline )
+        if self.auth_cache and is_invalid_aid_response( result_dct ):
+            self.invalidate_authorization_id( patron_barcode, api_url_root, partnership_id, university_code )
+            authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline )
+            result_dct = self.post_request( api_url_root, authorization_id, params, deadline )
         return result_dct
 
-    def get_authorization_id( self, patron_barcode, api_url_root, api_key, partnership_id, university_code ):
+    def get_authorization_id( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline=None ):
         """ Obtains authorization_id.
             Called by request_exact_item()
             Note that only the authenticator webservice is called;
               the authorization webservice simply extends the same id's session time and so is not needed here. """
-        authr = Authenticator()
+        if self.auth_cache:
+            key = self.auth_cache.make_key( api_url_root, partnership_id, university_code, patron_barcode )
+            authorization_id = self.auth_cache.get( key )
+            if authorization_id:
+                log.debug( 'using cached authorization_id' )
+                return authorization_id
+        authr = Authenticator( session=self.session, timeout=self.timeout )
         authorization_id = authr.authenticate(
-            patron_barcode, api_url_root, api_key, partnership_id, university_code )
+            patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline.for_auth() if deadline else None )
+        if self.auth_cache:
+            self.auth_cache.set( key, authorization_id )
         return authorization_id
 
+    def invalidate_authorization_id( self, patron_barcode, api_url_root, partnership_id, university_code ):
+        """ Drops a cached authorization_id the server has rejected.
+            Called by request_exact_item() and request_bib_item() """
+        log.info( 'authorization_id rejected; re-authenticating' )
+        key = self.auth_cache.make_key( api_url_root, partnership_id, university_code, patron_barcode )
+        self.auth_cache.invalidate( key )
+        return
+
+    def post_request( self, api_url_root, authorization_id, params, deadline=None ):
+        """ Posts request json and returns result dct.
+            Called by request_exact_item() and request_bib_item() """
+        url = '%s/dws/item/add?aid=%s' % ( api_url_root, authorization_id )
+        headers = { 'Content-type': 'application/json' }
+        with deadline_guard( deadline, 'request' ):
+            r = self.session.post( url, data=json.dumps(params), headers=headers, timeout=timeout_for_phase(self.timeout, deadline, 'request') )
+        log.debug( 'request r.url, `%s`', r.url )
+        log.debug( 'request r.content, `%s`', LazyBody(r.content) )
+        result_dct = decode_json( r, self.metrics, 'request', self.result_parser )
+        return result_dct
+
     def build_exact_search_params( self, partnership_id, pickup_location, search_type, search_value ):
-        """ Builds request json.
+        """ Builds request json; see module-level build_exact_search_params().
             Called by request_exact_item() """
-        params = {
-            'PartnershipId': partnership_id,
-            'PickupLocation': pickup_location,
-            'Notes': '',
-            'ExactSearch': [ {'Type': search_type, 'Value': search_value } ]
-        }
-        log.debug( 'params, `%s`' % pprint.pformat(params) )
-        return params
-
-    def build_bib_search_params( self, partnership_id, pickup_location, title, author, year ):
-        """ Builds request json.
+        return build_exact_search_params( partnership_id, pickup_location, search_type, search_value, self.valid_search_types )
+
+    def build_bib_search_params( self, partnership_id, pickup_location, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Builds request json; see module-level build_bib_search_params().
             Called by request_bib_item() """
-        params = {
-            'PartnershipId': partnership_id,
-            'PickupLocation': pickup_location,
-            'BibSearch': { 'TitlePhrase': title, 'Author': author },
-            'ResultFilter': {
-                'Include': { 'PublicationDate': [year], 'Format': ['Book'] }
-            }
-        }
-        log.debug( 'params, ```%s```' % params )
-        log.debug( 'json would be, ```%s```' % json.dumps(params) )
-        return params
+        return build_bib_search_params( partnership_id, pickup_location, title, author, year, formats )
 
     ## end class Requester()
+
+
+def build_exact_search_params( partnership_id, pickup_location, search_type, search_value, valid_search_types=VALID_SEARCH_TYPES ):
+    """ Builds request json.
+        Called by Requester.build_exact_search_params() and AsyncBorrowDirect.run_request_exact_item() """
+    params = {
+        'PartnershipId': partnership_id,
+        'PickupLocation': pickup_location,
+        'Notes': '',
+        'ExactSearch': [ {'Type': item_type, 'Value': item_value } for ( item_type, item_value ) in exact_search_pairs( search_type, search_value, valid_search_types ) ]
+    }
+    log.debug( 'params, `%s`', LazyPformat(params) )
+    return params
+
+
+def build_bib_search_params( partnership_id, pickup_location, title, author, year, formats=DEFAULT_FORMATS ):
+    """ Builds request json.
+        Called by Requester.build_bib_search_params() and AsyncBorrowDirect.run_request_bib_item() """
+    params = {
+        'PartnershipId': partnership_id,
+        'PickupLocation': pickup_location,
+        'BibSearch': { 'TitlePhrase': title, 'Author': author },
+    }
+    result_filter = bib_result_filter( year, formats )
+    if result_filter:
+        params['ResultFilter'] = result_filter
+    log.debug( 'params, ```%s```', params )
+    log.debug( 'json would be, ```%s```', LazyJson(params) )
+    return params
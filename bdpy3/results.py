@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+""" Compact result objects, for callers keeping many results; opt in with the RESULT_FORMAT setting ('object').
+    Each is built once, straight from the response bytes where the response is not cached or shared; the raw dct is only kept if asked for,
+      and dropped fields trim large values, eg the multi-kilobyte ILLiad OpenURL in 'RequestLink.ButtonLink'. """
+
+import sys
+from .metrics import loads_json
+from .search import HELD_LOCALLY, NOT_FOUND, ERROR, classify_search_result
+
+
+class SearchResult( object ):
+    """ Parsed search response.
+        `outcome` is one of search.AVAILABLE, HELD_LOCALLY, UNAVAILABLE, NOT_FOUND, or ERROR;
+          `pickup_locations` is a tuple of ( code, description ) tuples; `raw` is the response dct if kept, otherwise None.
+        Called by BorrowDirect when RESULT_FORMAT is 'object', or manually. """
+
+    __slots__ = ( 'outcome', 'available', 'number_of_records', 'pickup_locations', 'request_message', 'request_url', 'problem_code', 'problem_message', 'raw' )
+
+    def __init__( self, outcome, available=None, number_of_records=None, pickup_locations=(), request_message=None, request_url=None, problem_code=None, problem_message=None, raw=None ):
+        self.outcome = outcome
+        self.available = available
+        self.number_of_records = number_of_records
+        self.pickup_locations = pickup_locations
+        self.request_message = request_message
+        self.request_url = request_url
+        self.problem_code = problem_code
+        self.problem_message = problem_message
+        self.raw = raw
+
+    @classmethod
+    def from_dict( cls, dct, keep_raw=False, outcome=None ):
+        """ Returns SearchResult for a decoded search response; `outcome` may be passed if already classified. """
+        ( problem, link ) = _problem_and_link( dct )
+        pickup_locations = tuple(
+            ( _intern(location.get('PickupLocationCode')), _intern(location.get('PickupLocationDescription')) )
+            for location in ( dct.get('PickupLocation') or [] if isinstance(dct, dict) else [] ) )
+        return cls(
+            outcome=outcome or classify_search_result( dct ),
+            available=dct.get( 'Available' ) if isinstance( dct, dict ) else None,
+            number_of_records=dct.get( 'OrigNumberOfRecords' ) if isinstance( dct, dict ) else None,
+            pickup_locations=pickup_locations,
+            request_message=_intern( link.get('RequestMessage') ),
+            request_url=link.get( 'ButtonLink' ),
+            problem_code=_intern( problem.get('ErrorCode') ),
+            problem_message=_intern( problem.get('ErrorMessage') ),
+            raw=dct if keep_raw else None )
+
+    @classmethod
+    def from_bytes( cls, content, keep_raw=False, drop=() ):
+        """ Returns SearchResult parsed straight from response-bytes, with the `drop` fields removed first.
+            Called by Searcher when RESULT_FORMAT is 'object' and there is no search-cache, or manually. """
+        return _from_bytes( content, 'search', drop, keep_raw )
+
+    @property
+    def held_locally( self ):
+        return self.outcome == HELD_LOCALLY
+
+    @property
+    def found( self ):
+        return self.outcome not in ( NOT_FOUND, ERROR )
+
+    def to_dict( self ):
+        """ Returns the parsed fields as a json-friendly dct; `raw` is included if kept. """
+        return _to_dict( self )
+
+    def __repr__( self ):
+        return '<SearchResult outcome=%r problem_code=%r>' % ( self.outcome, self.problem_code )
+
+    ## end class SearchResult
+
+
+class RequestResult( object ):
+    """ Parsed request response.
+        `request_number` is set when BorrowDirect accepted the request; otherwise `request_message`/`request_url` or `problem_code` say why not.
+        Called by BorrowDirect when RESULT_FORMAT is 'object', or manually. """
+
+    __slots__ = ( 'request_number', 'request_message', 'request_url', 'problem_code', 'problem_message', 'raw' )
+
+    def __init__( self, request_number=None, request_message=None, request_url=None, problem_code=None, problem_message=None, raw=None ):
+        self.request_number = request_number
+        self.request_message = request_message
+        self.request_url = request_url
+        self.problem_code = problem_code
+        self.problem_message = problem_message
+        self.raw = raw
+
+    @classmethod
+    def from_dict( cls, dct, keep_raw=False ):
+        """ Returns RequestResult for a decoded request response. """
+        ( problem, link ) = _problem_and_link( dct )
+        return cls(
+            request_number=dct.get( 'RequestNumber' ) if isinstance( dct, dict ) else None,
+            request_message=_intern( link.get('RequestMessage') ),
+            request_url=link.get( 'ButtonLink' ),
+            problem_code=_intern( problem.get('ErrorCode') ),
+            problem_message=_intern( problem.get('ErrorMessage') ),
+            raw=dct if keep_raw else None )
+
+    @classmethod
+    def from_bytes( cls, content, keep_raw=False, drop=() ):
+        """ Returns RequestResult parsed straight from response-bytes, with the `drop` fields removed first.
+            Called by Requester when RESULT_FORMAT is 'object', or manually. """
+        return _from_bytes( content, 'request', drop, keep_raw )
+
+    @property
+    def requested( self ):
+        return bool( self.request_number )
+
+    def to_dict( self ):
+        """ Returns the parsed fields as a json-friendly dct; `raw` is included if kept. """
+        return _to_dict( self )
+
+    def __repr__( self ):
+        return '<RequestResult request_number=%r problem_code=%r>' % ( self.request_number, self.problem_code )
+
+    ## end class RequestResult
+
+
+def format_result( dct, kind, result_format='dict', drop=(), keep_raw=False ):
+    """ Returns a decoded response as the caller configured: the dct itself (RESULT_FORMAT 'dict', the default), or a SearchResult/RequestResult ('object').
+        `kind` is 'search' or 'request'; `drop` fields (RESULT_DROP_FIELDS) are removed from a copy, leaving the caller's dct whole;
+          `keep_raw` (RESULT_KEEP_RAW) keeps the trimmed dct on the object. An already-built result, or None, is returned as is.
+        Called by BorrowDirect and AsyncBorrowDirect. """
+    if not isinstance( dct, dict ):
+        return dct
+    assert result_format in ( 'dict', 'object' ), Exception( 'RESULT_FORMAT must be `dict` or `object`; current value is: %s' % result_format )
+    outcome = classify_search_result( dct ) if kind == 'search' and result_format == 'object' else None  # before dropping fields it may depend on
+    dct = without_fields( dct, drop )
+    if result_format == 'dict':
+        return dct
+    if kind == 'search':
+        return SearchResult.from_dict( dct, keep_raw, outcome )
+    return RequestResult.from_dict( dct, keep_raw )
+
+
+def without_fields( dct, paths ):
+    """ Returns a copy of dct without the dotted `paths`; only the dcts along each path are copied, the rest is shared with dct, which is left unchanged.
+        Called by format_result() """
+    if not paths or not isinstance( dct, dict ):
+        return dct
+    dct = dict( dct )
+    for path in paths:
+        parts = path.split( '.' )
+        parent = dct
+        for part in parts[:-1]:
+            child = parent.get( part )
+            if not isinstance( child, dict ):
+                parent = None
+                break
+            parent[part] = dict( child )
+            parent = parent[part]
+        if parent is not None:
+            parent.pop( parts[-1], None )
+    return dct
+
+
+def drop_fields( dct, paths ):
+    """ Removes dotted `paths`, eg 'RequestLink.ButtonLink', from dct in place; returns dct.
+        Called by _from_bytes(), or manually. """
+    if not paths or not isinstance( dct, dict ):
+        return dct
+    for path in paths:
+        parts = path.split( '.' )
+        parent = dct
+        for part in parts[:-1]:
+            parent = parent.get( part ) if isinstance( parent, dict ) else None
+        if isinstance( parent, dict ):
+            parent.pop( parts[-1], None )
+    return dct
+
+
+def _from_bytes( content, kind, drop, keep_raw ):
+    """ Returns the SearchResult/RequestResult for response-bytes; the freshly decoded dct is trimmed in place, since nothing else holds it.
+        Called by SearchResult.from_bytes() and RequestResult.from_bytes() """
+    dct = loads_json( content )
+    if not isinstance( dct, dict ):
+        return dct
+    if kind == 'search':
+        outcome = classify_search_result( dct )  # before dropping fields it may depend on
+        return SearchResult.from_dict( drop_fields(dct, drop), keep_raw, outcome )
+    return RequestResult.from_dict( drop_fields(dct, drop), keep_raw )
+
+
+def _problem_and_link( dct ):
+    if not isinstance( dct, dict ):
+        return ( {}, {} )
+    return ( dct.get('Problem') or {}, dct.get('RequestLink') or {} )
+
+
+def _intern( value ):
+    """ Interns short repeated strings -- outcome messages, error-codes, location codes -- so millions of results share one copy. """
+    return sys.intern( value ) if isinstance( value, str ) and len( value ) <= 200 else value
+
+
+def _to_dct_value( value ):
+    return [ list(pair) for pair in value ] if isinstance( value, tuple ) else value
+
+
+def _to_dict( result ):
+    dct = { name: _to_dct_value(getattr(result, name)) for name in result.__slots__ if name != 'raw' }
+    if result.raw is not None:
+        dct['raw'] = result.raw
+    return dct
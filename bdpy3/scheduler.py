@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+""" Schedules BorrowDirect calls by priority-class, so bulk background work cannot starve interactive patron requests of the shared quota.
+
+    Usage:
+        >>> scheduler = Scheduler( bd, classes={'interactive': {'rank': 0, 'max_concurrency': 8}, 'bulk': {'rank': 1, 'max_concurrency': 4, 'max_queued': 100}} )
+        >>> scheduler.call( 'interactive', 'request_exact_item', patron_barcode, 'ISBN', '9780688002305' )  # blocks for the result
+        >>> futures = [ scheduler.submit('bulk', 'search_exact_item', 'reconciliation', 'ISBN', isbn) for isbn in isbns ]  # blocks while bulk's queue is full
+        >>> scheduler.stats() """
+
+import collections, concurrent.futures, logging, threading, time
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CLASSES = {
+    'interactive': { 'rank': 0, 'max_concurrency': 8 },
+    'bulk': { 'rank': 1, 'max_concurrency': 2 },
+    }
+
+METHODS = (  # BorrowDirect's stateless methods; each takes patron_barcode first
+    'auth_nz', 'search_exact_item', 'search_bib_item', 'request_exact_item', 'request_bib_item', 'search_and_request_exact_item', 'search_and_request_bib_item' )
+
+
+class Scheduler( object ):
+    """ Runs calls to a shared BorrowDirect's stateless methods on one worker-pool, in priority-class order.
+        Each class has a `rank` (lower runs first), a `max_concurrency`, and optionally a `max_queued`, beyond which submit() blocks.
+        The pool has one worker per unit of concurrency summed over the classes, so a class at its limit never holds another class's workers:
+          an interactive call starts at once, however many bulk calls are queued or running, while bulk still runs at its full concurrency.
+        Within a class, patrons take turns -- one patron's thousand queued calls delay another's next call by at most one call per patron.
+        Time spent queued does not count toward DEADLINE_SECONDS, which starts when a call runs.
+        Called manually. """
+
+    def __init__( self, bd, classes=None, wait_sample_size=1000 ):
+        self.bd = bd
+        self.condition = threading.Condition()
+        self.classes = {
+            name: PriorityClass(name, wait_sample_size=wait_sample_size, **config) for ( name, config ) in ( classes or DEFAULT_CLASSES ).items() }
+        self.ranked = sorted( self.classes.values(), key=lambda priority_class: priority_class.rank )
+        self.workers = sum( priority_class.max_concurrency for priority_class in self.ranked )
+        self.threads = []
+        self.closed = False
+
+    def submit( self, priority, method, *args, **kwargs ):
+        """ Queues `bd.<method>( *args, **kwargs )` in the named priority-class; returns a concurrent.futures.Future for its result.
+            `method` is one of METHODS; its first argument, patron_barcode, is the unit of fair queuing.
+            Blocks while the class holds `max_queued` calls; raises RuntimeError once closed.
+            Called manually. """
+        assert method in METHODS, Exception( 'method must be one of %s; current value is: %s' % (METHODS, method) )
+        priority_class = self.classes[priority]
+        future = concurrent.futures.Future()
+        task = _Task( future, method, args, kwargs )
+        with self.condition:
+            while not self.closed and priority_class.max_queued and priority_class.queued >= priority_class.max_queued:
+                self.condition.wait()
+            if self.closed:
+                raise RuntimeError( 'scheduler is closed' )
+            self._start_workers()
+            priority_class.push( args[0] if args else kwargs.get('patron_barcode'), task )
+            self.condition.notify_all()
+        return future
+
+    def call( self, priority, method, *args, **kwargs ):
+        """ Runs the call in the named priority-class; returns its result, or raises its exception.
+            Called manually. """
+        return self.submit( priority, method, *args, **kwargs ).result()
+
+    def stats( self ):
+        """ Returns per-class queued/active/completed/error counts, and p50/p95/p99 queue-wait milliseconds of recent calls.
+            Called manually. """
+        with self.condition:
+            return { 'workers': self.workers, 'classes': {name: priority_class.stats() for (name, priority_class) in self.classes.items()} }
+
+    def close( self, wait=True ):
+        """ Stops accepting calls; queued calls still run. With `wait`, returns once they have finished.
+            Called manually, or on leaving a `with Scheduler(...) as scheduler:` block. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            threads = list( self.threads )
+        if wait:
+            for thread in threads:
+                thread.join()
+        return
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+    def _start_workers( self ):
+        """ Starts the worker-pool on first use; caller holds condition.
+            Called by submit() """
+        if self.threads:
+            return
+        for i in range( self.workers ):
+            thread = threading.Thread( target=self._work, name='bdpy3-scheduler-%s' % i, daemon=True )
+            thread.start()
+            self.threads.append( thread )
+        return
+
+    def _next( self ):
+        """ Returns ( priority_class, task ) from the best-ranked class with queued calls and a free slot, or None; caller holds condition.
+            Called by _work() """
+        for priority_class in self.ranked:
+            if priority_class.queued and priority_class.active < priority_class.max_concurrency:
+                return ( priority_class, priority_class.pop() )
+        return None
+
+    def _work( self ):
+        """ Runs calls until closed and drained.
+            Runs on each worker thread. """
+        while True:
+            with self.condition:
+                picked = self._next()
+                while picked is None:
+                    if self.closed and not any( priority_class.queued for priority_class in self.ranked ):
+                        return
+                    self.condition.wait()
+                    picked = self._next()
+                ( priority_class, task ) = picked
+                priority_class.active += 1
+                self.condition.notify_all()  # a submit() may be waiting on the queue having room
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result( getattr(self.bd, task.method)(*task.args, **task.kwargs) )
+                    failed = False
+                except Exception as e:
+                    log.warning( 'scheduled `%s` call failed, `%r`', task.method, e )
+                    task.future.set_exception( e )
+                    failed = True
+            else:
+                failed = False  # cancelled while queued
+            with self.condition:
+                priority_class.finish( failed )
+                self.condition.notify_all()
+
+    ## end class Scheduler
+
+
+class PriorityClass( object ):
+    """ Queued calls of one priority-class, one queue per patron, served round-robin.
+        Called by Scheduler() """
+
+    def __init__( self, name, rank=0, max_concurrency=1, max_queued=None, wait_sample_size=1000 ):
+        assert max_concurrency > 0, Exception( 'max_concurrency must be positive; current value is: %s' % max_concurrency )
+        self.name = name
+        self.rank = rank
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.patrons = collections.OrderedDict()  # patron_barcode -> deque of tasks; the front patron goes next
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.waits = collections.deque( maxlen=wait_sample_size )  # seconds queued, of recent calls
+
+    def push( self, patron_barcode, task ):
+        """ Queues task behind the patron's earlier ones.
+            Called by Scheduler.submit() """
+        self.patrons.setdefault( patron_barcode, collections.deque() ).append( task )
+        self.queued += 1
+        return
+
+    def pop( self ):
+        """ Returns the front patron's oldest task, and sends that patron to the back.
+            Called by Scheduler._next() """
+        ( patron_barcode, tasks ) = next( iter(self.patrons.items()) )
+        task = tasks.popleft()
+        if tasks:
+            self.patrons.move_to_end( patron_barcode )
+        else:
+            del self.patrons[patron_barcode]
+        self.queued -= 1
+        self.waits.append( time.perf_counter() - task.queued_at )
+        return task
+
+    def finish( self, failed ):
+        """ Counts a call out.
+            Called by Scheduler._work() """
+        self.active -= 1
+        self.completed += 1
+        self.errors += failed
+        return
+
+    def stats( self ):
+        """ Returns counters dct.
+            Called by Scheduler.stats() """
+        waits = sorted( self.waits )
+        def percentile_ms( pct ):
+            return round( waits[min(len(waits) - 1, int(pct / 100.0 * len(waits)))] * 1000, 1 ) if waits else 0.0
+        return {
+            'rank': self.rank, 'max_concurrency': self.max_concurrency, 'queued': self.queued, 'patrons_queued': len(self.patrons),
+            'active': self.active, 'completed': self.completed, 'errors': self.errors,
+            'wait_p50_ms': percentile_ms( 50 ), 'wait_p95_ms': percentile_ms( 95 ), 'wait_p99_ms': percentile_ms( 99 ) }
+
+    ## end class PriorityClass
+
+
+class _Task( object ):
+    """ One queued call; see Scheduler. """
+
+    __slots__ = ( 'future', 'method', 'args', 'kwargs', 'queued_at' )
+
+    def __init__( self, future, method, args, kwargs ):
+        self.future = future
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = time.perf_counter()
+
+    ## end class _Task
@@ -1,83 +1,263 @@
 # -*- coding: utf-8 -*-
 
-import json, logging, os, pprint
-import requests
-from . import logger_setup
-from .auth import Authenticator
+import json, logging
+from .logger_setup import LazyBody, LazyPformat
+from .deadline import deadline_guard, timeout_for_phase
+from .metrics import decode_json
+from .auth import Authenticator, is_invalid_aid_response
 
 
 log = logging.getLogger(__name__)
-logger_setup.check_logger()
+
+## search-result outcomes; see classify_search_result()
+AVAILABLE = 'available'
+HELD_LOCALLY = 'held_locally'
+UNAVAILABLE = 'unavailable'
+NOT_FOUND = 'not_found'
+ERROR = 'error'
+NOT_FOUND_ERROR_CODES = ( 'PUBFI002', )
+
+DEFAULT_FORMATS = ( 'Book', )  # bib searches' and requests' 'Format' filter, unless `formats` is passed
+VALID_SEARCH_TYPES = ( 'ISBN', 'ISSN', 'LCCN', 'OCLC', 'PHRASE' )
 
 
 class Searcher( object ):
     """ Enables easy calls to the BorrowDirect search webservice.
         BorrowDirect 'FindIt Web Service' docs: <https://relais.atlassian.net/wiki/display/ILL/Find+Item>
-        Called by BorrowDirect.run_search() """
+        Called by BorrowDirect.make_searcher() """
 
-    def __init__( self ):
-        self.valid_search_types = [ 'ISBN', 'ISSN', 'LCCN', 'OCLC', 'PHRASE' ]
+    def __init__( self, auth_cache=None, session=None, result_cache=None, timeout=90, flights=None, result_parser=None ):
+        self.valid_search_types = list( VALID_SEARCH_TYPES )
+        self.auth_cache = auth_cache  # optional cache.AuthIdCache
+        self.result_cache = result_cache  # optional cache.SearchResultCache or cache.SqliteSearchCache
+        self.flights = flights  # optional singleflight.SingleFlight; concurrent identical searches then share one call
+        if session is None:
+            from .cassette import default_session  # imports requests on first use, so `import bdpy3` stays cheap
+            session = default_session()  # the `requests` module, unless BDPY3_CASSETTE_PATH is set
+        self.session = session  # a session.BorrowDirectSession reuses pooled connections
+        self.metrics = getattr( session, 'metrics', None )
+        self.timeout = timeout  # seconds, or a ( connect, read ) tuple, per call; a `deadline` passed to a call caps it further
+        self.result_parser = result_parser  # optional callable building the result from response-bytes, eg results.SearchResult.from_bytes; default, the decoded dct
 
-    def search_exact_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, search_type, search_value ):
+    def search_exact_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, search_type, search_value, authorization_id=None, deadline=None ):
         """ Searches for exact key-value.
-            Called by BorrowDirect.run_search_exact_item() """
+            search_value may also be a list of several identifiers for the same work, sent in one call; see exact_search_pairs().
+            Called by BorrowDirect.search_exact_item() """
         assert search_type in self.valid_search_types
-        authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code )
-        params = self.build_exact_item_params( patron_barcode, partnership_id, university_code, search_type, search_value )
-        url = '%s/dws/item/available?aid=%s' % ( api_url_root, authorization_id )
-        headers = { 'Content-type': 'application/json' }
-        r = requests.post( url, data=json.dumps(params), headers=headers, timeout=90 )
-        log.debug( 'search r.url, `%s`' % r.url )
-        log.debug( 'search r.content, `%s`' % r.content.decode('utf-8') )
-        result_dct = r.json()
-        return result_dct
+        if not ( self.result_cache or self.flights ):
+            params = self.build_exact_item_params( patron_barcode, partnership_id, university_code, search_type, search_value )
+            return self.run_search( patron_barcode, api_url_root, api_key, partnership_id, university_code, params, authorization_id, deadline )
+        from .cache import exact_search_key
+        key = exact_search_key( partnership_id, university_code, search_type, search_value )
+        return self.search_once(
+            key, api_url_root, deadline,
+            lambda aid: self.run_search( patron_barcode, api_url_root, api_key, partnership_id, university_code, self.build_exact_item_params(patron_barcode, partnership_id, university_code, search_type, search_value), aid or authorization_id, deadline ),
+            lambda: authorization_id or self.get_authorization_id(patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline) )
 
-    def search_bib_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, title, author, year ):
+    def search_bib_item( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, title, author, year, authorization_id=None, deadline=None, formats=DEFAULT_FORMATS ):
         """ Searches for bib item.
-            Called by BorrowDirect.run_search_bib_item() """
-        authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code )
-        params = self.build_bib_item_params( partnership_id, university_code, title, author, year )
-        url = '%s/dws/item/available?aid=%s' % ( api_url_root, authorization_id )
-        headers = { 'Content-type': 'application/json' }
-        r = requests.post( url, data=json.dumps(params), headers=headers, timeout=90 )
-        log.debug( 'search r.url, `%s`' % r.url )
-        log.debug( 'search r.content, `%s`' % r.content.decode('utf-8') )
-        result_dct = r.json()
+            `year` and `formats` may each be several values, or None to drop that filter; see bib_result_filter().
+            Called by BorrowDirect.search_bib_item() """
+        if not ( self.result_cache or self.flights ):
+            params = self.build_bib_item_params( partnership_id, university_code, title, author, year, formats )
+            return self.run_search( patron_barcode, api_url_root, api_key, partnership_id, university_code, params, authorization_id, deadline )
+        from .cache import bib_search_key
+        key = bib_search_key( partnership_id, university_code, title, author, year, formats )
+        return self.search_once(
+            key, api_url_root, deadline,
+            lambda aid: self.run_search( patron_barcode, api_url_root, api_key, partnership_id, university_code, self.build_bib_item_params(partnership_id, university_code, title, author, year, formats), aid or authorization_id, deadline ),
+            lambda: authorization_id or self.get_authorization_id(patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline) )
+
+    def search_once( self, key, api_url_root, deadline, search_func, authorize ):
+        """ Returns the cached result for key if there is one; otherwise joins an identical in-flight search, or runs search_func and caches its result.
+            `search_func` takes an authorization_id, or None to use the caller's or authenticate; `authorize` returns the caller's own authorization_id.
+            Before joining a flight, each caller authenticates as itself, so only the search is shared -- never another patron's authentication failure.
+            Called by search_exact_item() and search_bib_item() """
+        if self.result_cache:
+            result_dct = self.result_cache.get( key )
+            if result_dct is not None:
+                log.debug( 'using cached search result' )
+                return result_dct
+        if self.flights:
+            authorization_id = authorize()
+            result_dct = self.flights.do( (api_url_root,) + key, lambda: self.cache_result(key, search_func(authorization_id)), deadline )
+        else:
+            result_dct = self.cache_result( key, search_func(None) )
+        return result_dct
+
+    def cache_result( self, key, result_dct ):
+        """ Stores result_dct in the result-cache, if any, before any waiting identical searches are handed it; returns result_dct.
+            Called by search_once() """
+        if self.result_cache:
+            self.result_cache.set( key, result_dct )
+        return result_dct
+
+    def run_search( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, params, authorization_id=None, deadline=None ):
+        """ Posts the search, authenticating if no authorization_id is passed in; retries once with a fresh id if a cached one is rejected.
+            Called by search_exact_item(), search_bib_item(), and search_once() """
+        if not authorization_id:  # a caller may pass in an authorization_id it already holds
+            authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline )
+        result_dct = self.post_search( api_url_root, authorization_id, params, deadline )
+        if self.auth_cache and is_invalid_aid_response( result_dct ):
+            self.invalidate_authorization_id( patron_barcode, api_url_root, partnership_id, university_code )
+            authorization_id = self.get_authorization_id( patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline )
+            result_dct = self.post_search( api_url_root, authorization_id, params, deadline )
         return result_dct
 
-    def get_authorization_id( self, patron_barcode, api_url_root, api_key, partnership_id, university_code ):
+    def get_authorization_id( self, patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline=None ):
         """ Obtains authorization_id.
-            Called by search()
+            Called by run_search(), and by BorrowDirect._search_then_request()
             Note that only the authenticator webservice is called;
               the authorization webservice simply extends the same id's session time and so is not needed here. """
         log.debug( 'starting get_authorization_id()...' )
-        authr = Authenticator()
+        if self.auth_cache:
+            key = self.auth_cache.make_key( api_url_root, partnership_id, university_code, patron_barcode )
+            authorization_id = self.auth_cache.get( key )
+            if authorization_id:
+                log.debug( 'using cached authorization_id' )
+                return authorization_id
+        authr = Authenticator( session=self.session, timeout=self.timeout )
         authorization_id = authr.authenticate(
-            patron_barcode, api_url_root, api_key, partnership_id, university_code )
+            patron_barcode, api_url_root, api_key, partnership_id, university_code, deadline.for_auth() if deadline else None )
+        if self.auth_cache:
+            self.auth_cache.set( key, authorization_id )
         return authorization_id
 
+    def invalidate_authorization_id( self, patron_barcode, api_url_root, partnership_id, university_code ):
+        """ Drops a cached authorization_id the server has rejected.
+            Called by run_search() """
+        log.info( 'authorization_id rejected; re-authenticating' )
+        key = self.auth_cache.make_key( api_url_root, partnership_id, university_code, patron_barcode )
+        self.auth_cache.invalidate( key )
+        return
+
+    def post_search( self, api_url_root, authorization_id, params, deadline=None ):
+        """ Posts search json and returns result dct.
+            Called by run_search() """
+        url = '%s/dws/item/available?aid=%s' % ( api_url_root, authorization_id )
+        headers = { 'Content-type': 'application/json' }
+        with deadline_guard( deadline, 'search' ):
+            r = self.session.post( url, data=json.dumps(params), headers=headers, timeout=timeout_for_phase(self.timeout, deadline, 'search') )
+        log.debug( 'search r.url, `%s`', r.url )
+        log.debug( 'search r.content, `%s`', LazyBody(r.content) )
+        result_dct = decode_json( r, self.metrics, 'search', self.result_parser )
+        return result_dct
+
     def build_exact_item_params( self, patron_barcode, partnership_id, university_code, search_type, search_value ):
-        """ Builds search json.
-            Called by search() """
-        params = {
-            'PartnershipId': partnership_id,
-            'ExactSearch': [ {
-                'Type': search_type, 'Value': search_value } ]
-                }
-        log.debug( 'params, `%s`' % pprint.pformat(params) )
-        return params
-
-    def build_bib_item_params( self, partnership_id, university_code, title, author, year ):
-        """ Builds search json.
-            Called by search() """
-        params = {
-            'PartnershipId': partnership_id,
-            'BibSearch': { 'TitlePhrase': title, 'Author': author },
-            'ResultFilter': {
-                'Include': { 'PublicationDate': [year], 'Format': ['Book'] }
-            }
-        }
-        log.debug( 'params, `%s`' % pprint.pformat(params) )
-        return params
+        """ Builds search json; see module-level build_exact_item_params().
+            Called by search_exact_item() """
+        return build_exact_item_params( patron_barcode, partnership_id, university_code, search_type, search_value, self.valid_search_types )
+
+    def build_bib_item_params( self, partnership_id, university_code, title, author, year, formats=DEFAULT_FORMATS ):
+        """ Builds search json; see module-level build_bib_item_params().
+            Called by search_bib_item() """
+        return build_bib_item_params( partnership_id, university_code, title, author, year, formats )
 
     ## end class Searcher
+
+
+def build_exact_item_params( patron_barcode, partnership_id, university_code, search_type, search_value, valid_search_types=VALID_SEARCH_TYPES ):
+    """ Builds search json.
+        Called by Searcher.build_exact_item_params() and AsyncBorrowDirect.run_search_exact_item() """
+    params = {
+        'PartnershipId': partnership_id,
+        'ExactSearch': [ {
+            'Type': item_type, 'Value': item_value } for ( item_type, item_value ) in exact_search_pairs( search_type, search_value, valid_search_types ) ]
+            }
+    log.debug( 'params, `%s`', LazyPformat(params) )
+    return params
+
+
+def build_bib_item_params( partnership_id, university_code, title, author, year, formats=DEFAULT_FORMATS ):
+    """ Builds search json.
+        Called by Searcher.build_bib_item_params() and AsyncBorrowDirect.run_search_bib_item() """
+    params = {
+        'PartnershipId': partnership_id,
+        'BibSearch': { 'TitlePhrase': title, 'Author': author },
+    }
+    result_filter = bib_result_filter( year, formats )
+    if result_filter:
+        params['ResultFilter'] = result_filter
+    log.debug( 'params, `%s`', LazyPformat(params) )
+    return params
+
+
+def exact_search_pairs( search_type, search_value, valid_search_types=VALID_SEARCH_TYPES ):
+    """ Returns list of ( type, value ) tuples for the 'ExactSearch' list.
+        search_value may be a single value, or a list whose elements are either values of search_type,
+          or ( type, value ) tuples -- eg `[ '9780688002305', '0688002307', ('OCLC', '673595') ]`.
+        Called by build_exact_item_params(), request.build_exact_search_params(), and cache.exact_search_key() """
+    values = search_value if isinstance( search_value, (list, tuple) ) else [ search_value ]
+    assert values, Exception( 'at least one identifier is required' )
+    pairs = []
+    for value in values:
+        if isinstance( value, (list, tuple) ):  # search_type itself is checked by the search/request methods
+            assert value[0] in valid_search_types, Exception( 'invalid search type: %s' % value[0] )
+            pairs.append( tuple(value) )
+        else:
+            pairs.append( (search_type, value) )
+    return pairs
+
+
+def bib_result_filter( year, formats=DEFAULT_FORMATS ):
+    """ Returns the 'ResultFilter' dct for a bib search or request, or None if there is nothing to filter on.
+        `year` may be a single year, a list/tuple/set of years, or a range -- eg `range(1973, 1976)` -- all sent in one query; None, empty, or blank drops the date filter.
+        `formats` may be a single format or several, eg `{'Book', 'Musical Score'}`; None (or empty) drops the format filter.
+        Called by build_bib_item_params() and request.build_bib_search_params() """
+    include = {}
+    years = bib_years( year )
+    if years:
+        include['PublicationDate'] = years
+    formats = bib_formats( formats )
+    if formats:
+        include['Format'] = formats
+    return { 'Include': include } if include else None
+
+
+def bib_years( year ):
+    """ Returns list of years for the 'PublicationDate' filter, or None; see bib_result_filter().
+        Blank strings -- eg a csv row's empty year cell -- are no year, rather than a filter on a blank date.
+        Called by bib_result_filter() and cache.bib_search_key() """
+    if year is None:
+        return None
+    if isinstance( year, range ):
+        return [ str(y) for y in year ]
+    if isinstance( year, (set, frozenset) ):
+        years = sorted( (y for y in year if not _is_blank(y)), key=str )
+    elif isinstance( year, (list, tuple) ):
+        years = [ y for y in year if not _is_blank(y) ]
+    else:
+        years = [ year ] if not _is_blank( year ) else []
+    return years or None
+
+
+def _is_blank( value ):
+    return isinstance( value, str ) and not value.strip()
+
+
+def bib_formats( formats ):
+    """ Returns list of formats for the 'Format' filter, or None; see bib_result_filter().
+        Called by bib_result_filter() and cache.bib_search_key() """
+    if not formats:
+        return None
+    if isinstance( formats, str ):
+        return [ formats ]
+    return sorted( set(formats) ) if isinstance( formats, (set, frozenset) ) else list( formats )
+
+
+def classify_search_result( result_dct ):
+    """ Returns one of AVAILABLE, HELD_LOCALLY, UNAVAILABLE (typically an ILLiad fallback-link), NOT_FOUND, or ERROR.
+        See README 'possible responses' for the shapes.
+        Also accepts a results.SearchResult, returning its outcome.
+        Called by cache.SearchResultCache.set() """
+    if not isinstance( result_dct, dict ):
+        return getattr( result_dct, 'outcome', ERROR )
+    if 'Problem' in result_dct:
+        error_code = ( result_dct['Problem'] or {} ).get( 'ErrorCode' )
+        return NOT_FOUND if error_code in NOT_FOUND_ERROR_CODES else ERROR
+    if result_dct.get( 'Available' ) is True:
+        return AVAILABLE
+    if result_dct.get( 'Available' ) is False:
+        message = ( result_dct.get('RequestLink') or {} ).get( 'RequestMessage' ) or ''
+        return HELD_LOCALLY if 'available locally' in message.lower() else UNAVAILABLE
+    return ERROR
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+""" Pooled, keep-alive http session shared by Authenticator, Searcher, and Requester. """
+
+import logging, socket
+import requests
+from requests.adapters import HTTPAdapter
+from .deadline import current_deadline
+from .metrics import endpoint_name
+
+
+log = logging.getLogger(__name__)
+
+
+class BorrowDirectSession( requests.Session ):
+    """ requests.Session whose connection-pool size and keep-alive behavior are configurable.
+        Connections are reused across calls, so a long-running worker skips repeated tcp/tls handshakes.
+        If a rate_limiter is given, every call waits for it, so callers need no sleeps between calls;
+          a call made under a deadline raises DeadlineExceeded rather than wait past it.
+        If metrics are given, every call's latency, status, and any timeout are recorded per endpoint.
+        If a cassette (cassette.Cassette) is given, calls are recorded to it, or replayed from it without touching the network.
+        Called by BorrowDirectHelper.make_session(), and by cassette.default_session() """
+
+    def __init__( self, pool_connections=10, pool_maxsize=10, pool_block=False, max_retries=0, keep_alive=True, tcp_keepalive=False, rate_limiter=None, metrics=None, cassette=None ):
+        super( BorrowDirectSession, self ).__init__()
+        self.rate_limiter = rate_limiter  # optional ratelimit.TokenBucket
+        self.metrics = metrics  # optional metrics.Metrics
+        pool_kwargs = dict( tcp_keepalive=tcp_keepalive, pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block, max_retries=max_retries )
+        if cassette:
+            from .cassette import CassetteAdapter
+            adapter = CassetteAdapter( cassette, **pool_kwargs )
+        else:
+            adapter = PoolAdapter( **pool_kwargs )
+        self.mount( 'https://', adapter )
+        self.mount( 'http://', adapter )
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+        log.debug( 'session initialized; pool_connections, `%s`; pool_maxsize, `%s`; keep_alive, `%s`' % (pool_connections, pool_maxsize, keep_alive) )
+
+    def request( self, method, url, *args, **kwargs ):
+        """ Waits for the rate-limiter, if any -- no longer than the deadline of the phase being run allows -- then makes the call, recording metrics if enabled.
+            Called by requests.Session.get() and requests.Session.post() """
+        if self.rate_limiter:
+            ( deadline, phase ) = current_deadline()
+            self.rate_limiter.acquire( deadline=deadline, phase=phase )
+        if not self.metrics:
+            return super( BorrowDirectSession, self ).request( method, url, *args, **kwargs )
+        endpoint = endpoint_name( url )
+        start_time = self.metrics.start_call( endpoint )
+        try:
+            r = super( BorrowDirectSession, self ).request( method, url, *args, **kwargs )
+        except requests.exceptions.Timeout:
+            self.metrics.finish_call( endpoint, start_time, timed_out=True )
+            raise
+        except requests.exceptions.ConnectionError:
+            self.metrics.finish_call( endpoint, start_time, connection_error=True )
+            raise
+        except Exception:
+            self.metrics.finish_call( endpoint, start_time )
+            raise
+        self.metrics.finish_call( endpoint, start_time, status=r.status_code )
+        return r
+
+    ## end class BorrowDirectSession
+
+
+class PoolAdapter( HTTPAdapter ):
+    """ HTTPAdapter that can enable tcp keep-alive probes on pooled sockets, so idle connections survive firewalls/NAT.
+        Called by BorrowDirectSession() """
+
+    __attrs__ = HTTPAdapter.__attrs__ + [ 'tcp_keepalive' ]
+
+    def __init__( self, tcp_keepalive=False, **kwargs ):
+        self.tcp_keepalive = tcp_keepalive
+        super( PoolAdapter, self ).__init__( **kwargs )
+
+    def init_poolmanager( self, *args, **kwargs ):
+        """ Adds SO_KEEPALIVE to the default socket options if requested.
+            Called by HTTPAdapter.__init__() """
+        if self.tcp_keepalive:
+            from urllib3.connection import HTTPConnection
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [ (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) ]
+        return super( PoolAdapter, self ).init_poolmanager( *args, **kwargs )
+
+    ## end class PoolAdapter
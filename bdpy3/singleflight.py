@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+""" Coalesces identical concurrent calls -- eg the same ISBN searched by several patrons within the same second -- into one upstream call. """
+
+import copy, logging, threading
+from .deadline import DeadlineExceeded
+
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight( object ):
+    """ For threads: the first caller for a key runs the call; callers arriving while it is in flight wait, then get a copy of its result
+          (or its exception). Nothing is kept once the call completes -- see cache.SearchResultCache for that.
+        A waiter waits no longer than its own deadline; on running out it raises DeadlineExceeded for `phase`, while the call carries on for the others.
+          If instead the leader's own deadline cut the call off, each waiter runs the call itself, within its own deadline.
+        `calls` counts upstream calls made, `collapsed` counts callers that shared another's call.
+        Called by BorrowDirect.__init__(); used by Searcher.search_exact_item() and Searcher.search_bib_item() """
+
+    def __init__( self, phase='search' ):
+        self.phase = phase
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> _Flight, while in flight
+        self.calls = 0
+        self.collapsed = 0
+
+    def do( self, key, func, deadline=None ):
+        """ Returns func()'s result, running func only if no identical call is in flight.
+            Called by Searcher """
+        with self.lock:
+            flight = self.flights.get( key )
+            if flight is None:
+                flight = self.flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self.collapsed += 1
+                leader = False
+        if leader:
+            return self._lead( key, flight, func )
+        log.debug( 'joining in-flight call, `%s`', key )
+        if not flight.done.wait( deadline.remaining() if deadline else None ):
+            raise DeadlineExceeded( self.phase, deadline.seconds, deadline.seconds - deadline.remaining() )
+        if isinstance( flight.error, DeadlineExceeded ):
+            log.debug( 'in-flight call hit its caller\'s deadline; calling, `%s`', key )
+            return func()
+        if flight.error is not None:
+            raise flight.error
+        return copy.deepcopy( flight.result )
+
+    def stats( self ):
+        """ Returns counters dct.
+            Called manually. """
+        with self.lock:
+            return { 'calls': self.calls, 'collapsed': self.collapsed, 'in_flight': len(self.flights) }
+
+    def _lead( self, key, flight, func ):
+        """ Runs func, then hands waiters a private copy of the result, since the leader's caller may modify its own.
+            Called by do() """
+        try:
+            result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]  # later callers start a new call
+                waiters = flight.waiters
+            if flight.error is None and waiters:
+                flight.result = copy.deepcopy( result )
+            flight.done.set()
+        return result
+
+    ## end class SingleFlight
+
+
+class AsyncSingleFlight( object ):
+    """ For asyncio: as SingleFlight, but the call runs as its own task, so a caller being cancelled or timing out does not cancel it for the others.
+        As there, a caller whose shared call was cut off by another caller's deadline makes the call itself.
+        Called by AsyncBorrowDirect.__init__() """
+
+    def __init__( self, phase='search' ):
+        self.phase = phase
+        self.flights = {}  # key -> asyncio.Task, while in flight
+        self.calls = 0
+        self.collapsed = 0
+
+    async def do( self, key, coroutine_func, deadline=None ):
+        """ Returns the awaited result of coroutine_func(), calling it only if no identical call is in flight.
+            Called by AsyncBorrowDirect._search_with_cache() """
+        import asyncio
+        task = self.flights.get( key )
+        leader = task is None
+        if leader:
+            task = self.flights[key] = asyncio.ensure_future( coroutine_func() )
+            task.add_done_callback( lambda t: self._done(key, t) )
+            self.calls += 1
+        else:
+            log.debug( 'joining in-flight call, `%s`', key )
+            self.collapsed += 1
+        try:
+            result = await asyncio.wait_for( asyncio.shield(task), deadline.remaining() if deadline else None )
+        except DeadlineExceeded:
+            if leader:
+                raise
+            log.debug( 'in-flight call hit its caller\'s deadline; calling, `%s`', key )
+            return await coroutine_func()
+        except asyncio.TimeoutError:
+            if task.done():  # the call's own timeout, not this caller's wait
+                raise
+            raise DeadlineExceeded( self.phase, deadline.seconds, deadline.seconds - deadline.remaining() )
+        return copy.deepcopy( result )  # the task's result is shared by every caller
+
+    def stats( self ):
+        """ Returns counters dct.
+            Called manually. """
+        return { 'calls': self.calls, 'collapsed': self.collapsed, 'in_flight': len(self.flights) }
+
+    def _done( self, key, task ):
+        """ Forgets the finished call; retrieves its exception so one no caller waited for is not reported as never retrieved.
+            Called when the task completes. """
+        if self.flights.get( key ) is task:
+            del self.flights[key]
+        if not task.cancelled():
+            task.exception()
+        return
+
+    ## end class AsyncSingleFlight
+
+
+class _Flight( object ):
+    """ One in-flight call; see SingleFlight. """
+
+    __slots__ = ( 'done', 'result', 'error', 'waiters' )
+
+    def __init__( self ):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+    ## end class _Flight
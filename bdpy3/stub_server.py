@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+""" Local stand-in for the BorrowDirect webservices, for offline tests and benchmarks.
+
+    Emulates the authentication, authorization, search (`/dws/item/available`), and request (`/dws/item/add`) webservices,
+      returning the response shapes shown in the README, with configurable latency and error-injection.
+
+    Usage:
+        >>> with StubServer( latency=0.05 ) as stub:
+        ...     bd = BorrowDirect( {'API_URL_ROOT': stub.url, 'PARTNERSHIP_ID': 'BD', 'PICKUP_LOCATION': 'A'} )
+        ...     bd.run_search_exact_item( '1234', 'ISBN', stub.ISBN_AVAILABLE )
+
+    Or from the command-line:
+        $ python -m bdpy3.stub_server --port 8000 --latency 0.05 --error-rate 0.01 """
+
+import argparse, http.server, itertools, json, logging, random, string, threading, time, urllib.parse
+from . import logger_setup
+
+
+log = logging.getLogger(__name__)
+
+
+class StubServer( object ):
+    """ Threaded http server emulating the BorrowDirect webservices.
+        `latency`: seconds added to every response; `latency_jitter`: extra random seconds, up to this value.
+        `error_rate`: fraction of calls answered with http `error_status` and a non-json body.
+        `aid_ttl`: seconds after which an authorization-id is rejected with a 'PUBAN003' problem (default None, never).
+        `catalog`: dct of { identifier-or-lowercased-title: outcome }, outcome being 'available', 'unavailable', or 'held_locally';
+          anything not in the catalog is not found.
+        `publication_years`: dct of { lowercased-title: year }; a bib search filtered on other years does not find that title.
+        `counts` tallies calls per endpoint. """
+
+    ISBN_AVAILABLE = '9780688002305'
+    ISBN_UNAVAILABLE = '9780231144063'
+    ISBN_HELD_LOCALLY = '9780060958329'
+    ISBN_NOT_FOUND = '9780000000000'
+    TITLE_AVAILABLE = 'zen and the art of motorcycle maintenance - an inquiry into values'
+
+    def __init__( self, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0, error_status=500, aid_ttl=None, catalog=None, seed=None, publication_years=None ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.aid_ttl = aid_ttl
+        self.catalog = catalog if catalog is not None else {
+            self.ISBN_AVAILABLE: 'available', self.ISBN_UNAVAILABLE: 'unavailable', self.ISBN_HELD_LOCALLY: 'held_locally',
+            self.TITLE_AVAILABLE: 'available' }
+        self.publication_years = publication_years if publication_years is not None else { self.TITLE_AVAILABLE: '1974' }
+        self.random = random.Random( seed )
+        self.aids = {}  # aid -> issued-at
+        self.counts = { 'authentication': 0, 'authorization': 0, 'search': 0, 'request': 0, 'error': 0 }
+        self.request_numbers = itertools.count( 1 )
+        self.lock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer( (host, port), _make_handler(self) )
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url( self ):
+        """ Returns API_URL_ROOT for this server. """
+        ( host, port ) = self.httpd.server_address[:2]
+        return 'http://%s:%s' % ( host, port )
+
+    def start( self ):
+        """ Serves in a background thread.
+            Called manually, or on entering a `with StubServer() as stub:` block. """
+        self.thread = threading.Thread( target=self.httpd.serve_forever, daemon=True )
+        self.thread.start()
+        log.debug( 'stub server started at, `%s`' % self.url )
+        return self
+
+    def stop( self ):
+        """ Stops serving and closes the socket.
+            Called manually, or on leaving a `with StubServer() as stub:` block. """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return
+
+    def __enter__( self ):
+        return self.start()
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.stop()
+        return False
+
+    def handle( self, method, path, query, body ):
+        """ Returns ( http-status, response-body-bytes ) for a call.
+            Called by the request-handler. """
+        delay = self.latency + ( self.random.uniform(0, self.latency_jitter) if self.latency_jitter else 0 )
+        if delay:
+            time.sleep( delay )
+        with self.lock:
+            inject_error = self.error_rate and self.random.random() < self.error_rate
+            if inject_error:
+                self.counts['error'] += 1
+        if inject_error:
+            return ( self.error_status, b'stub server: injected error' )
+        if method == 'POST' and path == '/portal-service/user/authentication':
+            return ( 200, self._dump(self._authenticate()) )
+        if method == 'GET' and path == '/portal-service/user/authz/isAuthorized':
+            return ( 200, self._dump(self._authorize(query.get('aid'))) )
+        if method == 'POST' and path in ( '/dws/item/available', '/dws/item/add' ):
+            kind = 'search' if path == '/dws/item/available' else 'request'
+            with self.lock:
+                self.counts[kind] += 1
+            if not self._aid_valid( query.get('aid') ):
+                return ( 200, self._dump({'Problem': {'ErrorCode': 'PUBAN003', 'ErrorMessage': 'Authorization id is not valid'}}) )
+            outcome = self._lookup( json.loads(body.decode('utf-8')) )
+            return ( 200, self._dump(self._search_response(outcome) if kind == 'search' else self._request_response(outcome)) )
+        return ( 404, b'stub server: not found' )
+
+    def _authenticate( self ):
+        aid = ''.join( self.random.choice(string.ascii_letters + string.digits) for i in range(27) )
+        with self.lock:
+            self.counts['authentication'] += 1
+            self.aids[aid] = time.time()
+        return { 'AuthorizationId': aid }
+
+    def _authorize( self, aid ):
+        with self.lock:
+            self.counts['authorization'] += 1
+            valid = self._aid_valid( aid )
+            if valid:
+                self.aids[aid] = time.time()  # authorization extends the session
+        return { 'AuthorizationState': {'State': valid} }
+
+    def _aid_valid( self, aid ):
+        issued = self.aids.get( aid )
+        if issued is None:
+            return False
+        return self.aid_ttl is None or time.time() - issued < self.aid_ttl
+
+    def _lookup( self, params ):
+        """ Returns outcome of the first catalog match among the params' identifiers or title. """
+        keys = [ str(dct.get('Value')) for dct in params.get('ExactSearch', []) ]
+        if 'BibSearch' in params:
+            title = str( params['BibSearch'].get('TitlePhrase', '') ).lower()
+            years = params.get( 'ResultFilter', {} ).get( 'Include', {} ).get( 'PublicationDate' )
+            if not years or title not in self.publication_years or self.publication_years[title] in [ str(year) for year in years ]:
+                keys.append( title )
+        for key in keys:
+            if key in self.catalog:
+                return self.catalog[key]
+        return 'not_found'
+
+    def _search_response( self, outcome ):
+        if outcome == 'available':
+            return {
+                'Available': True, 'OrigNumberOfRecords': 1,
+                'PickupLocation': [ {'PickupLocationCode': 'A', 'PickupLocationDescription': 'Rockefeller Library'} ],
+                'RequestLink': { 'ButtonLabel': 'Request', 'ButtonLink': 'AddRequest', 'RequestMessage': 'Request this through Borrow Direct.' } }
+        if outcome in ( 'unavailable', 'held_locally' ):
+            return { 'Available': False, 'OrigNumberOfRecords': 1, 'RequestLink': _request_link(outcome) }
+        return { 'Problem': {'ErrorCode': 'PUBFI002', 'ErrorMessage': 'No result'} }
+
+    def _request_response( self, outcome ):
+        if outcome == 'available':
+            with self.lock:
+                number = next( self.request_numbers )
+            return { 'RequestNumber': 'BRO-%08d' % number }
+        if outcome in ( 'unavailable', 'held_locally' ):
+            return { 'RequestLink': _request_link(outcome) }
+        return { 'Problem': {'ErrorCode': 'PUBRI003', 'ErrorMessage': 'No result'} }
+
+    def _dump( self, dct ):
+        return json.dumps( dct ).encode( 'utf-8' )
+
+    ## end class StubServer
+
+
+def _request_link( outcome ):
+    """ Returns the 'RequestLink' dct for an unavailable or held-locally item.
+        Called by StubServer """
+    if outcome == 'held_locally':
+        return {
+            'ButtonLabel': 'View in the BROWN Library Catalog.',
+            'ButtonLink': 'http://josiah.brown.edu/record=.b18151139a',
+            'RequestMessage': 'This item is available locally.' }
+    return {
+        'ButtonLabel': 'Request',
+        'ButtonLink': 'https://illiad.example.edu/illiad/illiad.dll/OpenURL?genre=Book&sid=BD&HeldLocally=N',
+        'RequestMessage': 'Place an interlibrary loan request via ILLiad.' }
+
+
+def _make_handler( stub ):
+    """ Returns a request-handler class bound to the stub.
+        Called by StubServer.__init__() """
+
+    class Handler( http.server.BaseHTTPRequestHandler ):
+
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real service
+        disable_nagle_algorithm = True  # headers and body are written separately; avoids delayed-ack stalls on kept-alive connections
+
+        def do_GET( self ):
+            self._respond( 'GET' )
+
+        def do_POST( self ):
+            self._respond( 'POST' )
+
+        def _respond( self, method ):
+            parsed = urllib.parse.urlparse( self.path )
+            query = dict( urllib.parse.parse_qsl(parsed.query) )
+            length = int( self.headers.get('Content-Length') or 0 )
+            body = self.rfile.read( length ) if length else b''
+            ( status, content ) = stub.handle( method, parsed.path, query, body )
+            self.send_response( status )
+            self.send_header( 'Content-Type', 'application/json' if status == 200 else 'text/plain' )
+            self.send_header( 'Content-Length', str(len(content)) )
+            self.end_headers()
+            self.wfile.write( content )
+
+        def log_message( self, format, *args ):
+            log.debug( 'stub server; ' + format % args )
+
+    return Handler
+
+
+if __name__ == '__main__':
+    logger_setup.check_logger()
+    parser = argparse.ArgumentParser( description='Serves a local stand-in for the BorrowDirect webservices.' )
+    parser.add_argument( '--host', default='127.0.0.1' )
+    parser.add_argument( '--port', type=int, default=8000 )
+    parser.add_argument( '--latency', type=float, default=0.0, help='seconds added to every response' )
+    parser.add_argument( '--latency-jitter', type=float, default=0.0, help='extra random seconds, up to this value' )
+    parser.add_argument( '--error-rate', type=float, default=0.0, help='fraction of calls answered with an http error' )
+    parser.add_argument( '--aid-ttl', type=float, default=None, help='seconds before an authorization-id is rejected' )
+    args = parser.parse_args()
+    stub = StubServer(
+        host=args.host, port=args.port, latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate, aid_ttl=args.aid_ttl )
+    print( 'serving at %s; ctrl-c to stop' % stub.url )
+    try:
+        stub.httpd.serve_forever()
+    except KeyboardInterrupt:
+        stub.httpd.server_close()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+""" Serves several libraries -- each its own API_KEY, PARTNERSHIP_ID, UNIVERSITY_CODE, and PICKUP_LOCATION -- from one process.
+
+    Usage:
+        >>> registry = TenantRegistry(
+        ...     tenants={ 'brown': {'API_KEY': '...', 'UNIVERSITY_CODE': 'BROWN', 'PICKUP_LOCATION': 'Rockefeller Library'},
+        ...               'yale': {'API_KEY': '...', 'UNIVERSITY_CODE': 'YALE', 'PICKUP_LOCATION': 'Sterling'} },
+        ...     shared_settings={'API_URL_ROOT': 'https://...', 'PARTNERSHIP_ID': 'BD', 'AUTH_CACHE_TTL': 600, 'SEARCH_CACHE_MAX_ENTRIES': 10000} )
+        >>> registry['yale'].search_exact_item( patron_barcode, 'ISBN', '9780688002305' ) """
+
+import logging, os, threading, types
+from .borrowdirect import BorrowDirect, BorrowDirectHelper
+
+
+log = logging.getLogger(__name__)
+
+PER_TENANT_PATH_SETTINGS = ( 'AUTH_CACHE_PATH', 'RATE_LIMIT_PATH' )  # file-backed state that must not be shared between tenants
+
+
+class TenantRegistry( object ):
+    """ Holds one BorrowDirect per tenant, built on first use from `shared_settings` overlaid with the tenant's own settings.
+        Per tenant, since BorrowDirect builds them from its settings: the connection pool, the auth-id cache, and the rate-limit budget --
+          so one tenant's burst cannot use up another's connections or tokens.
+          An AUTH_CACHE_PATH or RATE_LIMIT_PATH in `shared_settings` is suffixed with each tenant's name, eg `/var/bdpy3/rate.json` -> `/var/bdpy3/rate.yale.json`;
+          a path in the tenant's own settings is used as given.
+        Shared by all tenants: logging config; the search-result cache, whose keys include partnership and university code;
+          and metrics. Each is built once from `shared_settings` (eg SEARCH_CACHE_MAX_ENTRIES, METRICS_ENABLED), or may be passed in;
+          if neither, each tenant builds its own from its settings.
+        Thread-safe; share the tenants' BorrowDirects via their stateless methods, eg `registry[name].search_exact_item(...)`.
+        Called manually. """
+
+    def __init__( self, tenants=None, shared_settings=None, search_cache=None, metrics=None, logger=None ):
+        """ `tenants` is a dct of tenant-name -> settings, each as accepted by BorrowDirect(); more may be add()ed later. """
+        bdh = BorrowDirectHelper()
+        self.shared_settings = bdh.normalize_settings( shared_settings )
+        shared = types.SimpleNamespace( **dict(dict(BorrowDirectHelper.SETTINGS_DEFAULTS), **self.shared_settings) )
+        self.search_cache = search_cache if search_cache is not None else bdh.make_search_cache( shared )
+        self.metrics = metrics if metrics is not None else bdh.make_metrics( shared )
+        self.logger = logger
+        self.tenant_settings = {}  # name -> normalized settings
+        self.clients = {}  # name -> BorrowDirect, once built
+        self.lock = threading.Lock()
+        for ( name, settings ) in ( tenants or {} ).items():
+            self.add( name, settings )
+
+    def add( self, name, settings ):
+        """ Registers a tenant; replaces, and closes, an existing tenant of the same name.
+            Called by __init__(), or manually. """
+        own_settings = BorrowDirectHelper().normalize_settings( settings )
+        tenant_settings = dict( self.shared_settings, **own_settings )
+        for setting in PER_TENANT_PATH_SETTINGS:
+            if self.shared_settings.get( setting ) and setting not in own_settings:
+                tenant_settings[setting] = tenant_path( self.shared_settings[setting], name )
+        with self.lock:
+            self.tenant_settings[name] = tenant_settings
+            client = self.clients.pop( name, None )
+        if client:
+            client.close()
+        log.debug( 'registered tenant, `%s`', name )
+        return
+
+    def remove( self, name ):
+        """ Unregisters a tenant, closing its connections.
+            Called manually. """
+        with self.lock:
+            self.tenant_settings.pop( name )
+            client = self.clients.pop( name, None )
+        if client:
+            client.close()
+        return
+
+    def get( self, name ):
+        """ Returns the tenant's BorrowDirect, building it on first use; raises KeyError for an unregistered tenant.
+            Called manually, or via `registry[name]`. """
+        client = self.clients.get( name )
+        if client:
+            return client
+        with self.lock:
+            if name not in self.clients:
+                if name not in self.tenant_settings:
+                    raise KeyError( 'no tenant named `%s`; registered tenants: %s' % (name, sorted(self.tenant_settings)) )
+                self.clients[name] = BorrowDirect(
+                    self.tenant_settings[name], logger=self.logger, search_cache=self.search_cache, metrics=self.metrics )
+                log.debug( 'built client for tenant, `%s`', name )
+            return self.clients[name]
+
+    def names( self ):
+        """ Returns sorted list of registered tenant-names.
+            Called manually. """
+        with self.lock:
+            return sorted( self.tenant_settings )
+
+    def close( self ):
+        """ Closes every tenant's pooled connections; tenants stay registered, and are rebuilt on next use.
+            Called manually, or on leaving a `with TenantRegistry(...) as registry:` block. """
+        with self.lock:
+            ( clients, self.clients ) = ( list(self.clients.values()), {} )
+        for client in clients:
+            client.close()
+        return
+
+    def __getitem__( self, name ):
+        return self.get( name )
+
+    def __contains__( self, name ):
+        return name in self.tenant_settings
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+    ## end class TenantRegistry
+
+
+def tenant_path( path, name ):
+    """ Returns path with the tenant-name inserted before its extension, eg `/var/bdpy3/rate.json` -> `/var/bdpy3/rate.yale.json`.
+        Called by TenantRegistry.add() """
+    ( root, extension ) = os.path.splitext( path )
+    return '%s.%s%s' % ( root, name, extension )
@@ -8,4 +8,5 @@ setup(
     version='0.11',
     packages=find_packages(),
     install_requires=[ 'requests==2.18.4' ],
+    extras_require={ 'async': [ 'aiohttp' ], 'fast': [ 'orjson' ] },
 )
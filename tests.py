@@ -1,13 +1,44 @@
 # -*- coding: utf-8 -*-
 
-import imp, logging, pprint, os, time, unittest
-from bdpy3 import BorrowDirect, logger_setup
+import asyncio, concurrent.futures, io, json, logging, logging.handlers, pprint, os, subprocess, sys, tempfile, textwrap, threading, time, types, unittest
+import requests
+from bdpy3 import AsyncBorrowDirect, BorrowDirect, batch, cli, logger_setup
 from bdpy3.auth import Authenticator
-from bdpy3.search import Searcher
+from bdpy3.cache import AuthIdCache, SearchResultCache, SqliteSearchCache
+from bdpy3.cassette import CassetteMiss, open_cassette
+from bdpy3.deadline import Deadline, DeadlineExceeded
+from bdpy3.journal import Journal
+from bdpy3.keepalive import AuthKeepAlive
+from bdpy3.metrics import Metrics
+from bdpy3.pipeline import Pipeline
+from bdpy3.ratelimit import FileTokenBucket, TokenBucket
+from bdpy3.scheduler import Scheduler
+from bdpy3.search import Searcher, classify_search_result
+from bdpy3.session import BorrowDirectSession
+from bdpy3.singleflight import SingleFlight
+from bdpy3.stub_server import StubServer
+from bdpy3.tenants import TenantRegistry
 from bdpy3.request import Requester
+from bdpy3.results import RequestResult, SearchResult, format_result
+from bdpy3 import metrics
 
 
-SLEEP_SECONDS = 2  # being nice
+## The BorrowDirectTests, AuthenticatorTests, SearcherTests, and RequesterTests call the webservices.
+## With BDPY3_TEST__API_KEY set, they call the real ones, reading their settings from the BDPY3_TEST__ environment-variables;
+##   with BDPY3_CASSETTE_PATH set, they record to, or replay from, that cassette (see bdpy3.cassette);
+##   otherwise they replay the committed cassette, recorded against the stub server by `python ./utils/record_test_cassette.py`.
+LIVE_CASSETTE_PATH = os.path.join( os.path.dirname(os.path.abspath(__file__)), 'cassettes', 'live_tests.json' )
+REPLAY_TEST_ENV = {
+    'BDPY3_TEST__LOG_PATH': '', 'BDPY3_TEST__PATRON_BARCODE': '1234567890', 'BDPY3_TEST__API_URL_ROOT': 'http://replay.invalid',
+    'BDPY3_TEST__API_KEY': 'replay', 'BDPY3_TEST__UNIVERSITY_CODE': 'BROWN', 'BDPY3_TEST__PARTNERSHIP_ID': 'BD', 'BDPY3_TEST__PICKUP_LOCATION': 'Rockefeller Library',
+    'BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE': StubServer.ISBN_AVAILABLE, 'BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE': StubServer.ISBN_UNAVAILABLE,
+    'BDPY3_TEST__ISBN_NOT_FOUND': StubServer.ISBN_NOT_FOUND }
+REPLAYING = 'BDPY3_TEST__API_KEY' not in os.environ and 'BDPY3_CASSETTE_PATH' not in os.environ
+LIVE_ENV = REPLAY_TEST_ENV if REPLAYING else os.environ
+LIVE_SESSION = BorrowDirectSession( cassette=open_cassette(LIVE_CASSETTE_PATH) ) if REPLAYING else None  # None: the default session
+LIVE_SETTINGS = { 'HTTP_CASSETTE_PATH': LIVE_CASSETTE_PATH } if REPLAYING else {}
+
+SLEEP_SECONDS = float( os.environ.get('BDPY3_TEST__SLEEP_SECONDS', '0' if REPLAYING else '2') )  # being nice to the real webservices
 
 log = logging.getLogger(__name__)
 logger_setup.check_logger()
@@ -17,15 +48,15 @@ class BorrowDirectTests( unittest.TestCase ):
 
     def setUp(self):
         time.sleep( SLEEP_SECONDS )
-        self.patron_barcode = os.environ['BDPY3_TEST__PATRON_BARCODE']
-        self.api_url_root = os.environ['BDPY3_TEST__API_URL_ROOT']
-        self.api_key = os.environ['BDPY3_TEST__API_KEY']
-        self.university_code = os.environ['BDPY3_TEST__UNIVERSITY_CODE']
-        self.partnership_id = os.environ['BDPY3_TEST__PARTNERSHIP_ID']
-        self.pickup_location = os.environ['BDPY3_TEST__PICKUP_LOCATION']
-        self.isbn_found_and_available = os.environ['BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE']
-        self.isbn_found_and_unavailable = os.environ['BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE']
-        self.isbn_not_found = os.environ['BDPY3_TEST__ISBN_NOT_FOUND']
+        self.patron_barcode = LIVE_ENV['BDPY3_TEST__PATRON_BARCODE']
+        self.api_url_root = LIVE_ENV['BDPY3_TEST__API_URL_ROOT']
+        self.api_key = LIVE_ENV['BDPY3_TEST__API_KEY']
+        self.university_code = LIVE_ENV['BDPY3_TEST__UNIVERSITY_CODE']
+        self.partnership_id = LIVE_ENV['BDPY3_TEST__PARTNERSHIP_ID']
+        self.pickup_location = LIVE_ENV['BDPY3_TEST__PICKUP_LOCATION']
+        self.isbn_found_and_available = LIVE_ENV['BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE']
+        self.isbn_found_and_unavailable = LIVE_ENV['BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE']
+        self.isbn_not_found = LIVE_ENV['BDPY3_TEST__ISBN_NOT_FOUND']
 
     def test_settings_instantiation(self):
         """ Tests that instance instantiation handles settings not-defined, or defined as dict, module, or path. """
@@ -43,11 +74,11 @@ class BorrowDirectTests( unittest.TestCase ):
         self.assertEqual(
             '123', bd.UNIVERSITY_CODE )
         ## module settings
-        s = imp.new_module( 'settings' )  ## empty module
+        s = types.ModuleType( 'settings' )  ## empty module
         bd = BorrowDirect( s )
         self.assertEqual(
             None, bd.UNIVERSITY_CODE )
-        s = imp.new_module( 'settings' )  ## populated module
+        s = types.ModuleType( 'settings' )  ## populated module
         s.UNIVERSITY_CODE = '234'
         bd = BorrowDirect( s )
         self.assertEqual(
@@ -61,7 +92,7 @@ class BorrowDirectTests( unittest.TestCase ):
             'PARTNERSHIP_ID': self.partnership_id,
             'UNIVERSITY_CODE': self.university_code,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         bd.run_auth_nz( self.patron_barcode )
         self.assertEqual(
             True, bd.authnz_valid )
@@ -74,7 +105,7 @@ class BorrowDirectTests( unittest.TestCase ):
             'PARTNERSHIP_ID': self.partnership_id,
             'UNIVERSITY_CODE': self.university_code,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         bd.run_search_exact_item( self.patron_barcode, 'ISBN', self.isbn_found_and_available )
         self.assertEqual( ['Available', 'OrigNumberOfRecords', 'PickupLocation', 'RequestLink'], sorted(bd.search_result.keys()) )
         self.assertEqual( True, bd.search_result['Available'] )
@@ -87,7 +118,7 @@ class BorrowDirectTests( unittest.TestCase ):
             'PARTNERSHIP_ID': self.partnership_id,
             'UNIVERSITY_CODE': self.university_code,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         bd.run_search_exact_item( self.patron_barcode, 'ISBN', self.isbn_found_and_unavailable )
         self.assertEqual( ['Available', 'OrigNumberOfRecords', 'RequestLink'], sorted(bd.search_result.keys()) )
         self.assertEqual( False, bd.search_result['Available'] )
@@ -100,11 +131,26 @@ class BorrowDirectTests( unittest.TestCase ):
             'PARTNERSHIP_ID': self.partnership_id,
             'UNIVERSITY_CODE': self.university_code,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         bd.run_search_exact_item( self.patron_barcode, 'ISBN', self.isbn_not_found )
         self.assertEqual(
             {"Problem":{"ErrorCode":"PUBFI002","ErrorMessage":"No result"}}, bd.search_result )
 
+    def test_run_search_and_request_exact_item__not_found(self):
+        """ Tests combined search-then-request skips the request for a not-found item. """
+        basics = {
+            'API_URL_ROOT': self.api_url_root,
+            'API_KEY': self.api_key,
+            'PARTNERSHIP_ID': self.partnership_id,
+            'UNIVERSITY_CODE': self.university_code,
+            'PICKUP_LOCATION': self.pickup_location,
+        }
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
+        outcome = bd.run_search_and_request_exact_item( self.patron_barcode, 'ISBN', self.isbn_not_found )
+        self.assertEqual( 'not_found', outcome['search_outcome'] )
+        self.assertEqual( False, outcome['requested'] )
+        self.assertEqual( None, bd.request_result )
+
     # def test_run_request_exact_item__found_and_available(self):
     #     """ Tests manager requesting.
     #         Commented out because it'll really request the item. """
@@ -130,7 +176,7 @@ class BorrowDirectTests( unittest.TestCase ):
             'PARTNERSHIP_ID': self.partnership_id,
             'UNIVERSITY_CODE': self.university_code,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         ( title, author, year ) = ( 'Zen and the art of motorcycle maintenance - an inquiry into values', ['Pirsig, Robert M'], '1974' )
         bd.run_search_bib_item( self.patron_barcode, title, author, year )
         self.assertEqual( ['Available', 'OrigNumberOfRecords', 'PickupLocation', 'RequestLink'], sorted(bd.search_result.keys()) )
@@ -146,7 +192,7 @@ class BorrowDirectTests( unittest.TestCase ):
             'UNIVERSITY_CODE': self.university_code,
             'PICKUP_LOCATION': self.pickup_location,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         bd.run_request_exact_item( self.patron_barcode, 'ISBN', self.isbn_not_found )
         self.assertEqual(
             {'Problem': {'ErrorCode': 'PUBRI003', 'ErrorMessage': 'No result'}}, bd.request_result )
@@ -161,7 +207,7 @@ class BorrowDirectTests( unittest.TestCase ):
             'UNIVERSITY_CODE': self.university_code,
             'PICKUP_LOCATION': self.pickup_location,
         }
-        bd = BorrowDirect( basics )
+        bd = BorrowDirect( dict(basics, **LIVE_SETTINGS) )
         ( title, author, year ) = ( 'Zen and the art of motorcycle maintenance - an inquiry into values', ['Pirsig, Robert M'], '1874' )
         log.debug( 'title, ```%s```' % title )
         bd.run_request_bib_item( self.patron_barcode, title, author, year )
@@ -177,17 +223,17 @@ class AuthenticatorTests( unittest.TestCase ):
 
     def setUp(self):
         time.sleep( SLEEP_SECONDS )
-        self.LOG_PATH = os.environ['BDPY3_TEST__LOG_PATH']  # if None  ...outputs to console
+        self.LOG_PATH = LIVE_ENV['BDPY3_TEST__LOG_PATH']  # if None  ...outputs to console
         bd = BorrowDirect( {'LOG_PATH': self.LOG_PATH} )
-        self.patron_barcode = os.environ['BDPY3_TEST__PATRON_BARCODE']
-        self.api_url_root = os.environ['BDPY3_TEST__API_URL_ROOT']
-        self.api_key = os.environ['BDPY3_TEST__API_KEY']
-        self.university_code = os.environ['BDPY3_TEST__UNIVERSITY_CODE']
-        self.partnership_id = os.environ['BDPY3_TEST__PARTNERSHIP_ID']
+        self.patron_barcode = LIVE_ENV['BDPY3_TEST__PATRON_BARCODE']
+        self.api_url_root = LIVE_ENV['BDPY3_TEST__API_URL_ROOT']
+        self.api_key = LIVE_ENV['BDPY3_TEST__API_KEY']
+        self.university_code = LIVE_ENV['BDPY3_TEST__UNIVERSITY_CODE']
+        self.partnership_id = LIVE_ENV['BDPY3_TEST__PARTNERSHIP_ID']
 
     def test_authenticate(self):
         """ Tests getting an authentication-id. """
-        a = Authenticator()
+        a = Authenticator( session=LIVE_SESSION )
         authentication_id = a.authenticate(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code )
         self.assertEqual(
@@ -195,7 +241,7 @@ class AuthenticatorTests( unittest.TestCase ):
 
     def test_authorize(self):
         """ Tests authz session-extender. """
-        a = Authenticator()
+        a = Authenticator( session=LIVE_SESSION )
         authentication_id = a.authenticate(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code )
         time.sleep( SLEEP_SECONDS )
@@ -211,22 +257,22 @@ class SearcherTests( unittest.TestCase ):
 
     def setUp(self):
         time.sleep( SLEEP_SECONDS )
-        self.LOG_PATH = os.environ['BDPY3_TEST__LOG_PATH']  # if None  ...outputs to console
+        self.LOG_PATH = LIVE_ENV['BDPY3_TEST__LOG_PATH']  # if None  ...outputs to console
         bd = BorrowDirect( {'LOG_PATH': self.LOG_PATH} )
-        self.patron_barcode = os.environ['BDPY3_TEST__PATRON_BARCODE']
-        self.api_url_root = os.environ['BDPY3_TEST__API_URL_ROOT']
-        self.api_key = os.environ['BDPY3_TEST__API_KEY']
-        self.university_code = os.environ['BDPY3_TEST__UNIVERSITY_CODE']
-        self.partnership_id = os.environ['BDPY3_TEST__PARTNERSHIP_ID']
-        self.isbn_found_and_available = os.environ['BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE']
-        self.isbn_found_and_unavailable = os.environ['BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE']
-        self.isbn_not_found = os.environ['BDPY3_TEST__ISBN_NOT_FOUND']
-        # self.isbn_available_locally = os.environ['BDPY3_TEST__ISBN_AVAILABLE_LOCALLY']  # TODO
+        self.patron_barcode = LIVE_ENV['BDPY3_TEST__PATRON_BARCODE']
+        self.api_url_root = LIVE_ENV['BDPY3_TEST__API_URL_ROOT']
+        self.api_key = LIVE_ENV['BDPY3_TEST__API_KEY']
+        self.university_code = LIVE_ENV['BDPY3_TEST__UNIVERSITY_CODE']
+        self.partnership_id = LIVE_ENV['BDPY3_TEST__PARTNERSHIP_ID']
+        self.isbn_found_and_available = LIVE_ENV['BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE']
+        self.isbn_found_and_unavailable = LIVE_ENV['BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE']
+        self.isbn_not_found = LIVE_ENV['BDPY3_TEST__ISBN_NOT_FOUND']
+        # self.isbn_available_locally = LIVE_ENV['BDPY3_TEST__ISBN_AVAILABLE_LOCALLY']  # TODO
 
     def test_search_bib_item_found_available(self):
         """ Tests bib item search for available found item.
             See README for example full-json response. """
-        s = Searcher()
+        s = Searcher( session=LIVE_SESSION )
         ( title, author, year ) = ( 'Zen and the art of motorcycle maintenance - an inquiry into values', ['Pirsig, Robert M'], '1974' )
         result_dct = s.search_bib_item(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code, title, author, year )
@@ -237,7 +283,7 @@ class SearcherTests( unittest.TestCase ):
 
     def test_search_exact_item_found_available(self):
         """ Tests basic isbn search for available found item. """
-        s = Searcher()
+        s = Searcher( session=LIVE_SESSION )
         ( search_key, search_value ) = ( 'ISBN', self.isbn_found_and_available )
         result_dct = s.search_exact_item(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code, search_key, search_value )
@@ -248,7 +294,7 @@ class SearcherTests( unittest.TestCase ):
 
     def test_search_exact_item_found_unavailable(self):
         """ Tests basic isbn search for unavailable found item. """
-        s = Searcher()
+        s = Searcher( session=LIVE_SESSION )
         ( search_key, search_value ) = ( 'ISBN', self.isbn_found_and_unavailable )
         result_dct = s.search_exact_item(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code, search_key, search_value )
@@ -259,7 +305,7 @@ class SearcherTests( unittest.TestCase ):
 
     def test_search_exact_item_not_found(self):
         """ Tests basic isbn search for not-found item. """
-        s = Searcher()
+        s = Searcher( session=LIVE_SESSION )
         ( search_key, search_value ) = ( 'ISBN', self.isbn_not_found )
         result_dct = s.search_exact_item(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code, search_key, search_value )
@@ -269,7 +315,7 @@ class SearcherTests( unittest.TestCase ):
     ## TODO
     # def test_search_exact_item_available_locally(self):
     #     """ Tests basic isbn search for item that is available locally. """
-    #     s = Searcher()
+    #     s = Searcher( session=LIVE_SESSION )
     #     ( search_key, search_value ) = ( 'ISBN', self.isbn_available_locally )
     #     result_dct = s.search(
     #         self.patron_barcode, search_key, search_value, self.api_url_root, self.api_key, self.partnership_id, self.university_code )
@@ -283,22 +329,22 @@ class RequesterTests( unittest.TestCase ):
 
     def setUp(self):
         time.sleep( SLEEP_SECONDS )
-        self.LOG_PATH = os.environ['BDPY3_TEST__LOG_PATH']  # if None  ...outputs to console
+        self.LOG_PATH = LIVE_ENV['BDPY3_TEST__LOG_PATH']  # if None  ...outputs to console
         bd = BorrowDirect( {'LOG_PATH': self.LOG_PATH} )
-        self.patron_barcode = os.environ['BDPY3_TEST__PATRON_BARCODE']
-        self.api_url_root = os.environ['BDPY3_TEST__API_URL_ROOT']
-        self.api_key = os.environ['BDPY3_TEST__API_KEY']
-        self.university_code = os.environ['BDPY3_TEST__UNIVERSITY_CODE']
-        self.partnership_id = os.environ['BDPY3_TEST__PARTNERSHIP_ID']
-        self.pickup_location = os.environ['BDPY3_TEST__PICKUP_LOCATION']
-        self.isbn_found_and_available = os.environ['BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE']
-        self.isbn_found_and_unavailable = os.environ['BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE']
-        self.isbn_not_found = os.environ['BDPY3_TEST__ISBN_NOT_FOUND']
+        self.patron_barcode = LIVE_ENV['BDPY3_TEST__PATRON_BARCODE']
+        self.api_url_root = LIVE_ENV['BDPY3_TEST__API_URL_ROOT']
+        self.api_key = LIVE_ENV['BDPY3_TEST__API_KEY']
+        self.university_code = LIVE_ENV['BDPY3_TEST__UNIVERSITY_CODE']
+        self.partnership_id = LIVE_ENV['BDPY3_TEST__PARTNERSHIP_ID']
+        self.pickup_location = LIVE_ENV['BDPY3_TEST__PICKUP_LOCATION']
+        self.isbn_found_and_available = LIVE_ENV['BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE']
+        self.isbn_found_and_unavailable = LIVE_ENV['BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE']
+        self.isbn_not_found = LIVE_ENV['BDPY3_TEST__ISBN_NOT_FOUND']
 
     # def test_request_item_found_and_available(self):
     #     """ Tests basic isbn request for available found item.
     #         NOTE: commented out because this will really request the item. """
-    #     r = Requester()
+    #     r = Requester( session=LIVE_SESSION )
     #     ( search_key, search_value ) = ( 'ISBN', self.isbn_found_and_available )
     #     result_dct = r.request_exact_item(
     #         self.patron_barcode, search_key, search_value, self.pickup_location, self.api_url_root, self.api_key, self.partnership_id, self.university_code )
@@ -310,7 +356,7 @@ class RequesterTests( unittest.TestCase ):
     def test_request_item_not_found(self):
         """ Tests basic isbn request for not-found item.
             NOTE: will really attempt a request. """
-        r = Requester()
+        r = Requester( session=LIVE_SESSION )
         ( search_key, search_value ) = ( 'ISBN', self.isbn_not_found )
         result_dct = r.request_exact_item(
             self.patron_barcode, self.api_url_root, self.api_key, self.partnership_id, self.university_code, self.pickup_location, search_key, search_value )
@@ -319,24 +365,1261 @@ class RequesterTests( unittest.TestCase ):
 
     def test_build_exact_search_params( self ):
         """ Tests for all expected isbn-search params. """
-        r = Requester()
+        r = Requester( session=LIVE_SESSION )
         ( partnership_id, pickup_location, search_key, search_value ) = ( 'a', 'b', 'c', 'd' )
         params = r.build_exact_search_params( partnership_id, pickup_location, search_key, search_value )
         self.assertEqual(
             ['ExactSearch', 'Notes', 'PartnershipId', 'PickupLocation'],
             sorted(params.keys()) )
 
+    def test_build_exact_search_params_multiple( self ):
+        """ Tests several identifiers are sent in one 'ExactSearch' list. """
+        r = Requester( session=LIVE_SESSION )
+        params = r.build_exact_search_params( 'a', 'b', 'ISBN', ['9780688002305', '0688002307', ('OCLC', '673595')] )
+        self.assertEqual(
+            [ {'Type': 'ISBN', 'Value': '9780688002305'}, {'Type': 'ISBN', 'Value': '0688002307'}, {'Type': 'OCLC', 'Value': '673595'} ],
+            params['ExactSearch'] )
+        s = Searcher( session=LIVE_SESSION )
+        self.assertEqual( params['ExactSearch'], s.build_exact_item_params('x', 'a', 'c', 'ISBN', ['9780688002305', '0688002307', ('OCLC', '673595')])['ExactSearch'] )
+        self.assertEqual( [{'Type': 'ISBN', 'Value': '9780688002305'}], s.build_exact_item_params('x', 'a', 'c', 'ISBN', '9780688002305')['ExactSearch'] )
+
     def test_build_bib_search_params( self ):
         """ Tests for all expected bib-search params. """
-        r = Requester()
+        r = Requester( session=LIVE_SESSION )
         ( partnership_id, pickup_location, title, author, year ) = ( 'a', 'b', 'c', 'd', 'e' )
         params = r.build_bib_search_params( partnership_id, pickup_location, title, author, year )
         self.assertEqual(
             ['BibSearch', 'PartnershipId', 'PickupLocation', 'ResultFilter'],
             sorted(params.keys()) )
 
+    def test_build_bib_search_params__years_and_formats( self ):
+        """ Tests several years and formats fold into one query's filter, and filters can be dropped. """
+        r = Requester( session=LIVE_SESSION )
+        self.assertEqual( {'Include': {'PublicationDate': ['1974'], 'Format': ['Book']}}, r.build_bib_search_params('a', 'b', 'c', 'd', '1974')['ResultFilter'] )
+        params = r.build_bib_search_params( 'a', 'b', 'c', 'd', range(1973, 1976), formats={'Book', 'Musical Score'} )
+        self.assertEqual( {'Include': {'PublicationDate': ['1973', '1974', '1975'], 'Format': ['Book', 'Musical Score']}}, params['ResultFilter'] )
+        s = Searcher( session=LIVE_SESSION )
+        self.assertEqual( {'Include': {'Format': ['Book']}}, s.build_bib_item_params('a', 'c', 'd', 'e', None)['ResultFilter'] )
+        self.assertEqual( {'Include': {'PublicationDate': ['1974', 1975]}}, s.build_bib_item_params('a', 'c', 'd', 'e', ['1974', 1975], formats=None)['ResultFilter'] )
+        self.assertEqual( ['BibSearch', 'PartnershipId'], sorted(s.build_bib_item_params('a', 'c', 'd', 'e', None, formats=None).keys()) )
+
+    def test_build_bib_search_params__blank_year( self ):
+        """ Tests a blank year, eg an empty csv cell, drops the date filter rather than filtering on a blank date. """
+        r = Requester( session=LIVE_SESSION )
+        for year in ( '', '  ', [], [''], {' '} ):
+            self.assertEqual( {'Include': {'Format': ['Book']}}, r.build_bib_search_params('a', 'b', 'c', 'd', year)['ResultFilter'] )
+        self.assertEqual( {'Include': {'PublicationDate': ['1974']}}, Searcher( session=LIVE_SESSION ).build_bib_item_params('a', 'c', 'd', 'e', ['1974', ''], formats=None)['ResultFilter'] )
+        self.assertEqual( SearchResultCache().make_bib_key('BD', 'BROWN', 'T', 'A', None), SearchResultCache().make_bib_key('BD', 'BROWN', 'T', 'A', '') )
+
     ## end class RequesterTests
 
 
+class AuthIdCacheTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def test_get_and_set(self):
+        """ Tests stored authorization-id is returned until invalidated. """
+        cache = AuthIdCache( ttl=60 )
+        key = cache.make_key( 'url', 'BD', 'BROWN', '123' )
+        self.assertEqual( None, cache.get(key) )
+        cache.set( key, 'aid_a' )
+        self.assertEqual( 'aid_a', cache.get(key) )
+        cache.invalidate( key )
+        self.assertEqual( None, cache.get(key) )
+
+    def test_expiry(self):
+        """ Tests expired authorization-id is not returned. """
+        cache = AuthIdCache( ttl=-1 )
+        key = cache.make_key( 'url', 'BD', 'BROWN', '123' )
+        cache.set( key, 'aid_a' )
+        self.assertEqual( None, cache.get(key) )
+
+    def test_lru_eviction(self):
+        """ Tests least-recently-used entry is evicted beyond max_entries. """
+        cache = AuthIdCache( ttl=60, max_entries=2 )
+        ( key_a, key_b, key_c ) = [ cache.make_key('url', 'BD', 'BROWN', barcode) for barcode in ('a', 'b', 'c') ]
+        cache.set( key_a, 'aid_a' )
+        cache.set( key_b, 'aid_b' )
+        cache.get( key_a )
+        cache.set( key_c, 'aid_c' )
+        self.assertEqual( 'aid_a', cache.get(key_a) )
+        self.assertEqual( None, cache.get(key_b) )
+
+    def test_file_store_shared(self):
+        """ Tests a second cache using the same path sees the first cache's entry. """
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join( dir_path, 'aids.json' )
+            cache_a = AuthIdCache( ttl=60, path=path )
+            cache_b = AuthIdCache( ttl=60, path=path )
+            key = cache_a.make_key( 'url', 'BD', 'BROWN', '123' )
+            cache_a.set( key, 'aid_a' )
+            self.assertEqual( 'aid_a', cache_b.get(key) )
+            cache_a.invalidate( key )
+            cache_b.entries.clear()
+            self.assertEqual( None, cache_b.get(key) )
+
+    ## end class AuthIdCacheTests
+
+
+class SearchResultCacheTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def setUp(self):
+        self.available = { 'Available': True, 'PickupLocation': [], 'RequestLink': {} }
+        self.held_locally = { 'Available': False, 'RequestLink': {'RequestMessage': 'This item is available locally.'} }
+        self.not_found = { 'Problem': {'ErrorCode': 'PUBFI002', 'ErrorMessage': 'No result'} }
+        self.error = { 'Problem': {'ErrorCode': 'PUBFI001', 'ErrorMessage': 'Error'} }
+
+    def test_bib_key_years_and_formats(self):
+        """ Tests bib keys ignore the order of years and formats, but distinguish different filters. """
+        cache = SearchResultCache()
+        self.assertEqual( cache.make_bib_key('BD', 'BROWN', 'T', 'A', range(1973, 1975)), cache.make_bib_key('BD', 'BROWN', 'T', 'A', [1974, '1973'], formats=['Book']) )
+        self.assertNotEqual( cache.make_bib_key('BD', 'BROWN', 'T', 'A', '1974'), cache.make_bib_key('BD', 'BROWN', 'T', 'A', '1974', formats=None) )
+        self.assertNotEqual( cache.make_bib_key('BD', 'BROWN', 'T', 'A', '1974'), cache.make_bib_key('BD', 'BROWN', 'T', 'A', ['1974', '1975']) )
+
+    def test_classify_search_result(self):
+        """ Tests outcome classification of README response shapes. """
+        self.assertEqual( 'available', classify_search_result(self.available) )
+        self.assertEqual( 'held_locally', classify_search_result(self.held_locally) )
+        self.assertEqual( 'unavailable', classify_search_result({'Available': False, 'RequestLink': {'RequestMessage': 'Place an interlibrary loan request via ILLiad.'}}) )
+        self.assertEqual( 'not_found', classify_search_result(self.not_found) )
+        self.assertEqual( 'error', classify_search_result(self.error) )
+
+    def test_normalized_key_hits(self):
+        """ Tests differently-formatted isbns share an entry, and hits/misses are counted. """
+        cache = SearchResultCache()
+        cache.set( cache.make_exact_key('BD', 'BROWN', 'ISBN', '978-0-688-00230-5'), self.available )
+        self.assertEqual( self.available, cache.get(cache.make_exact_key('BD', 'BROWN', 'ISBN', '9780688002305')) )
+        self.assertEqual( None, cache.get(cache.make_exact_key('BD', 'YALE', 'ISBN', '9780688002305')) )
+        self.assertEqual( {'hits': 1, 'misses': 1, 'entries': 1}, cache.stats() )
+
+    def test_multiple_identifier_key(self):
+        """ Tests several identifiers share a key regardless of order and formatting. """
+        cache = SearchResultCache()
+        key_a = cache.make_exact_key( 'BD', 'BROWN', 'ISBN', ['978-0-688-00230-5', ('OCLC', '673595')] )
+        key_b = cache.make_exact_key( 'BD', 'BROWN', 'ISBN', [('OCLC', '673595'), '9780688002305'] )
+        self.assertEqual( key_a, key_b )
+        self.assertNotEqual( key_a, cache.make_exact_key('BD', 'BROWN', 'ISBN', '9780688002305') )
+
+    def test_outcome_ttls(self):
+        """ Tests per-outcome ttls, and that errors are not stored. """
+        cache = SearchResultCache( ttl_available=0, ttl_not_found=60 )
+        ( key_a, key_b, key_c ) = [ cache.make_exact_key('BD', 'BROWN', 'ISBN', isbn) for isbn in ('1', '2', '3') ]
+        cache.set( key_a, self.available )
+        cache.set( key_b, self.not_found )
+        cache.set( key_c, self.error )
+        self.assertEqual( None, cache.get(key_a) )
+        self.assertEqual( self.not_found, cache.get(key_b) )
+        self.assertEqual( None, cache.get(key_c) )
+
+    def test_lru_eviction(self):
+        """ Tests least-recently-used entry is evicted beyond max_entries. """
+        cache = SearchResultCache( max_entries=1 )
+        ( key_a, key_b ) = [ cache.make_exact_key('BD', 'BROWN', 'ISBN', isbn) for isbn in ('1', '2') ]
+        cache.set( key_a, self.available )
+        cache.set( key_b, self.available )
+        self.assertEqual( None, cache.get(key_a) )
+        self.assertEqual( self.available, cache.get(key_b) )
+
+    ## end class SearchResultCacheTests
+
+
+class SqliteSearchCacheTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def setUp(self):
+        self.available = { 'Available': True, 'PickupLocation': [], 'RequestLink': {} }
+        self.not_found = { 'Problem': {'ErrorCode': 'PUBFI002', 'ErrorMessage': 'No result'} }
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.temp_dir.name, 'search_cache.sqlite' )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_shared_across_processes(self):
+        """ Tests a result stored by another process is a hit here, under its normalized key. """
+        code = textwrap.dedent( """
+            import sys
+            from bdpy3.cache import SqliteSearchCache
+            cache = SqliteSearchCache( sys.argv[1] )
+            cache.set( cache.make_exact_key('BD', 'BROWN', 'ISBN', '978-0-688-00230-5'), {'Available': True, 'PickupLocation': [], 'RequestLink': {}} )
+            """ )
+        subprocess.run( [sys.executable, '-c', code, self.path], cwd=os.path.dirname(os.path.abspath(__file__)), check=True )
+        cache = SqliteSearchCache( self.path )
+        self.assertEqual( self.available, cache.get(cache.make_exact_key('BD', 'BROWN', 'ISBN', '9780688002305')) )
+        self.assertEqual( None, cache.get(cache.make_exact_key('BD', 'YALE', 'ISBN', '9780688002305')) )
+        self.assertEqual( (1, 0, 1, 1), (cache.stats()['hits'], cache.stats()['memory_hits'], cache.stats()['misses'], cache.stats()['entries']) )
+        cache.close()
+
+    def test_outcome_ttls(self):
+        """ Tests per-outcome ttls apply to the file as well as to memory. """
+        writer = SqliteSearchCache( self.path, ttl_available=0.05, ttl_not_found=60 )
+        ( key_a, key_b ) = [ writer.make_exact_key('BD', 'BROWN', 'ISBN', isbn) for isbn in ('1', '2') ]
+        writer.set( key_a, self.available )
+        writer.set( key_b, self.not_found )
+        writer.set( writer.make_exact_key('BD', 'BROWN', 'ISBN', '3'), {'Problem': {'ErrorCode': 'PUBFI001', 'ErrorMessage': 'Error'}} )
+        reader = SqliteSearchCache( self.path, memory_entries=0 )
+        self.assertEqual( 2, reader.stats()['entries'] )
+        time.sleep( 0.1 )
+        for cache in ( writer, reader ):
+            self.assertEqual( None, cache.get(key_a) )
+            self.assertEqual( self.not_found, cache.get(key_b) )
+        self.assertEqual( 1, reader.stats()['entries'] )
+
+    def test_lru_eviction(self):
+        """ Tests least-recently-used rows are evicted beyond max_entries, counting another process's reads as uses. """
+        cache = SqliteSearchCache( self.path, max_entries=2, memory_entries=0 )
+        ( key_a, key_b, key_c ) = [ cache.make_exact_key('BD', 'BROWN', 'ISBN', isbn) for isbn in ('1', '2', '3') ]
+        cache.set( key_a, self.available )
+        cache.set( key_b, self.available )
+        other = SqliteSearchCache( self.path, memory_entries=0, flush_interval=0 )
+        other.get( key_a )
+        cache.set( key_c, self.available )
+        self.assertEqual( (self.available, None, self.available), (cache.get(key_a), cache.get(key_b), cache.get(key_c)) )
+
+    def test_warm_start(self):
+        """ Tests a new instance preloads the most-hit keys into memory, and serves them without reading the file. """
+        cache = SqliteSearchCache( self.path )
+        keys = [ cache.make_exact_key('BD', 'BROWN', 'ISBN', isbn) for isbn in ('1', '2', '3') ]
+        for ( key, hits ) in zip( keys, (1, 5, 3) ):
+            cache.set( key, self.available )
+            for i in range( hits ):
+                cache.get( key )
+        cache.close()
+        warmed = SqliteSearchCache( self.path, warm_start=2 )
+        self.assertEqual( [ warmed._db_key(keys[2]), warmed._db_key(keys[1]) ], list(warmed.memory) )
+        self.assertEqual( self.available, warmed.get(keys[1]) )
+        self.assertEqual( (2, 1), (warmed.stats()['warmed'], warmed.stats()['memory_hits']) )
+
+    def test_bd_settings(self):
+        """ Tests SEARCH_CACHE_PATH builds a shared-file cache that searches use. """
+        with StubServer() as stub:
+            settings = { 'API_URL_ROOT': stub.url, 'PARTNERSHIP_ID': 'BD', 'PICKUP_LOCATION': 'A', 'SEARCH_CACHE_PATH': self.path }
+            with BorrowDirect( settings ) as bd:
+                self.assertEqual( True, isinstance(bd.search_cache, SqliteSearchCache) )
+                bd.search_exact_item( '123', 'ISBN', stub.ISBN_AVAILABLE )
+            before = stub.counts['search']
+            with BorrowDirect( settings ) as bd:
+                self.assertEqual( True, bd.search_exact_item('456', 'ISBN', stub.ISBN_AVAILABLE)['Available'] )
+            self.assertEqual( before, stub.counts['search'] )
+
+    ## end class SqliteSearchCacheTests
+
+
+class BorrowDirectSessionTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def test_settings_configure_pool(self):
+        """ Tests pool settings reach the instance's session adapter. """
+        bd = BorrowDirect( {'HTTP_POOL_MAXSIZE': 25, 'HTTP_KEEP_ALIVE': False} )
+        self.assertEqual( True, isinstance(bd.session, BorrowDirectSession) )
+        self.assertEqual( 25, bd.session.get_adapter('https://example.org')._pool_maxsize )
+        self.assertEqual( 'close', bd.session.headers['Connection'] )
+        bd.close()
+
+    def test_session_injected(self):
+        """ Tests a passed-in session is used, and that the requests module remains the default. """
+        session = BorrowDirectSession()
+        s = Searcher( session=session )
+        self.assertEqual( session, s.session )
+        self.assertEqual( requests, Searcher().session )
+
+    ## end class BorrowDirectSessionTests
+
+
+class CassetteTests( unittest.TestCase ):
+    """ Offline; records against the local stub server, then replays without it. """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.temp_dir.name, 'cassette.json' )
+        self.stub = StubServer( latency=0.1 ).start()
+        self.settings = { 'API_URL_ROOT': self.stub.url, 'API_KEY': 'secret', 'PARTNERSHIP_ID': 'BD', 'UNIVERSITY_CODE': 'BROWN', 'PICKUP_LOCATION': 'A' }
+        with BorrowDirect( dict(self.settings, HTTP_CASSETTE_PATH=self.path, HTTP_CASSETTE_MODE='record') ) as bd:
+            self.recorded = [ bd.search_exact_item('123', 'ISBN', isbn) for isbn in (self.stub.ISBN_AVAILABLE, self.stub.ISBN_NOT_FOUND) ]
+            self.recorded.append( bd.request_exact_item('123', 'ISBN', self.stub.ISBN_AVAILABLE) )
+        self.stub.stop()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_replay_offline(self):
+        """ Tests calls replay the recorded responses with the server gone -- for another patron, api-root, and authorization-id -- and the api-key is not saved. """
+        with open( self.path ) as f:
+            self.assertEqual( False, 'secret' in f.read() )
+        settings = dict( self.settings, API_URL_ROOT='http://offline.invalid', HTTP_CASSETTE_PATH=self.path )
+        with BorrowDirect( settings ) as bd:
+            replayed = [ bd.search_exact_item('456', 'ISBN', isbn) for isbn in (self.stub.ISBN_AVAILABLE, self.stub.ISBN_NOT_FOUND) ]
+            replayed.append( bd.request_exact_item('456', 'ISBN', self.stub.ISBN_AVAILABLE) )
+            self.assertEqual( self.recorded, replayed )
+            with self.assertRaises( CassetteMiss ):
+                bd.search_exact_item( '456', 'ISBN', self.stub.ISBN_UNAVAILABLE )
+        self.assertEqual( (6, 7, 1), tuple(open_cassette(self.path).stats()[name] for name in ('interactions', 'replayed', 'misses')) )
+
+    def test_replay_latency(self):
+        """ Tests recorded latency is simulated when asked, and skipped otherwise. """
+        timings = []
+        for scale in ( 0.0, 1.0 ):
+            with BorrowDirect( dict(self.settings, HTTP_CASSETTE_PATH=self.path, HTTP_CASSETTE_LATENCY=scale) ) as bd:
+                start = time.perf_counter()
+                bd.search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )  # authentication and search
+                timings.append( time.perf_counter() - start )
+        self.assertTrue( timings[0] < 0.1 )
+        self.assertTrue( timings[1] >= 0.2 )
+
+    def test_environment_default_session(self):
+        """ Tests BDPY3_CASSETTE_PATH makes session-less Authenticator and Searcher replay, as the live-webservice tests would. """
+        code = textwrap.dedent( """
+            import sys
+            from bdpy3.search import Searcher
+            print( Searcher().search_exact_item('123', 'http://offline.invalid', 'key', 'BD', 'BROWN', 'ISBN', sys.argv[1])['Available'] )
+            """ )
+        env = dict( os.environ, BDPY3_CASSETTE_PATH=self.path, BDPY3_LOG_LEVEL='WARNING' )
+        output = subprocess.run(
+            [sys.executable, '-c', code, self.stub.ISBN_AVAILABLE], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True ).stdout
+        self.assertEqual( 'True', output.strip() )
+
+    ## end class CassetteTests
+
+
+class TokenBucketTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def test_burst_then_wait(self):
+        """ Tests `burst` calls pass immediately, and the next waits about 1/rate seconds. """
+        bucket = TokenBucket( rate=10, burst=3 )
+        self.assertEqual( [0, 0, 0], [bucket.reserve() for i in range(3)] )
+        self.assertAlmostEqual( 0.1, bucket.reserve(), places=2 )
+        self.assertAlmostEqual( 0.2, bucket.reserve(), places=2 )
+
+    def test_file_bucket_shared(self):
+        """ Tests two buckets using the same path share one budget. """
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join( dir_path, 'bucket.json' )
+            clock = lambda: 1000.0  # both reserves at the same instant, however long the file-locking takes
+            ( bucket_a, bucket_b ) = ( FileTokenBucket(rate=10, burst=1, path=path, clock=clock), FileTokenBucket(rate=10, burst=1, path=path, clock=clock) )
+            self.assertEqual( 0, bucket_a.reserve() )
+            self.assertAlmostEqual( 0.1, bucket_b.reserve(), places=6 )
+
+    def test_settings_configure_session(self):
+        """ Tests rate-limit settings reach the instance's session. """
+        bd = BorrowDirect( {'RATE_LIMIT_PER_SECOND': 5, 'RATE_LIMIT_BURST': 2} )
+        self.assertEqual( True, isinstance(bd.session.rate_limiter, TokenBucket) )
+        self.assertEqual( 2, bd.session.rate_limiter.burst )
+        self.assertEqual( None, BorrowDirect().session.rate_limiter )
+
+    ## end class TokenBucketTests
+
+
+class BatchTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def test_run_unordered(self):
+        """ Tests every item is paired with its result, and exceptions are yielded rather than raised. """
+        def func( item ):
+            if item == 3:
+                raise ValueError( 'bad item' )
+            return item * 10
+        results = dict( batch.run_unordered(func, range(10), max_workers=3) )
+        self.assertEqual( list(range(10)), sorted(results.keys()) )
+        self.assertEqual( 90, results[9] )
+        self.assertEqual( True, isinstance(results[3], ValueError) )
+
+    def test_run_unordered_concurrency(self):
+        """ Tests wall-clock time scales with concurrency rather than item-count. """
+        start = time.time()
+        list( batch.run_unordered(lambda item: time.sleep(0.1), range(8), max_workers=8) )
+        self.assertTrue( time.time() - start < 0.5 )
+
+    ## end class BatchTests
+
+
+class AsyncBorrowDirectTests( unittest.IsolatedAsyncioTestCase ):
+    """ Offline; runs against the local stub server. """
+
+    def setUp(self):
+        self.stub = StubServer().start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    async def test_run_search_exact_item(self):
+        """ Tests awaitable exact-item searches, run concurrently. """
+        try:
+            import aiohttp
+        except ImportError:
+            self.skipTest( 'aiohttp not installed' )
+        async with AsyncBorrowDirect( {'API_URL_ROOT': self.stub.url, 'PARTNERSHIP_ID': 'BD'} ) as bd:
+            results = await asyncio.gather( *[ bd.run_search_exact_item('123', 'ISBN', isbn) for isbn in (self.stub.ISBN_AVAILABLE, self.stub.ISBN_NOT_FOUND) ] )
+        self.assertEqual( True, results[0]['Available'] )
+        self.assertEqual( {'Problem': {'ErrorCode': 'PUBFI002', 'ErrorMessage': 'No result'}}, results[1] )
+
+    async def test_single_flight(self):
+        """ Tests concurrent identical searches share one call, each caller getting its own copy. """
+        try:
+            import aiohttp
+        except ImportError:
+            self.skipTest( 'aiohttp not installed' )
+        self.stub.latency = 0.2
+        async with AsyncBorrowDirect( {'API_URL_ROOT': self.stub.url, 'PARTNERSHIP_ID': 'BD', 'SEARCH_SINGLE_FLIGHT': True} ) as bd:
+            results = await asyncio.gather( *[ bd.run_search_exact_item(str(patron), 'ISBN', self.stub.ISBN_AVAILABLE) for patron in range(5) ] )
+        self.assertEqual( ( 1, 5, 4 ), (self.stub.counts['search'], self.stub.counts['authentication'], bd.search_flights.collapsed) )  # each patron authenticates as itself
+        results[0]['Available'] = 'changed'
+        self.assertEqual( [True] * 4, [ result['Available'] for result in results[1:] ] )
+
+    async def test_file_backed_stores_off_event_loop(self):
+        """ Tests auth-cache, search-cache, and rate-limiter file i/o runs off the event-loop's thread. """
+        try:
+            import aiohttp
+        except ImportError:
+            self.skipTest( 'aiohttp not installed' )
+        with tempfile.TemporaryDirectory() as dir_path:
+            settings = {
+                'API_URL_ROOT': self.stub.url, 'PARTNERSHIP_ID': 'BD', 'AUTH_CACHE_TTL': 60, 'AUTH_CACHE_PATH': os.path.join(dir_path, 'aids.json'),
+                'SEARCH_CACHE_PATH': os.path.join(dir_path, 'searches.sqlite'), 'RATE_LIMIT_PER_SECOND': 100, 'RATE_LIMIT_BURST': 10, 'RATE_LIMIT_PATH': os.path.join(dir_path, 'bucket.json') }
+            async with AsyncBorrowDirect( settings ) as bd:
+                threads = []
+                for ( obj, name ) in ( (bd.auth_cache.store, 'get'), (bd.auth_cache.store, 'set'), (bd.search_cache, 'get'), (bd.search_cache, 'set'), (bd.rate_limiter, 'reserve') ):
+                    def recording( *args, _func=getattr(obj, name) ):
+                        threads.append( threading.current_thread() )
+                        return _func( *args )
+                    setattr( obj, name, recording )
+                for i in range( 2 ):
+                    result = await bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+                    self.assertEqual( True, result['Available'] )
+        self.assertTrue( len(threads) >= 5 )
+        self.assertEqual( False, threading.current_thread() in threads )
+        self.assertEqual( 1, self.stub.counts['search'] )
+
+    def test_no_sync_session(self):
+        """ Tests building the async client and its json creates no `requests` session, even with a cassette configured. """
+        code = textwrap.dedent( """
+            import os, sys
+            os.environ['BDPY3_CASSETTE_PATH'] = 'unused.json'
+            from bdpy3 import cassette
+            from bdpy3.async_client import AsyncBorrowDirect
+            bd = AsyncBorrowDirect( {'LOG_LEVEL': 'INFO'} )
+            print( cassette._default_session is None, bd.format_result is not None )
+            """ )
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True ).stdout
+        self.assertEqual( 'True True', output.strip() )
+
+    ## end class AsyncBorrowDirectTests
+
+
+class StubServerTests( unittest.TestCase ):
+    """ Offline; runs BorrowDirect against the local stub server. """
+
+    def setUp(self):
+        self.stub = StubServer().start()
+        self.basics = {
+            'API_URL_ROOT': self.stub.url, 'API_KEY': 'key', 'PARTNERSHIP_ID': 'BD', 'UNIVERSITY_CODE': 'BROWN', 'PICKUP_LOCATION': 'A' }
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_run_search_exact_item(self):
+        """ Tests the stub's README response shapes. """
+        bd = BorrowDirect( self.basics )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( ['Available', 'OrigNumberOfRecords', 'PickupLocation', 'RequestLink'], sorted(bd.search_result.keys()) )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_UNAVAILABLE )
+        self.assertEqual( ['Available', 'OrigNumberOfRecords', 'RequestLink'], sorted(bd.search_result.keys()) )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_NOT_FOUND )
+        self.assertEqual( {'Problem': {'ErrorCode': 'PUBFI002', 'ErrorMessage': 'No result'}}, bd.search_result )
+
+    def test_run_search_exact_item__multiple_identifiers(self):
+        """ Tests several identifiers go out in one search call. """
+        bd = BorrowDirect( self.basics )
+        bd.run_search_exact_item( '123', 'ISBN', [self.stub.ISBN_NOT_FOUND, ('OCLC', '1'), self.stub.ISBN_AVAILABLE] )
+        self.assertEqual( True, bd.search_result['Available'] )
+        self.assertEqual( 1, self.stub.counts['search'] )
+
+    def test_auth_cache(self):
+        """ Tests one authentication per patron, and re-authentication when the server rejects an expired id. """
+        self.stub.aid_ttl = 0.2
+        bd = BorrowDirect( dict(self.basics, AUTH_CACHE_TTL=60) )
+        for i in range( 3 ):
+            bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( 1, self.stub.counts['authentication'] )
+        time.sleep( 0.3 )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( True, bd.search_result['Available'] )
+        self.assertEqual( 2, self.stub.counts['authentication'] )
+
+    def test_search_cache(self):
+        """ Tests a repeated search is answered from the cache. """
+        bd = BorrowDirect( dict(self.basics, SEARCH_CACHE_MAX_ENTRIES=100) )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_NOT_FOUND )
+        bd.run_search_exact_item( '456', 'ISBN', self.stub.ISBN_NOT_FOUND )
+        self.assertEqual( 1, self.stub.counts['search'] )
+        self.assertEqual( 1, bd.search_cache.hits )
+
+    def test_run_search_batch(self):
+        """ Tests every batch item is paired with its result. """
+        bd = BorrowDirect( self.basics )
+        items = [ ('ISBN', self.stub.ISBN_AVAILABLE), ('ISBN', self.stub.ISBN_NOT_FOUND), (self.stub.TITLE_AVAILABLE, ('Pirsig, Robert M',), '1974') ]
+        results = dict( bd.run_search_batch('123', items, max_workers=3) )
+        self.assertEqual( True, results[items[0]]['Available'] )
+        self.assertEqual( 'PUBFI002', results[items[1]]['Problem']['ErrorCode'] )
+        self.assertEqual( True, results[items[2]]['Available'] )
+
+    def test_run_search_and_request_exact_item(self):
+        """ Tests one authentication for search plus request, and no request for an item held locally. """
+        bd = BorrowDirect( self.basics )
+        outcome = bd.run_search_and_request_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( ( 'available', True, 'BRO-00000001' ), (outcome['search_outcome'], outcome['requested'], outcome['request_number']) )
+        self.assertEqual( 1, self.stub.counts['authentication'] )
+        outcome = bd.run_search_and_request_exact_item( '123', 'ISBN', self.stub.ISBN_HELD_LOCALLY )
+        self.assertEqual( ( 'held_locally', False, None ), (outcome['search_outcome'], outcome['requested'], bd.request_result) )
+        self.assertEqual( 1, self.stub.counts['request'] )
+
+    def test_error_injection(self):
+        """ Tests injected errors are non-json http errors. """
+        self.stub.error_rate = 1.0
+        r = requests.get( self.stub.url + '/portal-service/user/authz/isAuthorized?aid=x' )
+        self.assertEqual( 500, r.status_code )
+
+    def test_shared_instance_across_threads(self):
+        """ Tests one instance serves a thread pool, each call getting its own result, without touching the instance's attributes. """
+        bd = BorrowDirect( dict(self.basics, AUTH_CACHE_TTL=60) )
+        isbns = [ self.stub.ISBN_AVAILABLE, self.stub.ISBN_UNAVAILABLE, self.stub.ISBN_NOT_FOUND ] * 10
+        with concurrent.futures.ThreadPoolExecutor( max_workers=8 ) as executor:
+            outcomes = list( executor.map(lambda isbn: classify_search_result(bd.search_exact_item('123', 'ISBN', isbn)), isbns) )
+        self.assertEqual( [ 'available', 'unavailable', 'not_found' ] * 10, outcomes )
+        outcome = bd.search_and_request_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( 'BRO-00000001', outcome['request_number'] )
+        self.assertEqual( ( None, None, None, None ), (bd.AId, bd.authnz_valid, bd.search_result, bd.request_result) )
+        self.assertEqual( ( 'available', True ), (bd.run_search_and_request_exact_item('123', 'ISBN', self.stub.ISBN_AVAILABLE)['search_outcome'], bd.search_result['Available']) )
+
+    def test_single_flight(self):
+        """ Tests concurrent identical searches share one call, each thread getting its own copy; and that it can be turned off. """
+        self.stub.latency = 0.2
+        for ( single_flight, expected_searches ) in ( (True, 1), (False, 6) ):
+            searches_before = self.stub.counts['search']
+            bd = BorrowDirect( dict(self.basics, SEARCH_SINGLE_FLIGHT=single_flight) )
+            with concurrent.futures.ThreadPoolExecutor( max_workers=6 ) as executor:
+                results = list( executor.map(lambda patron: bd.search_exact_item(str(patron), 'ISBN', self.stub.ISBN_AVAILABLE), range(6)) )
+            self.assertEqual( expected_searches, self.stub.counts['search'] - searches_before )
+            self.assertEqual( [True] * 6, [ result['Available'] for result in results ] )
+            self.assertEqual( 6, len(set(id(result) for result in results)) )
+        self.assertEqual( None, BorrowDirect(self.basics).search_flights )  # off by default
+
+    def test_single_flight_auth_failure_not_shared(self):
+        """ Tests one patron's authentication failure is raised to that patron only; the others still share one search. """
+        self.stub.latency = 0.2
+        srchr = Searcher( flights=SingleFlight('search') )
+        original_get_authorization_id = srchr.get_authorization_id
+        def get_authorization_id( patron_barcode, *args ):
+            if patron_barcode == 'blocked':
+                time.sleep( 0.1 )
+                raise ValueError( 'blocked patron' )
+            return original_get_authorization_id( patron_barcode, *args )
+        srchr.get_authorization_id = get_authorization_id
+        searches_before = self.stub.counts['search']
+        with concurrent.futures.ThreadPoolExecutor( max_workers=4 ) as executor:
+            futures = [ executor.submit(srchr.search_exact_item, patron, self.stub.url, None, 'BD', None, 'ISBN', self.stub.ISBN_AVAILABLE) for patron in ('blocked', '1', '2', '3') ]
+            self.assertRaises( ValueError, futures[0].result )
+            self.assertEqual( [True] * 3, [ future.result()['Available'] for future in futures[1:] ] )
+        self.assertEqual( 1, self.stub.counts['search'] - searches_before )
+
+    ## end class StubServerTests
+
+
+class MetricsTests( unittest.TestCase ):
+    """ Offline; runs against the local stub server. """
+
+    def setUp(self):
+        self.stub = StubServer().start()
+        self.basics = {
+            'API_URL_ROOT': self.stub.url, 'API_KEY': 'key', 'PARTNERSHIP_ID': 'BD', 'UNIVERSITY_CODE': 'BROWN', 'METRICS_ENABLED': True }
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_per_endpoint_metrics(self):
+        """ Tests latency, status, and ErrorCode counts per endpoint. """
+        bd = BorrowDirect( self.basics )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_NOT_FOUND )
+        snapshot = bd.metrics.snapshot()
+        self.assertEqual( ['authentication', 'search'], sorted(snapshot['endpoints'].keys()) )
+        search = snapshot['endpoints']['search']
+        self.assertEqual( ( 1, 0, {'200': 1}, {'PUBFI002': 1} ), (search['latency']['count'], search['in_flight'], search['statuses'], search['error_codes']) )
+        self.assertEqual( 1, search['decode']['count'] )
+
+    def test_sink_and_exporters(self):
+        """ Tests sink callback events, and the prometheus-text and json exporters. """
+        events = []
+        bd = BorrowDirect( dict(self.basics, METRICS_SINK=events.append) )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( ['call', 'decode', 'call', 'decode'], [event['type'] for event in events] )
+        text = bd.metrics.to_prometheus_text()
+        self.assertTrue( 'bdpy3_call_duration_seconds_count{endpoint="search"} 1' in text )
+        self.assertTrue( 'bdpy3_responses_total{endpoint="search",status="200"} 1' in text )
+        self.assertEqual( 1, json.loads(bd.metrics.to_json())['endpoints']['authentication']['latency']['count'] )
+
+    def test_timeouts(self):
+        """ Tests timeout counting and cumulative histogram buckets. """
+        metrics = Metrics( buckets=(0.1, 1.0) )
+        metrics.finish_call( 'search', metrics.start_call('search') - 0.5, timed_out=True )
+        search = metrics.snapshot()['endpoints']['search']
+        self.assertEqual( ( 1, [0, 1, 1] ), (search['timeouts'], search['latency']['counts']) )
+
+    ## end class MetricsTests
+
+
+class LazyLoggingTests( unittest.TestCase ):
+    """ Offline; no webservice calls. """
+
+    def test_lazy_pformat_deferred(self):
+        """ Tests formatting is skipped when the record is not emitted. """
+        calls = []
+        class Tracker( object ):
+            def __repr__( self ):
+                calls.append( 1 )
+                return 'tracker'
+        test_log = logging.getLogger( 'bdpy3_lazy_test' )
+        test_log.setLevel( logging.INFO )
+        test_log.debug( 'params, `%s`', logger_setup.LazyPformat(Tracker()) )
+        self.assertEqual( [], calls )
+        self.assertEqual( 'tracker', str(logger_setup.LazyPformat(Tracker())) )
+
+    def test_lazy_body_truncated(self):
+        """ Tests long bodies are truncated. """
+        text = str( logger_setup.LazyBody(b'a' * (logger_setup.BODY_MAX_CHARS + 10)) )
+        self.assertTrue( text.endswith('...(truncated; %s chars total)' % (logger_setup.BODY_MAX_CHARS + 10)) )
+        self.assertEqual( 'short', str(logger_setup.LazyBody(b'short')) )
+
+    def test_enable_queue_logging(self):
+        """ Tests records reach the original handlers through the background queue. """
+        root = logging.getLogger()
+        original_handlers = root.handlers[:]
+        records = []
+        class ListHandler( logging.Handler ):
+            def emit( self, record ):
+                records.append( record.getMessage() )
+        for handler in original_handlers:
+            root.removeHandler( handler )
+        root.addHandler( ListHandler() )
+        try:
+            logger_setup.enable_queue_logging()
+            logging.getLogger( 'bdpy3_queue_test' ).warning( 'queued %s', 'message' )
+            logger_setup.stop_queue_logging()
+            self.assertEqual( ['queued message'], records )
+            self.assertTrue( isinstance(root.handlers[0], logging.handlers.QueueHandler) )
+        finally:
+            for handler in root.handlers[:]:
+                root.removeHandler( handler )
+            for handler in original_handlers:
+                root.addHandler( handler )
+
+    def test_queue_logging_formats_on_listener_thread(self):
+        """ Tests a lazy arg is rendered by the queue's background thread, not by the logging thread. """
+        root = logging.getLogger()
+        original_handlers = root.handlers[:]
+        rendering_threads = []
+        class Tracker( object ):
+            def __repr__( self ):
+                rendering_threads.append( threading.current_thread() )
+                return 'tracker'
+        class ListHandler( logging.Handler ):
+            def emit( self, record ):
+                self.format( record )
+        for handler in original_handlers:
+            root.removeHandler( handler )
+        root.addHandler( ListHandler() )
+        try:
+            logger_setup.enable_queue_logging()
+            logging.getLogger( 'bdpy3_queue_test' ).warning( 'params, `%s`', logger_setup.LazyPformat(Tracker()) )
+            logger_setup.stop_queue_logging()
+            self.assertEqual( 1, len(rendering_threads) )
+            self.assertNotEqual( threading.current_thread(), rendering_threads[0] )
+        finally:
+            for handler in root.handlers[:]:
+                root.removeHandler( handler )
+            for handler in original_handlers:
+                root.addHandler( handler )
+
+    def test_default_logging_configured_once(self):
+        """ Tests building many instances without a logger configures logging once. """
+        calls = []
+        ( original_check_logger, original_configured ) = ( logger_setup.check_logger, logger_setup.default_logging_configured )
+        logger_setup.check_logger = lambda *args: calls.append( args )
+        logger_setup.default_logging_configured = False
+        try:
+            for i in range( 3 ):
+                BorrowDirect( {'LOG_LEVEL': 'INFO'} ).close()
+        finally:
+            ( logger_setup.check_logger, logger_setup.default_logging_configured ) = ( original_check_logger, original_configured )
+        self.assertEqual( [ (None, 'INFO') ], calls )
+
+    def test_default_level_skips_lazy_formatting(self):
+        """ Tests the default log config is at INFO, so a debug message's Lazy* args are never rendered; LOG_LEVEL 'DEBUG' renders them. """
+        code = textwrap.dedent( """
+            import logging, sys
+            from bdpy3 import BorrowDirect, logger_setup
+            class Tracker( object ):
+                def __repr__( self ):
+                    print( 'rendered' )
+                    return 'tracker'
+            BorrowDirect( {'LOG_LEVEL': sys.argv[1]} if sys.argv[1] else {} )
+            logging.getLogger( 'bdpy3.search' ).debug( 'result, `%s`', logger_setup.LazyPformat(Tracker()) )
+            print( logging.getLevelName(logging.getLogger().level) )
+            """ )
+        env = { k: v for ( k, v ) in os.environ.items() if k not in ('BDPY3_LOG_CONFIG_JSON', 'BDPY3_LOG_LEVEL', 'BDPY3_LOG_QUEUE') }
+        outputs = [ subprocess.run(
+            [sys.executable, '-c', code, level], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True ).stdout.split()
+            for level in ( '', 'DEBUG' ) ]
+        self.assertEqual( [ ['INFO'], ['rendered', 'DEBUG'] ], outputs )
+
+    ## end class LazyLoggingTests
+
+
+class SettingsLoadingTests( unittest.TestCase ):
+
+    def test_settings_path(self):
+        """ Tests that a settings file is loaded without `imp`, whatever its extension, and that defaults fill the gaps. """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join( temp_dir, 'bd_settings.conf' )
+            with open( path, 'w' ) as f:
+                f.write( textwrap.dedent("""
+                    UNIVERSITY_CODE = '345'
+                    HTTP_POOL_MAXSIZE = 20
+                    lowercase_helper = 'ignored'
+                    """) )
+            bd = BorrowDirect( path )
+            self.assertEqual( '345', bd.UNIVERSITY_CODE )
+            self.assertEqual( 20, bd.HTTP_POOL_MAXSIZE )
+            self.assertEqual( 10, bd.HTTP_POOL_CONNECTIONS )
+            self.assertEqual( False, hasattr(bd, 'lowercase_helper') )
+            bd.close()
+
+    def test_import_is_lazy(self):
+        """ Tests that `import bdpy3` neither imports `requests` nor configures logging, until a client is accessed and built. """
+        code = textwrap.dedent( """
+            import logging, sys
+            import bdpy3
+            print( 'requests' in sys.modules, bool(logging.getLogger().handlers) )
+            from bdpy3 import BorrowDirect
+            print( 'requests' in sys.modules )
+            BorrowDirect( {} )
+            print( 'requests' in sys.modules, bool(logging.getLogger().handlers) )
+            """ )
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True ).stdout
+        self.assertEqual( ['False False', 'False', 'True True'], output.strip().splitlines() )
+
+    def test_optional_subsystems_import_lazily(self):
+        """ Tests that building a BorrowDirect with default settings imports neither the caches (nor `sqlite3`), rate-limiter, keep-alive, nor results modules. """
+        code = textwrap.dedent( """
+            import sys
+            from bdpy3 import BorrowDirect
+            BorrowDirect( {'LOG_LEVEL': 'INFO'} )
+            print( sorted(name for name in ('sqlite3', 'bdpy3.cache', 'bdpy3.ratelimit', 'bdpy3.keepalive', 'bdpy3.results') if name in sys.modules) )
+            BorrowDirect( {'LOG_LEVEL': 'INFO', 'SEARCH_CACHE_MAX_ENTRIES': 10, 'RATE_LIMIT_PER_SECOND': 5} )
+            print( sorted(name for name in ('bdpy3.cache', 'bdpy3.ratelimit') if name in sys.modules) )
+            """ )
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True ).stdout
+        self.assertEqual( ["[]", "['bdpy3.cache', 'bdpy3.ratelimit']"], output.strip().splitlines() )
+
+    def test_log_settings_applied(self):
+        """ Tests the LOG_LEVEL and LOG_PATH settings set the default log config's level and handler. """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_path = os.path.join( temp_dir, 'bdpy3.log' )
+            code = textwrap.dedent( """
+                import logging, sys
+                from bdpy3 import BorrowDirect
+                BorrowDirect( {'LOG_LEVEL': 'info', 'LOG_PATH': sys.argv[1]} )
+                root = logging.getLogger()
+                print( logging.getLevelName(root.level), [ (type(h).__name__, logging.getLevelName(h.level)) for h in root.handlers ] )
+                logging.getLogger( 'bdpy3.check' ).debug( 'not written' )
+                logging.getLogger( 'bdpy3.check' ).info( 'written' )
+                """ )
+            env = { k: v for ( k, v ) in os.environ.items() if k not in ('BDPY3_LOG_CONFIG_JSON', 'BDPY3_LOG_LEVEL', 'BDPY3_LOG_QUEUE') }
+            result = subprocess.run(
+                [sys.executable, '-c', code, log_path], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True )
+            self.assertEqual( "INFO [('FileHandler', 'INFO')]", result.stdout.strip() )
+            self.assertEqual( '', result.stderr )
+            with open( log_path ) as f:
+                content = f.read()
+        self.assertTrue( 'written' in content and 'not written' not in content )
+
+    ## end class SettingsLoadingTests
+
+
+class CliTests( unittest.TestCase ):
+    """ Offline; runs `python -m bdpy3`'s main() against the local stub server. """
+
+    def setUp(self):
+        self.stub = StubServer().start()
+        self.settings_args = [ '--setting', 'API_URL_ROOT="%s"' % self.stub.url, '--setting', 'PARTNERSHIP_ID="BD"', '--setting', 'PICKUP_LOCATION="A"' ]
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def run_cli(self, argv, input_text):
+        ( stdout, stderr ) = ( io.StringIO(), io.StringIO() )
+        status = cli.main( argv + self.settings_args, stdin=io.StringIO(input_text), stdout=stdout, stderr=stderr )
+        records = sorted( [json.loads(line) for line in stdout.getvalue().splitlines()], key=lambda record: record['line'] )
+        return ( status, records, stderr.getvalue() )
+
+    def test_csv_search(self):
+        """ Tests csv exact and bib rows, a multi-identifier cell, and the summary line. """
+        input_text = 'patron,search_type,search_value,title,author,year\n'
+        input_text += '1,ISBN,%s,,,\n' % self.stub.ISBN_AVAILABLE
+        input_text += '1,ISBN,%s|%s,,,\n' % ( self.stub.ISBN_NOT_FOUND, self.stub.ISBN_UNAVAILABLE )
+        input_text += '2,,,%s,"Pirsig, Robert M",1974\n' % self.stub.TITLE_AVAILABLE
+        ( status, records, summary ) = self.run_cli( ['--workers', '1'], input_text )
+        self.assertEqual( 0, status )
+        self.assertEqual( [2, 3, 4], [record['line'] for record in records] )
+        self.assertEqual( ['available', 'unavailable', 'available'], [record['search_outcome'] for record in records] )
+        self.assertEqual( 2, self.stub.counts['authentication'] )  # once per patron
+        self.assertTrue( summary.startswith('bdpy3: 3 rows in ') )
+
+    def test_jsonl_search_and_request(self):
+        """ Tests jsonl rows, --patron, and that a bad row is reported without ending the run. """
+        input_text = '\n'.join( [
+            json.dumps( {'search_type': 'ISBN', 'search_value': self.stub.ISBN_AVAILABLE, 'id': 'x'} ),
+            json.dumps( {'search_type': 'ISBN', 'search_value': self.stub.ISBN_HELD_LOCALLY} ),
+            'not json',
+            ] ) + '\n'
+        ( status, records, summary ) = self.run_cli( ['--action', 'search_and_request', '--patron', '1'], input_text )
+        self.assertEqual( 1, status )
+        self.assertEqual( 'x', records[0]['input']['id'] )
+        self.assertEqual( 'BRO-00000001', records[0]['request_number'] )
+        self.assertEqual( False, records[1]['requested'] )
+        self.assertTrue( 'error' in records[2] )
+        self.assertTrue( 'errors 1; request-numbers 1;' in summary )
+
+    def test_bib_row_without_year(self):
+        """ Tests a bib row with an empty year cell, or no year at all, is searched and requested with no date filter, rather than a blank one. """
+        input_text = 'patron,search_type,search_value,title,author,year\n'
+        input_text += '1,,,%s,"Pirsig, Robert M",\n' % self.stub.TITLE_AVAILABLE
+        ( status, records, summary ) = self.run_cli( ['--action', 'search_and_request'], input_text )
+        ( jsonl_status, jsonl_records, summary ) = self.run_cli( ['--action', 'search', '--patron', '1'], json.dumps({'title': self.stub.TITLE_AVAILABLE, 'year': ' '}) + '\n' )
+        self.assertEqual( ( 0, 0 ), (status, jsonl_status) )
+        self.assertEqual( ( 'available', True, None ), (records[0]['search_outcome'], records[0]['requested'], records[0]['input']['year']) )
+        self.assertEqual( ( 'available', None ), (jsonl_records[0]['search_outcome'], jsonl_records[0]['input']['year']) )
+
+    ## end class CliTests
+
+
+class JournalTests( unittest.TestCase ):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.temp_dir.name, 'journal.sqlite' )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_search_writes_are_batched(self):
+        """ Tests search entries reach the file only once a batch fills, but are readable at once. """
+        with Journal( self.path, batch_size=2, flush_interval=60 ) as journal:
+            key_a = journal.make_exact_key( '1', 'ISBN', '978-0-688-00230-5' )
+            self.assertEqual( key_a, journal.make_exact_key('1', 'ISBN', '9780688002305') )
+            journal.record_search( key_a, {'Available': True} )
+            self.assertEqual( {'Available': True}, journal.get(key_a, 'search')['result'] )
+            with Journal( self.path ) as other:
+                self.assertEqual( {}, other.stats() )
+                journal.record_search( journal.make_bib_key('1', 'Title', ['Author'], 1974), {'Available': False} )
+                self.assertEqual( {'search:done': 2}, other.stats() )
+
+    def test_request_claims(self):
+        """ Tests a key with a pending or done request cannot be claimed again, and a failed one can. """
+        with Journal( self.path ) as journal:
+            key = journal.make_exact_key( '1', 'ISBN', '9780688002305' )
+            self.assertEqual( True, journal.begin_request(key) )
+            self.assertEqual( False, journal.begin_request(key) )
+            journal.fail_request( key, 'ConnectionError()' )
+            self.assertEqual( True, journal.begin_request(key) )
+            journal.finish_request( key, {'RequestNumber': 'BRO-1'} )
+            self.assertEqual( False, journal.begin_request(key) )
+        with Journal( self.path ) as journal:
+            self.assertEqual( 'BRO-1', journal.get(key, 'request')['request_number'] )
+
+    def test_cli_rerun_skips_journaled_work(self):
+        """ Tests a re-run with the same journal neither re-searches nor re-requests, and a duplicate row is requested once. """
+        with StubServer() as stub:
+            argv = [ '--action', 'search_and_request', '--patron', '1', '--workers', '1', '--journal', self.path, '--setting', 'API_URL_ROOT="%s"' % stub.url ]
+            input_text = 'search_type,search_value\nISBN,%s\nISBN,%s\nISBN,%s\n' % ( stub.ISBN_AVAILABLE, stub.ISBN_NOT_FOUND, stub.ISBN_AVAILABLE )
+            stdout = io.StringIO()
+            cli.main( argv, stdin=io.StringIO(input_text), stdout=stdout, stderr=io.StringIO() )
+            request_numbers = [ json.loads(line)['request_number'] for line in stdout.getvalue().splitlines() ]
+            self.assertEqual( ['BRO-00000001', 'BRO-00000001'], sorted([n for n in request_numbers if n]) )
+            self.assertEqual( 1, stub.counts['request'] )
+            searches = stub.counts['search']
+            stderr = io.StringIO()
+            cli.main( argv, stdin=io.StringIO(input_text), stdout=io.StringIO(), stderr=stderr )
+            self.assertEqual( ( 1, searches ), ( stub.counts['request'], stub.counts['search'] ) )
+            self.assertTrue( 'from journal 3;' in stderr.getvalue() )
+
+    ## end class JournalTests
+
+
+class DeadlineTests( unittest.TestCase ):
+    """ Offline; stub-server latency is 0.2 seconds per call. """
+
+    def setUp(self):
+        self.stub = StubServer( latency=0.2 ).start()
+        self.basics = {
+            'API_URL_ROOT': self.stub.url, 'API_KEY': 'key', 'PARTNERSHIP_ID': 'BD', 'UNIVERSITY_CODE': 'BROWN', 'PICKUP_LOCATION': 'A' }
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_deadline_caps_timeouts(self):
+        """ Tests timeouts are capped at the remaining budget, and the auth share. """
+        deadline = Deadline( 2.0, auth_share=0.25 )
+        ( connect, read ) = deadline.timeout_for( 'search', (10, 90) )
+        self.assertTrue( 1.9 < read <= 2.0 and connect == read )
+        self.assertTrue( 0.45 < deadline.for_auth().remaining() <= 0.5 )
+        with self.assertRaises( DeadlineExceeded ):
+            Deadline( 0 ).timeout_for( 'search', 90 )
+
+    def test_within_deadline(self):
+        """ Tests an operation that fits its budget is unaffected. """
+        bd = BorrowDirect( dict(self.basics, DEADLINE_SECONDS=2.0) )
+        bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( True, bd.search_result['Available'] )
+
+    def test_auth_phase_exceeded(self):
+        """ Tests a slow authentication is cut off at its share of the budget, and named. """
+        bd = BorrowDirect( dict(self.basics, DEADLINE_SECONDS=0.3, DEADLINE_AUTH_SHARE=0.5) )
+        start = time.monotonic()
+        with self.assertRaises( DeadlineExceeded ) as context:
+            bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( 'authentication', context.exception.phase )
+        self.assertTrue( time.monotonic() - start < 0.3 )
+
+    def test_search_phase_exceeded(self):
+        """ Tests the search gets what the authentication left, and is named when that runs out. """
+        bd = BorrowDirect( dict(self.basics, DEADLINE_SECONDS=0.35, DEADLINE_AUTH_SHARE=0.9) )
+        start = time.monotonic()
+        with self.assertRaises( DeadlineExceeded ) as context:
+            bd.run_search_and_request_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( 'search', context.exception.phase )
+        self.assertTrue( time.monotonic() - start < 0.45 )
+        self.assertEqual( 0, self.stub.counts['request'] )
+
+    def test_rate_limit_wait_capped_by_deadline(self):
+        """ Tests a rate-limit wait longer than the remaining budget raises at once for the phase, without taking a token or making the call. """
+        bd = BorrowDirect( dict(self.basics, DEADLINE_SECONDS=1.0, RATE_LIMIT_PER_SECOND=0.5) )  # the authentication takes the only token; the next is 2 seconds away
+        start = time.monotonic()
+        with self.assertRaises( DeadlineExceeded ) as context:
+            bd.search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        self.assertEqual( 'search', context.exception.phase )
+        self.assertTrue( time.monotonic() - start < 0.5 )
+        self.assertEqual( ( 1, 0 ), (self.stub.counts['authentication'], self.stub.counts['search']) )
+        self.assertTrue( 1.5 < bd.rate_limiter.reserve() <= 2.0 )  # the failed call left its token
+
+    def test_async_rate_limit_wait_capped_by_deadline(self):
+        """ Tests AsyncBorrowDirect likewise gives up on a rate-limit wait the budget cannot cover. """
+        async def search():
+            async with AsyncBorrowDirect( dict(self.basics, DEADLINE_SECONDS=1.0, RATE_LIMIT_PER_SECOND=0.5) ) as bd:
+                await bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        start = time.monotonic()
+        with self.assertRaises( DeadlineExceeded ) as context:
+            asyncio.run( search() )
+        self.assertEqual( 'search', context.exception.phase )
+        self.assertTrue( time.monotonic() - start < 0.5 )
+
+    def test_async_deadline(self):
+        """ Tests AsyncBorrowDirect honors the same budget. """
+        async def search():
+            async with AsyncBorrowDirect( dict(self.basics, DEADLINE_SECONDS=0.3) ) as bd:
+                await bd.run_search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        with self.assertRaises( DeadlineExceeded ) as context:
+            asyncio.run( search() )
+        self.assertEqual( 'authentication', context.exception.phase )
+
+    def test_single_flight_waiter_deadline(self):
+        """ Tests a search joining a slower identical one gives up at its own deadline, while the first completes. """
+        flights = SingleFlight( 'search' )
+        def slow_call():
+            time.sleep( 0.3 )
+            return { 'Available': True }
+        with concurrent.futures.ThreadPoolExecutor( max_workers=1 ) as executor:
+            leader = executor.submit( flights.do, 'key', slow_call )
+            time.sleep( 0.05 )
+            with self.assertRaises( DeadlineExceeded ) as context:
+                flights.do( 'key', slow_call, Deadline(0.1) )
+            self.assertEqual( {'Available': True}, leader.result() )
+        self.assertEqual( ( 'search', {'calls': 1, 'collapsed': 1, 'in_flight': 0} ), (context.exception.phase, flights.stats()) )
+
+    def test_single_flight_leader_deadline_not_shared(self):
+        """ Tests a waiter whose shared call was cut off by the leader's deadline makes the call itself. """
+        flights = SingleFlight( 'search' )
+        def leader_call():
+            time.sleep( 0.1 )
+            raise DeadlineExceeded( 'search', 0.1, 0.1 )
+        with concurrent.futures.ThreadPoolExecutor( max_workers=1 ) as executor:
+            leader = executor.submit( flights.do, 'key', leader_call )
+            time.sleep( 0.05 )
+            self.assertEqual( {'Available': True}, flights.do('key', lambda: {'Available': True}, Deadline(1.0)) )
+            self.assertRaises( DeadlineExceeded, leader.result )
+
+    def test_single_flight_error_shared(self):
+        """ Tests waiters get the in-flight call's exception, and the next call starts afresh. """
+        flights = SingleFlight()
+        def failing_call():
+            time.sleep( 0.1 )
+            raise ConnectionError( 'down' )
+        with concurrent.futures.ThreadPoolExecutor( max_workers=3 ) as executor:
+            futures = [ executor.submit(flights.do, 'key', failing_call) for i in range(3) ]
+            self.assertEqual( [ConnectionError] * 3, [ type(future.exception()) for future in futures ] )
+        self.assertEqual( {'ok': 1}, flights.do('key', lambda: {'ok': 1}) )
+        self.assertEqual( {'calls': 2, 'collapsed': 2, 'in_flight': 0}, flights.stats() )
+
+    ## end class DeadlineTests
+
+
+class ResultObjectTests( unittest.TestCase ):
+    """ Offline; parses the README response shapes, and runs against the local stub server. """
+
+    def test_search_result_shapes(self):
+        """ Tests parsing of available, held-locally, and not-found searches. """
+        available = SearchResult.from_bytes( json.dumps({
+            'Available': True, 'OrigNumberOfRecords': 1,
+            'PickupLocation': [ {'PickupLocationCode': 'A', 'PickupLocationDescription': 'Rockefeller Library'} ],
+            'RequestLink': {'ButtonLabel': 'Request', 'ButtonLink': 'AddRequest', 'RequestMessage': 'Request this through Borrow Direct.'} }).encode('utf-8') )
+        self.assertEqual( ( 'available', True, (('A', 'Rockefeller Library'),), None ), (available.outcome, available.found, available.pickup_locations, available.raw) )
+        held_locally = SearchResult.from_dict( {'Available': False, 'RequestLink': {'ButtonLink': 'http://josiah.brown.edu/record=.b18151139a', 'RequestMessage': 'This item is available locally.'}} )
+        self.assertEqual( True, held_locally.held_locally )
+        not_found = SearchResult.from_dict( {'Problem': {'ErrorCode': 'PUBFI002', 'ErrorMessage': 'No result'}}, keep_raw=True )
+        self.assertEqual( ( 'not_found', False, 'PUBFI002' ), (not_found.outcome, not_found.found, not_found.problem_code) )
+        self.assertEqual( 'PUBFI002', not_found.to_dict()['raw']['Problem']['ErrorCode'] )
+        self.assertEqual( False, hasattr(not_found, '__dict__') )
+
+    def test_request_result_drop_fields(self):
+        """ Tests dropped fields are gone from both the object and its kept raw dct, while the outcome is unaffected. """
+        content = json.dumps( {'RequestLink': {'ButtonLink': 'https://illiad.example.edu/' + 'x' * 4000, 'RequestMessage': 'This item is available locally.'}} ).encode( 'utf-8' )
+        result = RequestResult.from_bytes( content, keep_raw=True, drop=['RequestLink.ButtonLink', 'No.Such.Field'] )
+        self.assertEqual( ( False, None, 'This item is available locally.' ), (result.requested, result.request_url, result.request_message) )
+        self.assertEqual( {'RequestLink': {'RequestMessage': 'This item is available locally.'}}, result.raw )
+        self.assertEqual( 'held_locally', SearchResult.from_bytes(content.replace(b'{"RequestLink"', b'{"Available": false, "RequestLink"'), drop=['RequestLink.RequestMessage']).outcome )
+
+    def test_json_backends_agree(self):
+        """ Tests the standard-library and (if installed) orjson backends decode alike. """
+        content = '{"RequestLink": {"RequestMessage": "caf\u00e9"}, "OrigNumberOfRecords": 1}'.encode( 'utf-8' )
+        try:
+            metrics.set_json_backend( 'json' )
+            expected = metrics.loads_json( content )
+            if metrics.set_json_backend( 'auto' ) == 'orjson':
+                self.assertEqual( expected, metrics.loads_json(content) )
+        finally:
+            metrics.set_json_backend( 'auto' )
+
+    def test_result_format_object(self):
+        """ Tests RESULT_FORMAT 'object' for the run_* methods, including search-then-request. """
+        with StubServer() as stub:
+            bd = BorrowDirect( {
+                'API_URL_ROOT': stub.url, 'PARTNERSHIP_ID': 'BD', 'PICKUP_LOCATION': 'A',
+                'RESULT_FORMAT': 'object', 'RESULT_DROP_FIELDS': ['RequestLink.ButtonLink'] } )
+            bd.run_search_exact_item( '123', 'ISBN', stub.ISBN_UNAVAILABLE )
+            self.assertEqual( ( 'unavailable', None ), (bd.search_result.outcome, bd.search_result.request_url) )
+            outcome = bd.run_search_and_request_exact_item( '123', 'ISBN', stub.ISBN_AVAILABLE )
+            self.assertEqual( 'BRO-00000001', outcome['request_number'] )
+            self.assertEqual( 'BRO-00000001', bd.request_result.request_number )
+            bd.close()
+
+    def test_result_objects_built_from_bytes(self):
+        """ Tests RESULT_FORMAT 'object' builds results as the response is decoded, with metrics still counting error-codes; a search-cache keeps dcts. """
+        with StubServer() as stub:
+            settings = { 'API_URL_ROOT': stub.url, 'PARTNERSHIP_ID': 'BD', 'PICKUP_LOCATION': 'A', 'RESULT_FORMAT': 'object', 'METRICS_ENABLED': True }
+            with BorrowDirect( settings ) as bd:
+                srchr = bd.make_searcher()
+                result = srchr.search_exact_item( '123', stub.url, None, 'BD', None, 'ISBN', stub.ISBN_NOT_FOUND )
+                self.assertEqual( ( SearchResult, 'not_found' ), (type(result), result.outcome) )
+                self.assertEqual( RequestResult, type(bd.make_requester().request_exact_item('123', stub.url, None, 'BD', None, 'A', 'ISBN', stub.ISBN_AVAILABLE)) )
+                self.assertEqual( {'PUBFI002': 1}, bd.metrics.snapshot()['endpoints']['search']['error_codes'] )
+            with BorrowDirect( dict(settings, SEARCH_CACHE_MAX_ENTRIES=10) ) as bd:
+                self.assertEqual( None, bd.make_searcher().result_parser )
+                self.assertEqual( 'available', bd.search_exact_item('123', 'ISBN', stub.ISBN_AVAILABLE).outcome )
+
+    def test_format_result_leaves_caller_dct_whole(self):
+        """ Tests dropped fields are removed from a copy, sharing the untouched parts. """
+        dct = { 'Available': True, 'RequestLink': {'ButtonLink': 'x' * 4000, 'RequestMessage': 'Request this.'}, 'PickupLocation': [{'PickupLocationCode': 'A'}] }
+        original = json.loads( json.dumps(dct) )
+        trimmed = format_result( dct, 'search', 'dict', ['RequestLink.ButtonLink', 'Available.Nested', 'No.Such.Field'] )
+        self.assertEqual( original, dct )
+        self.assertEqual( {'RequestMessage': 'Request this.'}, trimmed['RequestLink'] )
+        self.assertTrue( trimmed['PickupLocation'] is dct['PickupLocation'] )
+        self.assertEqual( None, format_result(dct, 'search', 'object', ['RequestLink.ButtonLink']).request_url )
+        self.assertEqual( original, dct )
+
+    ## end class ResultObjectTests
+
+
+class TenantRegistryTests( unittest.TestCase ):
+    """ Offline; runs tenants against the local stub server. """
+
+    def test_tenants(self):
+        """ Tests per-tenant pools and settings, the shared search-cache and metrics, and threads spanning tenants. """
+        with StubServer() as stub:
+            registry = TenantRegistry(
+                tenants={ 'brown': {'API_KEY': 'b', 'UNIVERSITY_CODE': 'BROWN', 'PICKUP_LOCATION': 'A'}, 'yale': {'API_KEY': 'y', 'UNIVERSITY_CODE': 'YALE', 'PICKUP_LOCATION': 'B'} },
+                shared_settings={ 'API_URL_ROOT': stub.url, 'PARTNERSHIP_ID': 'BD', 'AUTH_CACHE_TTL': 60, 'SEARCH_CACHE_MAX_ENTRIES': 100, 'METRICS_ENABLED': True } )
+            with registry:
+                ( brown, yale ) = ( registry['brown'], registry['yale'] )
+                self.assertEqual( ( 'BROWN', 'YALE', 'BD' ), (brown.UNIVERSITY_CODE, yale.UNIVERSITY_CODE, yale.PARTNERSHIP_ID) )
+                self.assertTrue( brown.session is not yale.session and brown.auth_cache is not yale.auth_cache )
+                self.assertTrue( brown.search_cache is yale.search_cache is registry.search_cache and brown.metrics is registry.metrics )
+                self.assertTrue( registry.get('brown') is brown )
+                jobs = [ (name, isbn) for name in ('brown', 'yale') for isbn in (stub.ISBN_AVAILABLE, stub.ISBN_NOT_FOUND) ] * 3
+                for ( name, isbn ) in jobs[:4]:
+                    registry[name].search_exact_item( '123', 'ISBN', isbn )
+                with concurrent.futures.ThreadPoolExecutor( max_workers=4 ) as executor:
+                    outcomes = list( executor.map(lambda job: classify_search_result(registry[job[0]].search_exact_item('123', 'ISBN', job[1])), jobs) )
+                self.assertEqual( [ 'available', 'not_found' ] * 6, outcomes )
+                self.assertEqual( 4, stub.counts['search'] )  # one per tenant and isbn; the rest are cache hits, not shared across tenants
+                self.assertEqual( 2, stub.counts['authentication'] )
+                self.assertRaises( KeyError, registry.get, 'harvard' )
+                registry.remove( 'yale' )
+                self.assertEqual( ['brown'], registry.names() )
+
+    def test_file_backed_state_is_per_tenant(self):
+        """ Tests shared AUTH_CACHE_PATH and RATE_LIMIT_PATH become one file per tenant, so one tenant's calls do not spend another's tokens. """
+        with tempfile.TemporaryDirectory() as directory:
+            ( auth_path, rate_path, own_path ) = ( os.path.join(directory, 'auth.json'), os.path.join(directory, 'rate.json'), os.path.join(directory, 'own.json') )
+            registry = TenantRegistry(
+                tenants={ 'brown': {'UNIVERSITY_CODE': 'BROWN'}, 'yale': {'UNIVERSITY_CODE': 'YALE'}, 'mit': {'UNIVERSITY_CODE': 'MIT', 'RATE_LIMIT_PATH': own_path} },
+                shared_settings={ 'LOG_LEVEL': 'INFO', 'AUTH_CACHE_TTL': 60, 'AUTH_CACHE_PATH': auth_path, 'RATE_LIMIT_PER_SECOND': 0.01, 'RATE_LIMIT_PATH': rate_path } )
+            with registry:
+                ( brown, yale, mit ) = ( registry['brown'], registry['yale'], registry['mit'] )
+                self.assertEqual( ( os.path.join(directory, 'rate.brown.json'), os.path.join(directory, 'rate.yale.json'), own_path ),
+                    (brown.RATE_LIMIT_PATH, yale.RATE_LIMIT_PATH, mit.RATE_LIMIT_PATH) )
+                self.assertEqual( ( os.path.join(directory, 'auth.brown.json'), os.path.join(directory, 'auth.yale.json') ), (brown.AUTH_CACHE_PATH, yale.AUTH_CACHE_PATH) )
+                self.assertEqual( ( 0.0, 0.0 ), (brown.rate_limiter.reserve(), yale.rate_limiter.reserve()) )  # each tenant's first token is its own
+                self.assertTrue( brown.rate_limiter.reserve() > 0 )
+
+    ## end class TenantRegistryTests
+
+
+class AuthKeepAliveTests( unittest.TestCase ):
+    """ Offline; runs against the local stub server, whose authorization-ids expire unless authorized. """
+
+    def setUp(self):
+        self.stub = StubServer( aid_ttl=0.6 ).start()
+        self.basics = { 'API_URL_ROOT': self.stub.url, 'PARTNERSHIP_ID': 'BD', 'AUTH_CACHE_TTL': 0.5 }
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_keepalive_avoids_reauthentication(self):
+        """ Tests a patron's authorization-id is refreshed in the background, so later searches skip authentication. """
+        with BorrowDirect( dict(self.basics, AUTH_KEEPALIVE=True, AUTH_KEEPALIVE_MARGIN=0.3) ) as bd:
+            for i in range( 3 ):
+                self.assertEqual( True, bd.search_exact_item('123', 'ISBN', self.stub.ISBN_AVAILABLE)['Available'] )
+                time.sleep( 0.7 )  # longer than both ttls
+            self.assertEqual( 1, self.stub.counts['authentication'] )
+            self.assertTrue( bd.auth_keepalive.stats()['refreshes'] >= 3 )
+        self.assertEqual( None, bd.auth_keepalive.thread )
+
+    def test_idle_eviction(self):
+        """ Tests an unused authorization-id stops being refreshed, and one the server rejects is invalidated. """
+        bd = BorrowDirect( self.basics )
+        keepalive = AuthKeepAlive( bd.auth_cache, session=bd.session, refresh_margin=0.5, idle_timeout=0.2 )  # not started; passes run manually
+        bd.search_exact_item( '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+        key = bd.auth_cache.make_key( self.stub.url, 'BD', None, '123' )
+        keepalive.refresh()
+        self.assertEqual( {'tracked': 1, 'refreshes': 1, 'failures': 0, 'evictions': 0}, keepalive.stats() )
+        time.sleep( 0.3 )
+        keepalive.refresh()
+        self.assertEqual( {'tracked': 0, 'refreshes': 1, 'failures': 0, 'evictions': 1}, keepalive.stats() )
+        bd.auth_cache.set( key, 'not-an-aid' )
+        keepalive.refresh()
+        self.assertEqual( ( None, 0 ), (bd.auth_cache.get(key), keepalive.stats()['tracked']) )
+        bd.close()
+
+    ## end class AuthKeepAliveTests
+
+
+class PipelineTests( unittest.TestCase ):
+    """ Offline; runs the pipeline against the local stub server. """
+
+    def setUp(self):
+        self.stub = StubServer( latency=0.02 ).start()
+        self.bd = BorrowDirect( {'API_URL_ROOT': self.stub.url, 'PARTNERSHIP_ID': 'BD', 'PICKUP_LOCATION': 'A', 'AUTH_CACHE_TTL': 60} )
+
+    def tearDown(self):
+        self.bd.close()
+        self.stub.stop()
+
+    def test_search_decide_request(self):
+        """ Tests each outcome is requested or not per the decide function, errors become outcomes, and stats add up. """
+        items = [ ('ISBN', self.stub.ISBN_AVAILABLE), ('ISBN', self.stub.ISBN_HELD_LOCALLY), ('ISBN', self.stub.ISBN_NOT_FOUND), ('ISBN', self.stub.ISBN_UNAVAILABLE),
+                  {'patron': '456', 'title': self.stub.TITLE_AVAILABLE, 'author': ['Pirsig, Robert M'], 'year': range(1973, 1976)}, ('bad',) ]
+        pipeline = Pipeline( self.bd, search_workers=3, request_workers=2 )
+        outcomes = { str(outcome['item']): outcome for outcome in pipeline.run(items, '123') }
+        self.assertEqual( [True, False, False, True, True], [ outcomes[str(item)]['requested'] for item in items[:5] ] )
+        self.assertEqual( 'BRO-00000001', outcomes[str(items[0])]['request_number'] )
+        self.assertTrue( 'IndexError' in outcomes[str(items[5])]['error'] )
+        stats = pipeline.stats()
+        self.assertEqual( ( 6, 5, 1, 3, 2, 3, 6 ), (stats['fed'], stats['search']['completed'], stats['search']['errors'], stats['decide']['request'], stats['decide']['skip'], stats['request']['completed'], stats['output']['emitted']) )
+        outcomes = list( Pipeline(self.bd, decide=lambda item, result: False).run(items[:2], '123') )
+        self.assertEqual( [False, False], [ outcome['requested'] for outcome in outcomes ] )
+
+    def test_backpressure(self):
+        """ Tests a slow consumer holds back reading of a long input, and stopping early stops the workers. """
+        pipeline = Pipeline( self.bd, search_workers=2, request_workers=1, queue_size=2 )
+        outcomes = pipeline.run( (('ISBN', self.stub.ISBN_AVAILABLE) for i in range(100000)), '123' )
+        for i in range( 5 ):
+            next( outcomes )
+            time.sleep( 0.05 )
+        in_flight_bound = 3 * 2 + 2 + 1 + 1  # three queues, the workers, and the item the feeder holds
+        self.assertTrue( pipeline.stats()['fed'] <= 5 + in_flight_bound )
+        outcomes.close()
+        self.assertEqual( [], [ thread.name for thread in threading.enumerate() if thread.name.startswith('bdpy3-pipeline') ] )
+
+    ## end class PipelineTests
+
+
+class SchedulerTests( unittest.TestCase ):
+    """ Offline; schedules calls against the local stub server. """
+
+    def setUp(self):
+        self.stub = StubServer( latency=0.05 ).start()
+        self.bd = BorrowDirect( {'API_URL_ROOT': self.stub.url, 'PARTNERSHIP_ID': 'BD', 'PICKUP_LOCATION': 'A', 'AUTH_CACHE_TTL': 60, 'SEARCH_SINGLE_FLIGHT': False} )
+        self.classes = { 'interactive': {'rank': 0, 'max_concurrency': 2}, 'bulk': {'rank': 1, 'max_concurrency': 2, 'max_queued': 50} }
+
+    def tearDown(self):
+        self.bd.close()
+        self.stub.stop()
+
+    def test_interactive_not_starved(self):
+        """ Tests an interactive call starts at once while a bulk backlog runs at its full concurrency, and results and errors come back. """
+        with Scheduler( self.bd, classes=self.classes ) as scheduler:
+            bulk = [ scheduler.submit('bulk', 'search_exact_item', 'bulk', 'ISBN', self.stub.ISBN_AVAILABLE) for i in range(40) ]
+            time.sleep( 0.1 )
+            start = time.perf_counter()
+            result = scheduler.call( 'interactive', 'request_exact_item', '123', 'ISBN', self.stub.ISBN_AVAILABLE )
+            self.assertTrue( time.perf_counter() - start < 0.5 )  # one authentication and one request; the backlog needs about a second
+            self.assertEqual( 'BRO-00000001', result['RequestNumber'] )
+            self.assertEqual( 2, scheduler.stats()['classes']['bulk']['active'] )
+            with self.assertRaises( Exception ):
+                scheduler.call( 'interactive', 'search_exact_item', '123', 'BAD', '1' )
+        self.assertEqual( True, all( future.result()['Available'] for future in bulk ) )
+        stats = scheduler.stats()['classes']
+        self.assertEqual( (40, 0, 2, 1), (stats['bulk']['completed'], stats['bulk']['errors'], stats['interactive']['completed'], stats['interactive']['errors']) )
+
+    def test_fair_queuing_across_patrons(self):
+        """ Tests patrons within a class take turns, rather than running in submission order. """
+        order = []
+        class RecordingBorrowDirect( object ):
+            def search_exact_item( self, patron_barcode, search_type, search_value ):
+                order.append( patron_barcode )
+                time.sleep( 0.01 )
+        with Scheduler( RecordingBorrowDirect(), classes={'bulk': {'rank': 0, 'max_concurrency': 1}} ) as scheduler:
+            scheduler.submit( 'bulk', 'search_exact_item', 'first', 'ISBN', '1' )  # occupies the worker while the rest queue
+            for patron in [ 'a' ] * 3 + [ 'b' ] * 3:
+                scheduler.submit( 'bulk', 'search_exact_item', patron, 'ISBN', '1' )
+        self.assertEqual( ['first', 'a', 'b', 'a', 'b', 'a', 'b'], order )
+
+    ## end class SchedulerTests
+
+
 if __name__ == '__main__':
   unittest.main()
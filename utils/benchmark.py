@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+""" Drives the BorrowDirect entry-points against the local stub server at varying concurrency;
+      reports throughput and p50/p95/p99 latency per scenario.
+
+    Usage (from the repo root):
+        $ python ./utils/benchmark.py
+        $ python ./utils/benchmark.py --calls 400 --concurrency 1,8,32 --latency 0.02 --json
+        $ python ./utils/benchmark.py --setting HTTP_CASSETTE_PATH='"./bench.json"' --setting HTTP_CASSETTE_LATENCY=1.0  # replays a recorded cassette """
+
+import argparse, concurrent.futures, json, os, sys, threading, time
+
+os.environ.setdefault( 'BDPY3_LOG_CONFIG_JSON', json.dumps({  # set before bdpy3's import, so per-call debug-logging does not skew timings
+    'version': 1, 'disable_existing_loggers': False,
+    'handlers': { 'default': {'level': 'WARNING', 'class': 'logging.StreamHandler'} },
+    'loggers': { '': {'handlers': ['default'], 'level': 'WARNING'} } }) )
+sys.path.insert( 0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+from bdpy3 import BorrowDirect
+from bdpy3.stub_server import StubServer
+
+
+SCENARIOS = {
+    'search_exact': lambda bd, stub, i: bd.run_search_exact_item( 'patron_%s' % (i % 50), 'ISBN', [stub.ISBN_AVAILABLE, stub.ISBN_NOT_FOUND][i % 2] ),
+    'search_bib': lambda bd, stub, i: bd.run_search_bib_item( 'patron_%s' % (i % 50), stub.TITLE_AVAILABLE, ['Pirsig, Robert M'], '1974' ),
+    'request_exact': lambda bd, stub, i: bd.run_request_exact_item( 'patron_%s' % (i % 50), 'ISBN', stub.ISBN_AVAILABLE ),
+    'search_and_request_exact': lambda bd, stub, i: bd.run_search_and_request_exact_item( 'patron_%s' % (i % 50), 'ISBN', stub.ISBN_AVAILABLE ),
+    }
+
+
+def run_scenario( stub, settings, scenario, calls, concurrency ):
+    """ Returns stats dct for `calls` runs of the scenario on `concurrency` threads.
+        Each thread uses its own BorrowDirect instance, since the run_* methods store results on the instance. """
+    func = SCENARIOS[scenario]
+    local = threading.local()
+    def timed_call( i ):
+        if not hasattr( local, 'bd' ):
+            local.bd = BorrowDirect( settings )
+        start = time.perf_counter()
+        func( local.bd, stub, i )
+        return time.perf_counter() - start
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor( max_workers=concurrency ) as executor:
+        latencies = sorted( executor.map(timed_call, range(calls)) )
+    elapsed = time.perf_counter() - start
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'calls': calls,
+        'seconds': round( elapsed, 3 ),
+        'calls_per_second': round( calls / elapsed, 1 ),
+        'p50_ms': round( percentile(latencies, 50) * 1000, 1 ),
+        'p95_ms': round( percentile(latencies, 95) * 1000, 1 ),
+        'p99_ms': round( percentile(latencies, 99) * 1000, 1 ),
+        }
+
+
+def percentile( sorted_values, pct ):
+    """ Returns nearest-rank percentile of an already-sorted list. """
+    if not sorted_values:
+        return 0.0
+    rank = max( 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) )
+    return sorted_values[ min(rank, len(sorted_values)) - 1 ]
+
+
+def main():
+    parser = argparse.ArgumentParser( description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( '--calls', type=int, default=200, help='calls per scenario and concurrency-level' )
+    parser.add_argument( '--concurrency', default='1,4,16', help='comma-separated thread counts' )
+    parser.add_argument( '--scenarios', default=','.join(SCENARIOS), help='comma-separated; choices: %s' % ', '.join(SCENARIOS) )
+    parser.add_argument( '--latency', type=float, default=0.01, help='stub-server seconds per response' )
+    parser.add_argument( '--error-rate', type=float, default=0.0, help='stub-server fraction of http errors' )
+    parser.add_argument( '--setting', action='append', default=[], metavar='NAME=JSON', help='extra BorrowDirect setting, eg AUTH_CACHE_TTL=600; repeatable' )
+    parser.add_argument( '--json', action='store_true', help='print one json line per result instead of a table' )
+    args = parser.parse_args()
+    rows = []
+    with StubServer( latency=args.latency, error_rate=args.error_rate, seed=1 ) as stub:
+        settings = { 'API_URL_ROOT': stub.url, 'API_KEY': 'key', 'PARTNERSHIP_ID': 'BD', 'UNIVERSITY_CODE': 'BROWN', 'PICKUP_LOCATION': 'A', 'LOG_LEVEL': 'INFO' }
+        for setting in args.setting:
+            ( name, value ) = setting.split( '=', 1 )
+            settings[name] = json.loads( value )
+        concurrency_levels = [ int(c) for c in args.concurrency.split(',') ]
+        settings['HTTP_POOL_MAXSIZE'] = max( settings.get('HTTP_POOL_MAXSIZE', 10), max(concurrency_levels) )
+        for scenario in args.scenarios.split( ',' ):
+            for concurrency in concurrency_levels:
+                row = run_scenario( stub, settings, scenario, args.calls, concurrency )
+                rows.append( row )
+                if args.json:
+                    print( json.dumps(row) )
+                else:
+                    print( '%(scenario)-26s concurrency %(concurrency)4s  %(calls_per_second)8s calls/s  p50 %(p50_ms)7s ms  p95 %(p95_ms)7s ms  p99 %(p99_ms)7s ms' % row )
+    return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+""" Measures bdpy3 startup cost, as paid by short-lived cli and cron processes:
+      wall-time of fresh interpreters running each stage, minus a bare-interpreter baseline,
+      plus the modules each stage pulls in.
+
+    Usage (from the repo root):
+        $ python ./utils/import_benchmark.py
+        $ python ./utils/import_benchmark.py --runs 30 --json
+        $ python -X importtime -c 'import bdpy3' 2>&1 | sort -t'|' -k2 -n | tail  # per-module detail """
+
+import argparse, json, os, statistics, subprocess, sys, time
+
+
+REPO_ROOT = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+STAGES = {
+    'baseline': 'pass',
+    'import bdpy3': 'import bdpy3',
+    'from bdpy3 import BorrowDirect': 'from bdpy3 import BorrowDirect',
+    'BorrowDirect( {} )': 'from bdpy3 import BorrowDirect; BorrowDirect( {"LOG_LEVEL": "INFO"} )',
+    'from bdpy3 import AsyncBorrowDirect': 'from bdpy3 import AsyncBorrowDirect',
+    }
+MODULE_COUNT_SUFFIX = '; import sys; print( len(sys.modules) )'
+
+
+def time_stage( code, runs ):
+    """ Returns list of wall-clock seconds for `runs` fresh interpreters executing code. """
+    env = dict( os.environ, BDPY3_LOG_CONFIG_JSON=json.dumps({'version': 1, 'disable_existing_loggers': False}) )
+    seconds = []
+    for i in range( runs ):
+        start = time.perf_counter()
+        subprocess.run( [sys.executable, '-c', code], cwd=REPO_ROOT, env=env, check=True )
+        seconds.append( time.perf_counter() - start )
+    return seconds
+
+
+def count_modules( code ):
+    """ Returns the number of modules in sys.modules after executing code. """
+    output = subprocess.run( [sys.executable, '-c', code + MODULE_COUNT_SUFFIX], cwd=REPO_ROOT, capture_output=True, text=True, check=True ).stdout
+    return int( output.strip().splitlines()[-1] )
+
+
+def main():
+    parser = argparse.ArgumentParser( description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( '--runs', type=int, default=15, help='fresh interpreters per stage' )
+    parser.add_argument( '--json', action='store_true', help='print one json line per stage instead of a table' )
+    args = parser.parse_args()
+    baseline_ms = None
+    rows = []
+    for ( stage, code ) in STAGES.items():
+        median_ms = statistics.median( time_stage(code, args.runs) ) * 1000
+        if baseline_ms is None:
+            baseline_ms = median_ms
+        row = {
+            'stage': stage,
+            'median_ms': round( median_ms, 1 ),
+            'over_baseline_ms': round( median_ms - baseline_ms, 1 ),
+            'modules': count_modules( code ),
+            }
+        rows.append( row )
+        if args.json:
+            print( json.dumps(row) )
+        else:
+            print( '%(stage)-38s median %(median_ms)7s ms  over baseline %(over_baseline_ms)7s ms  modules %(modules)5s' % row )
+    return rows
+
+
+if __name__ == '__main__':
+    main()
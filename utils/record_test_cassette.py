@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+""" Re-records ./cassettes/live_tests.json -- the cassette the webservice test-classes in tests.py replay by default --
+      by running them against the local stub server.
+
+    Usage (from the repo root):
+        $ python ./utils/record_test_cassette.py """
+
+import os, subprocess, sys
+
+sys.path.insert( 0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+from bdpy3.stub_server import StubServer
+
+
+ROOT = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+CASSETTE_PATH = os.path.join( ROOT, 'cassettes', 'live_tests.json' )
+TEST_CLASSES = ( 'BorrowDirectTests', 'AuthenticatorTests', 'SearcherTests', 'RequesterTests' )
+
+
+def main():
+    if os.path.exists( CASSETTE_PATH ):
+        os.remove( CASSETTE_PATH )
+    with StubServer( seed=1 ) as stub:
+        env = dict( os.environ,
+            BDPY3_CASSETTE_PATH=CASSETTE_PATH, BDPY3_CASSETTE_MODE='record', BDPY3_LOG_LEVEL='INFO', BDPY3_TEST__SLEEP_SECONDS='0',
+            BDPY3_TEST__LOG_PATH='', BDPY3_TEST__PATRON_BARCODE='1234567890', BDPY3_TEST__API_URL_ROOT=stub.url,
+            BDPY3_TEST__API_KEY='stub', BDPY3_TEST__UNIVERSITY_CODE='BROWN', BDPY3_TEST__PARTNERSHIP_ID='BD', BDPY3_TEST__PICKUP_LOCATION='Rockefeller Library',
+            BDPY3_TEST__ISBN_FOUND_AND_AVAILABLE=stub.ISBN_AVAILABLE, BDPY3_TEST__ISBN_FOUND_AND_UNAVAILABLE=stub.ISBN_UNAVAILABLE,
+            BDPY3_TEST__ISBN_NOT_FOUND=stub.ISBN_NOT_FOUND )
+        result = subprocess.run( [sys.executable, '-m', 'unittest', '-q'] + [ 'tests.%s' % name for name in TEST_CLASSES ], cwd=ROOT, env=env )
+    print( 'recorded, ```%s```' % CASSETTE_PATH )
+    return result.returncode
+
+
+if __name__ == '__main__':
+    sys.exit( main() )